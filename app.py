@@ -1,30 +1,170 @@
 """Flask App for Flask Cafe."""
 
-from flask import Flask, render_template, flash, jsonify, request
-from flask import redirect, session, g
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-from models import db, connect_db, Cafe, City, User, Like
+_import_started = time.perf_counter()
+
+from flask import Blueprint, Flask, render_template, flash, jsonify, request
+from flask import redirect, session, g, abort, current_app
+from flask_sqlalchemy import Pagination
+
+from models import db, connect_db, record_change, Cafe, City, User, Like
+from mapping import get_city_map_count, save_city_maps
 
 from forms import CafeAddEditForm
 from forms import SignupForm, LoginForm, EditUserForm
 
+from pagecache import cache_page
+from streaming import stream_template
+from autocomplete import cafe_search
+from images import images
+from assets import LIBRARIES, static_url
+from warmup import health
+from offline import offline, offline_cli
+from cafe_api import FieldError, api_response, parse_fields, select_cafes
+from cafe_api import snapshot_values, to_dicts
+from snapshot import catalog
+from routing import READ_YOUR_WRITES_SECONDS, add_replica_binds, read_only
+from cli import LazyCommand
+import bus  # noqa: F401 (publishes committed changes)
+import trending
+import feed
+import queries
+import stats
+
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 
 from secrets import FLASK_SECRET_KEY
 
-from config import DATABASE_URL
+from config import DATABASE_URL, DATABASE_REPLICA_URLS, DATABASE_DIRECT_URL
+from config import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT
+from config import DB_POOL_RECYCLE, DB_POOL_PRE_PING, PGBOUNCER
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+main = Blueprint('main', __name__)
 
-app = Flask(__name__)
+# cities' overview maps are redrawn off the request, one at a time, in order
+city_map_redraws = ThreadPoolExecutor(max_workers=1,
+                                      thread_name_prefix='city-maps')
 
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
-app.config['SECRET_KEY'] = FLASK_SECRET_KEY
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
 
-connect_db(app)
+def create_app(config=None):
+    """Create and configure a Flask Cafe app.
 
+    `config` is a mapping of settings overriding the defaults. Nothing
+    here opens a database connection, so the app can be built in a
+    gunicorn master (--preload) and shared with forked workers.
+    """
 
-@app.errorhandler(404)
+    started = time.perf_counter()
+
+    app = Flask(__name__)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+    app.config['SECRET_KEY'] = FLASK_SECRET_KEY
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = True
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        # drop connections before a server or PgBouncer times them out
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+    app.config['PGBOUNCER'] = PGBOUNCER
+
+    # read-only views read from these (routing.py); after writing, a
+    # user reads from the primary for a while, in case replicas lag
+    app.config['SQLALCHEMY_REPLICA_URIS'] = DATABASE_REPLICA_URLS
+    app.config['READ_YOUR_WRITES_SECONDS'] = READ_YOUR_WRITES_SECONDS
+
+    # anonymous pages are cached for this many seconds (0 turns it off)
+    app.config['PAGE_CACHE_TTL'] = 60
+    app.config['PAGE_CACHE_MAX_ENTRIES'] = 1000
+
+    app.config['CAFES_PER_PAGE'] = 24
+    # send long pages (/cafes, /profile) as they render
+    app.config['STREAM_TEMPLATES'] = True
+    app.config['STREAM_BUFFER_BYTES'] = 16 * 1024
+    app.config['TRENDING_LIMIT'] = 50
+    # default and largest ?limit= for /api/cafes
+    app.config['API_CAFES_PER_PAGE'] = 100
+    app.config['API_CAFES_MAX_PER_PAGE'] = 1000
+    # default and largest ?limit= for /api/feed
+    app.config['FEED_PER_PAGE'] = 20
+    app.config['FEED_MAX_PER_PAGE'] = 100
+    # the dashboard warns when city stats are older than this (seconds)
+    app.config['CITY_STATS_MAX_AGE'] = 60 * 60
+
+    # resized copies of remote cafe/user images
+    app.config['IMAGE_WIDTHS'] = (160, 320, 640)
+    app.config['IMAGE_CACHE_DIR'] = os.path.join(
+        app.instance_path, 'image-cache')
+    app.config['IMAGE_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+    app.config['IMAGE_MAX_SOURCE_BYTES'] = 10 * 1024 * 1024
+    app.config['IMAGE_MAX_PIXELS'] = 40 * 1000 * 1000
+
+    # memory-mapped catalog shared by the workers on a host (snapshot.py)
+    app.config['CATALOG_SNAPSHOT'] = True
+    app.config['CATALOG_SNAPSHOT_DIR'] = app.instance_path
+    app.config['CATALOG_SNAPSHOT_CHECK'] = 5
+
+    # offline support (offline.py); the manifest is written at build time
+    app.config['SERVICE_WORKER'] = True
+    app.config['SERVICE_WORKER_MANIFEST'] = os.path.join(
+        app.instance_path, 'sw-manifest.json')
+
+    # pooled connections each worker opens before taking traffic
+    app.config['WARMUP_CONNECTIONS'] = 2
+
+    # tell other workers and hosts about commits over NOTIFY (bus.py)
+    app.config['INVALIDATION_BUS'] = True
+    app.config['INVALIDATION_BUS_COALESCE_MS'] = 50
+    # LISTEN needs a session of its own, not one behind PgBouncer
+    app.config['INVALIDATION_BUS_DATABASE_URI'] = DATABASE_DIRECT_URL
+
+    if config:
+        app.config.from_mapping(config)
+
+    add_replica_binds(app)
+    connect_db(app)
+
+    app.register_blueprint(main)
+    app.register_blueprint(images)
+    app.register_blueprint(health)
+    app.register_blueprint(offline)
+    app.add_template_global(static_url)
+    app.add_template_global(LIBRARIES, 'libraries')
+
+    # only needed by the `flask` command, so imported when one runs
+    app.cli.add_command(LazyCommand(
+        'cafes', 'importer:cafes_cli', "Manage cafes."))
+    app.cli.add_command(LazyCommand(
+        'users', 'importer:users_cli', "Manage users."))
+    app.cli.add_command(LazyCommand(
+        'freeze', 'freezer:freeze',
+        "Render the public catalog to static files in OUT."))
+    app.cli.add_command(LazyCommand(
+        'db', 'schema:db_cli', "Manage the database schema."))
+    app.cli.add_command(trending.trending_cli)
+    app.cli.add_command(stats.stats_cli)
+    app.cli.add_command(offline_cli)
+
+    app.config['BOOT_TIMES'] = {
+        'import': IMPORT_SECONDS,
+        'create_app': time.perf_counter() - started,
+    }
+
+    return app
+
+
+@main.app_errorhandler(404)
 def page_not_found(e):
     """Return 404 page."""
 
@@ -38,11 +178,11 @@ CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
 
-@app.before_request
+@main.before_app_request
 def add_user_to_g():
     """If logged in, add curr user to Flask global."""
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = queries.get_user(session[CURR_USER_KEY])
     else:
         g.user = None
 
@@ -60,7 +200,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route("/signup", methods=["GET", "POST"])
+@main.route("/signup", methods=["GET", "POST"])
 def signup():
     """Display signup form and handle request to register new user.
     Redirect to cafes list.
@@ -109,7 +249,7 @@ def signup():
         return render_template("auth/signup-form.html", form=form)
 
 
-@app.route("/login", methods=["GET", "POST"])
+@main.route("/login", methods=["GET", "POST"])
 def login():
     """Produce login form or handle login.
     Redirects to cafes list on successful login.
@@ -136,7 +276,7 @@ def login():
     return render_template("auth/login-form.html", form=form)
 
 
-@app.route("/logout", methods=["POST", "GET"])
+@main.route("/logout", methods=["POST", "GET"])
 def logout():
     """Handle user logout. Redirects to homepage."""
 
@@ -148,7 +288,8 @@ def logout():
 #######################################
 # homepage
 
-@app.route("/")
+@main.route("/")
+@cache_page
 def homepage():
     """Show homepage."""
 
@@ -158,24 +299,133 @@ def homepage():
 #######################################
 # cafes
 
-@app.route('/cafes')
+@main.route('/cafes')
+@cache_page
+@read_only
 def cafe_list():
-    """Return list of all cafes."""
+    """Return list of cafes, optionally only those in ?city=<code>, and
+    only those open now (?open_now=1)."""
+
+    city_code = request.args.get('city')
+    open_now = request.args.get('open_now', 0, type=int)
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['CAFES_PER_PAGE']
+
+    registry = City.get_registry()
+
+    if city_code and city_code not in registry:
+        abort(404)
+    if page < 1:
+        abort(404)
+
+    snapshot = catalog.get()
+    offset = (page - 1) * per_page
+
+    if snapshot is not None:
+        counts = snapshot.city_counts()
+        query = None
+        if open_now:
+            # the snapshot has every cafe's hours bitmap
+            slots = City.get_local_slots()
+            if city_code:
+                slots = {city_code: slots.get(city_code)}
+            found = snapshot.open_records(slots)
+            total = len(found)
+            items = snapshot.rows(found[offset:offset + per_page])
+        else:
+            total = counts.get(city_code, 0) if city_code else len(snapshot)
+            items = snapshot.page(city_code, offset, per_page)
 
-    cafes = Cafe.query.order_by('name').all()
+    else:
+        counts = Cafe.get_city_counts()
+        query = Cafe.query
+        if city_code:
+            query = query.filter_by(city_code=city_code)
+            total = counts.get(city_code, 0)
+        else:
+            total = sum(counts.values())
 
-    return render_template(
+        if open_now:
+            query = query.filter(Cafe.open_at())
+            total = query.order_by(None).count()
+
+        # runs as the page renders, once its head has gone out
+        items = (query.order_by(Cafe.name, Cafe.id)
+                 .limit(per_page)
+                 .offset(offset))
+
+    if page > 1 and (page - 1) * per_page >= total:
+        abort(404)
+
+    # cached facet counts give us the total, so no COUNT query here
+    cafes = Pagination(query, page, per_page, total, items)
+
+    facets = [(code, name, counts.get(code, 0))
+              for code, name in registry.choices]
+
+    return stream_template(
         'cafe/list.html',
         cafes=cafes,
+        city_code=city_code,
+        open_now=open_now,
+        facets=facets,
+        total=sum(counts.values()),
         can_add=g.user and g.user.admin
     )
 
 
-@app.route('/cafes/<int:cafe_id>')
+@main.route('/cities/<code>')
+@cache_page
+@read_only
+def city_detail(code):
+    """Show a city's overview map and its first page of cafes."""
+
+    registry = City.get_registry()
+    if code not in registry:
+        abort(404)
+
+    per_page = current_app.config['CAFES_PER_PAGE']
+    snapshot = catalog.get()
+
+    if snapshot is not None:
+        count = snapshot.city_counts().get(code, 0)
+        cafes = snapshot.page(code, 0, per_page)
+    else:
+        count = Cafe.get_city_counts().get(code, 0)
+        cafes = (Cafe.query.filter_by(city_code=code)
+                 .order_by(Cafe.name, Cafe.id)
+                 .limit(per_page)
+                 .all())
+
+    return render_template(
+        'city/detail.html',
+        code=code,
+        city_state=registry.get_city_state(code),
+        cafes=cafes,
+        count=count,
+        maps=get_city_map_count(code)
+    )
+
+
+@main.route('/cafes/trending')
+@cache_page
+@read_only
+def trending_cafes():
+    """Show cafes with the most recent likes."""
+
+    return render_template(
+        'cafe/trending.html',
+        cafes=trending.get_trending(current_app.config['TRENDING_LIMIT'])
+    )
+
+
+@main.route('/cafes/<int:cafe_id>')
+@cache_page
+@read_only
 def cafe_detail(cafe_id):
     """Show detail for cafe."""
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = queries.get_cafe_or_404(cafe_id)
 
     if g.user:
         liked = g.user in cafe.liking_users
@@ -190,7 +440,39 @@ def cafe_detail(cafe_id):
     )
 
 
-@app.route('/cafes/add', methods=["GET", "POST"])
+def update_city_maps(*codes):
+    """Redraw the overview maps of these cities in the background; return
+    the redraws' futures.
+
+    Each changed map is a MapQuest call, too slow to keep the admin
+    waiting for. The cafe is already saved by now, so a failure is only
+    logged.
+    """
+
+    futures = []
+    for code in set(codes):
+        city = City.query.get(code)
+        futures.append(city_map_redraws.submit(
+            redraw_city_maps, current_app.logger, code,
+            city.get_map_addresses(), city.name, city.state))
+    return futures
+
+
+def redraw_city_maps(logger, code, *args):
+    try:
+        save_city_maps(code, *args)
+    except Exception:
+        logger.exception("Couldn't save map of %s", code)
+
+
+def rebuild_catalog():
+    """Replace the catalog snapshot, so every worker sees a cafe edit."""
+
+    if current_app.config['CATALOG_SNAPSHOT']:
+        catalog.rebuild()
+
+
+@main.route('/cafes/add', methods=["GET", "POST"])
 def add_cafe():
     """Handle add_cafe form.
     Only logged-in admin users can add/edit cafes."""
@@ -210,6 +492,7 @@ def add_cafe():
             url=form.url.data,
             address=form.address.data,
             city_code=form.city_code.data,
+            hours=form.hours.data or '',
             image_url=form.image_url.data or None,
         )
 
@@ -222,6 +505,8 @@ def add_cafe():
         cafe.save_map()
 
         db.session.commit()
+        rebuild_catalog()
+        update_city_maps(cafe.city_code)
 
         flash(f"{cafe.name} added!", "success")
         return redirect(f"/cafes/{cafe.id}")
@@ -230,7 +515,7 @@ def add_cafe():
         return render_template("cafe/add-form.html", form=form)
 
 
-@app.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@main.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
 def edit_cafe(cafe_id):
     """Handle edit cafe form.
     Only logged-in admin users can add/edit cafes."""
@@ -239,7 +524,7 @@ def edit_cafe(cafe_id):
         flash("Only admins can edit cafes.", "danger")
         return redirect("/login")
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = queries.get_cafe_or_404(cafe_id)
 
     # Do not display the static value of the default image
     # This will throw an error with the URL validator in wtforms
@@ -254,12 +539,14 @@ def edit_cafe(cafe_id):
                 cafe.address != form.address.data or
                 cafe.city_code != form.city_code.data
         )
+        old_city_code = cafe.city_code
 
         cafe.name = form.name.data
         cafe.description = form.description.data
         cafe.url = form.url.data
         cafe.address = form.address.data
         cafe.city_code = form.city_code.data
+        cafe.hours = form.hours.data or ''
         cafe.image_url = form.image_url.data or None
 
         if need_new_map:
@@ -270,6 +557,10 @@ def edit_cafe(cafe_id):
             cafe.image_url = Cafe._default_img
 
         db.session.commit()
+        rebuild_catalog()
+        if need_new_map:
+            update_city_maps(old_city_code, cafe.city_code)
+
         flash(f"{cafe.name} edited", "success")
         return redirect(f"/cafes/{cafe.id}")
 
@@ -277,10 +568,146 @@ def edit_cafe(cafe_id):
         return render_template("cafe/edit-form.html", form=form, cafe=cafe)
 
 
+#######################################
+# admin dashboard
+
+@main.route('/admin/stats')
+@read_only
+def city_stats():
+    """Show admins per-city numbers, as of their last refresh."""
+
+    if not g.user or not g.user.admin:
+        flash("Only admins can see statistics.", "danger")
+        return redirect("/login")
+
+    rows = stats.get_city_stats()
+
+    refreshed_at = min((row.refreshed_at for row in rows), default=None)
+    age = refreshed_at and datetime.utcnow() - refreshed_at
+    stale = age is None or (
+        age.total_seconds() > current_app.config['CITY_STATS_MAX_AGE'])
+
+    return render_template(
+        'admin/stats.html',
+        rows=rows,
+        refreshed_at=refreshed_at,
+        age_minutes=age and int(age.total_seconds() // 60),
+        stale=stale
+    )
+
+
+#######################################
+# API for cafes
+
+
+@main.route("/api/cafes")
+@read_only
+def cafes_api():
+    """Return cafes by id, a page at a time.
+
+    ?fields= picks fields (default all), ?city= filters by city code,
+    ?open_at= to cafes open at an ISO datetime (or "now"; without a UTC
+    offset it's local time in each cafe's city), and ?after= continues
+    from the previous page's "next" cursor.
+    """
+
+    config = current_app.config
+    limit = request.args.get('limit', config['API_CAFES_PER_PAGE'], type=int)
+    limit = max(1, min(limit, config['API_CAFES_MAX_PER_PAGE']))
+    after = request.args.get('after', type=int)
+    city_code = request.args.get('city')
+    at = request.args.get('open_at')
+
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        if at and at != 'now':
+            at = datetime.fromisoformat(at)
+    except FieldError as e:
+        return api_response({"error": str(e)}, 400)
+    except ValueError:
+        return api_response({"error": f"Bad open_at: {at}"}, 400)
+
+    # the snapshot is in id order for all cities; filters need the db
+    snapshot = None if city_code or at else catalog.get()
+
+    if snapshot is not None:
+        rows = snapshot_values(fields, snapshot.after(after, limit + 1))
+
+    else:
+        query = select_cafes(fields)
+        if city_code:
+            query = query.filter(Cafe.city_code == city_code)
+        if at:
+            query = query.filter(Cafe.open_at(None if at == 'now' else at))
+        if after is not None:
+            query = query.filter(Cafe.id > after)
+        rows = query.order_by(Cafe.id).limit(limit + 1).all()
+
+    # keyset paging: one extra row says whether there's a next page
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    return api_response({
+        "cafes": to_dicts(fields, rows),
+        "next": rows[-1][0] if more else None,
+    })
+
+
+@main.route("/api/cafes/<int:cafe_id>")
+@read_only
+def cafe_api(cafe_id):
+    """Return one cafe, with the fields picked by ?fields=."""
+
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except FieldError as e:
+        return api_response({"error": str(e)}, 400)
+
+    snapshot = catalog.get()
+    if snapshot is not None:
+        found = snapshot.get(cafe_id)
+        row = found and snapshot_values(fields, [found])[0]
+    else:
+        row = select_cafes(fields).filter(Cafe.id == cafe_id).first()
+
+    if row is None:
+        return api_response({"error": "Not found"}, 404)
+
+    return api_response({"cafe": dict(zip(fields, row))})
+
+
+@main.route("/api/cafes/trending")
+@read_only
+def trending_cafes_api():
+    """Return top cafes by trending score (up to ?limit=)."""
+
+    limit = max(1, min(request.args.get('limit', 10, type=int),
+                       current_app.config['TRENDING_LIMIT']))
+    registry = City.get_registry()
+
+    return jsonify({"cafes": [{
+        "id": cafe.id,
+        "name": cafe.name,
+        "city": registry.get_city_state(cafe.city_code),
+        "score": round(score, 3),
+    } for cafe, score in trending.get_trending(limit)]})
+
+
+@main.route("/api/cafes/autocomplete")
+def autocomplete_cafes():
+    """Return cafes and cities with a word starting with ?q=."""
+
+    q = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 20))
+
+    return jsonify({"results": cafe_search.search(q, limit)})
+
+
 #######################################
 # display and edit user profiles
 
-@app.route('/profile')
+@main.route('/profile')
+@read_only
 def display_profile():
     """Displays profile if user is logged in"""
 
@@ -288,10 +715,26 @@ def display_profile():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    return render_template("profile/detail.html", user=g.user)
+    try:
+        entries, next_page = feed.get_feed(
+            g.user.id, before=request.args.get('before'),
+            limit=current_app.config['FEED_PER_PAGE'])
+    except ValueError:
+        abort(400)
+
+    # any number of rows; read them as the page renders
+    liked_cafes = (Cafe.query
+                   .join(Like, Like.cafe_id == Cafe.id)
+                   .filter(Like.user_id == g.user.id)
+                   .order_by(Like.created_at.desc(), Cafe.id)
+                   .yield_per(100))
 
+    return stream_template("profile/detail.html", user=g.user,
+                           liked_cafes=liked_cafes, feed=entries,
+                           next_page=next_page)
 
-@app.route('/profile/edit', methods=["GET", "POST"])
+
+@main.route('/profile/edit', methods=["GET", "POST"])
 def edit_user():
     """Edit profile for user."""
 
@@ -327,7 +770,8 @@ def edit_user():
 # API for likes
 
 
-@app.route("/api/likes")
+@main.route("/api/likes")
+@read_only
 def likes_cafe():
     """Does user like a cafe?"""
 
@@ -335,15 +779,14 @@ def likes_cafe():
         return jsonify({"error": "Not logged in"})
 
     cafe_id = int(request.args['cafe_id'])
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = queries.get_cafe_or_404(cafe_id)
 
-    like = Like.query.filter_by(user_id=g.user.id, cafe_id=cafe.id).first()
-    likes = like is not None
+    likes = queries.user_likes_cafe(g.user.id, cafe.id)
 
     return jsonify({"likes": likes})
 
 
-@app.route("/api/like", methods=["POST"])
+@main.route("/api/like", methods=["POST"])
 def like_cafe():
     """Like a cafe"""
 
@@ -351,16 +794,28 @@ def like_cafe():
         return jsonify({"error": "Not logged in"})
 
     cafe_id = int(request.json['cafe_id'])
-    cafe = Cafe.query.get_or_404(cafe_id)
-
-    g.user.liked_cafes.append(cafe)
+    cafe = queries.get_cafe_or_404(cafe_id)
+
+    # likes made offline are sent later, maybe after one made elsewhere;
+    # a second request racing this one inserts nothing
+    inserted = db.session.execute(
+        insert(Like.__table__)
+        .values(user_id=g.user.id, cafe_id=cafe.id)
+        .on_conflict_do_nothing()
+        .returning(Like.cafe_id)
+    ).fetchall()
+
+    if inserted:
+        trending.add_like(cafe.id)
+        feed.add_like(g.user.id, cafe.id)
+        record_change(db.session, 'likes', (g.user.id, cafe.id))
     db.session.commit()
 
     response = {"liked": cafe.id}
     return jsonify(response)
 
 
-@app.route("/api/unlike", methods=["POST"])
+@main.route("/api/unlike", methods=["POST"])
 def unlike_cafe():
     """Unlike a cafe"""
 
@@ -368,14 +823,99 @@ def unlike_cafe():
         return jsonify({"error": "Not logged in"})
 
     cafe_id = int(request.json['cafe_id'])
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = queries.get_cafe_or_404(cafe_id)
+
+    # the like's age tells us how much it counts toward trending
+    deleted = db.session.execute(
+        Like.__table__.delete()
+        .where(Like.cafe_id == cafe_id)
+        .where(Like.user_id == g.user.id)
+        .returning(Like.created_at)
+    ).fetchall()
+
+    for (created_at,) in deleted:
+        trending.remove_like(cafe_id, created_at)
+        feed.remove_like(g.user.id, cafe_id, created_at)
+        record_change(db.session, 'likes', (g.user.id, cafe_id))
 
-    Like.query.filter_by(cafe_id=cafe_id, user_id=g.user.id).delete()
     db.session.commit()
 
     response = {"unliked": cafe.id}
     return jsonify(response)
 
 
+#######################################
+# API for follows and the activity feed
+
+
+@main.route("/api/follow", methods=["POST"])
+def follow_user():
+    """Follow a user"""
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"})
+
+    user_id = int(request.json['user_id'])
+    user = queries.get_user_or_404(user_id)
+    if user.id == g.user.id:
+        return jsonify({"error": "You can't follow yourself"}), 400
+
+    feed.follow(g.user.id, user.id)
+    db.session.commit()
+
+    return jsonify({"following": user.id})
+
+
+@main.route("/api/unfollow", methods=["POST"])
+def unfollow_user():
+    """Stop following a user"""
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"})
+
+    user_id = int(request.json['user_id'])
+    user = queries.get_user_or_404(user_id)
+
+    feed.unfollow(g.user.id, user.id)
+    db.session.commit()
+
+    return jsonify({"unfollowed": user.id})
+
+
+@main.route("/api/feed")
+@read_only
+def feed_api():
+    """Page of the user's feed, newest first.
+
+    Pass the previous page's "next" as ?before= for the page after it;
+    "next" is null on the last page.
+    """
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"})
+
+    config = current_app.config
+    limit = request.args.get('limit', config['FEED_PER_PAGE'], type=int)
+    limit = max(1, min(limit, config['FEED_MAX_PER_PAGE']))
+
+    try:
+        entries, next_page = feed.get_feed(
+            g.user.id, before=request.args.get('before'), limit=limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({
+        "items": [{
+            "user_id": entry.user_id,
+            "username": entry.username,
+            "cafe_id": entry.cafe_id,
+            "cafe_name": entry.cafe_name,
+            "liked_at": entry.liked_at.isoformat(),
+        } for entry in entries],
+        "next": next_page,
+    })
+
+
 if __name__ == '__main__':
-    app.run(debug=True, use_debugger=False, use_reloader=False, passthrough_errors=True)
+    create_app().run(debug=True, use_debugger=False, use_reloader=False,
+                     passthrough_errors=True)
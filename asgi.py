@@ -0,0 +1,270 @@
+"""ASGI app serving the like API for Flask Cafe.
+
+The like endpoints are tiny, I/O-bound calls, so this serves them from an
+event loop with an asyncpg connection pool instead of tying up a sync
+worker per request. It reads the Flask session cookie, so the two apps
+share logins and run side by side (with replicas, it also sets the
+cookie's read-your-writes pin after a like, as routing.py does); route /api/like, /api/unlike and
+/api/likes here and everything else to gunicorn. Run with:
+
+    uvicorn asgi:app --workers 2
+"""
+
+import asyncio
+import json
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+import asyncpg
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.http import dump_cookie
+
+from app import CURR_USER_KEY
+from config import DATABASE_URL, DATABASE_REPLICA_URLS
+from config import ASYNC_DB_POOL_MIN, ASYNC_DB_POOL_MAX, PGBOUNCER
+from routing import PRIMARY_UNTIL_KEY, READ_YOUR_WRITES_SECONDS
+from secrets import FLASK_SECRET_KEY
+from trending import NOW_SQL, weight_sql
+import feed
+
+# create_app leaves the session settings at Flask's defaults
+SESSION_COOKIE_NAME = Flask.default_config['SESSION_COOKIE_NAME']
+SESSION_LIFETIME = Flask.default_config['PERMANENT_SESSION_LIFETIME']
+
+
+def session_serializer(secret_key):
+    """Return the signer Flask's session cookies use, so cookies are
+    interchangeable."""
+
+    interface = SecureCookieSessionInterface()
+    return URLSafeTimedSerializer(
+        secret_key, salt=interface.salt, serializer=interface.serializer,
+        signer_kwargs={'key_derivation': interface.key_derivation,
+                       'digest_method': interface.digest_method})
+
+
+class LikeAPI:
+    """ASGI application for /api/likes, /api/like and /api/unlike."""
+
+    def __init__(self, dsn, min_size=ASYNC_DB_POOL_MIN,
+                 max_size=ASYNC_DB_POOL_MAX, pgbouncer=PGBOUNCER,
+                 secret_key=FLASK_SECRET_KEY,
+                 replicas=bool(DATABASE_REPLICA_URLS),
+                 read_your_writes=READ_YOUR_WRITES_SECONDS):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        # PgBouncer (transaction mode) hands each transaction a different
+        # server connection, where our named prepared statements don't exist
+        self.statement_cache_size = 0 if pgbouncer else 100
+        self.pool = None
+        self._pool_lock = None
+
+        self.routes = {
+            ('GET', '/api/likes'): self.likes_cafe,
+            ('POST', '/api/like'): self.like_cafe,
+            ('POST', '/api/unlike'): self.unlike_cafe,
+        }
+
+        self.serializer = session_serializer(secret_key)
+        self.cookie_name = SESSION_COOKIE_NAME
+        self.max_age = int(SESSION_LIFETIME.total_seconds())
+
+        # after a like, the Flask app's read-only views read the primary
+        # for a while, so the user sees it even if the replicas lag
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            await self.respond(send, {"error": "Not found"}, status=404)
+            return
+
+        session = self.get_session(scope)
+        user_id = session.get(CURR_USER_KEY)
+        if user_id is None:
+            await self.respond(send, {"error": "Not logged in"})
+            return
+
+        try:
+            cafe_id = await self.get_cafe_id(scope, receive)
+        except (KeyError, ValueError, TypeError):
+            await self.respond(send, {"error": "Bad request"}, status=400)
+            return
+
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            status, body = await handler(conn, user_id, cafe_id)
+
+        headers = []
+        if (self.replicas and scope['method'] == 'POST'
+                and status == 200 and 'error' not in body):
+            headers.append(self.pin_to_primary(session))
+        await self.respond(send, body, status=status, headers=headers)
+
+    #######################################
+    # plumbing
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.get_pool()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.pool is not None:
+                    await self.pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def get_pool(self):
+        """Return the connection pool, creating it on first use."""
+
+        if self.pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self.pool is None:
+                    self.pool = await asyncpg.create_pool(
+                        self.dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        statement_cache_size=self.statement_cache_size)
+        return self.pool
+
+    def get_session(self, scope):
+        """Return the Flask session from its cookie ({} if none)."""
+
+        cookies = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookies.load(value.decode('latin-1'))
+
+        morsel = cookies.get(self.cookie_name)
+        if morsel is None:
+            return {}
+
+        try:
+            return self.serializer.loads(morsel.value, max_age=self.max_age)
+        except BadSignature:
+            return {}
+
+    def pin_to_primary(self, session):
+        """Return a Set-Cookie header for the session, with the user's
+        reads pinned to the primary (routing.PRIMARY_UNTIL_KEY)."""
+
+        session = dict(session)
+        session[PRIMARY_UNTIL_KEY] = time.time() + self.read_your_writes
+        # as Flask sets it: permanent sessions expire, others end with
+        # the browser
+        max_age = self.max_age if session.get('_permanent') else None
+        cookie = dump_cookie(self.cookie_name, self.serializer.dumps(session),
+                             max_age=max_age, path='/', httponly=True)
+        return (b'set-cookie', cookie.encode('latin-1'))
+
+    async def get_cafe_id(self, scope, receive):
+        """Return cafe_id from the query string (GET) or JSON body (POST)."""
+
+        if scope['method'] == 'GET':
+            query = parse_qs(scope['query_string'].decode('latin-1'))
+            return int(query['cafe_id'][0])
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        return int(json.loads(body)['cafe_id'])
+
+    async def respond(self, send, body, status=200, headers=()):
+        payload = json.dumps(body).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(payload)).encode()),
+                *headers,
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    #######################################
+    # API for likes
+
+    async def likes_cafe(self, conn, user_id, cafe_id):
+        """Does user like a cafe?"""
+
+        row = await conn.fetchrow(
+            """SELECT EXISTS (SELECT 1 FROM cafes WHERE id = $2) AS cafe,
+                      EXISTS (SELECT 1 FROM likes
+                              WHERE user_id = $1 AND cafe_id = $2) AS likes""",
+            user_id, cafe_id)
+
+        if not row['cafe']:
+            return 404, {"error": "Not found"}
+        return 200, {"likes": row['likes']}
+
+    async def like_cafe(self, conn, user_id, cafe_id):
+        """Like a cafe"""
+
+        weight = weight_sql(NOW_SQL)
+        fanout = feed.fanout_sql('$1', '$2', liked='liked')
+        trim = feed.trim_sql(feed.followers_sql('$1', feed.TRIM_CHANCE))
+        try:
+            async with conn.transaction():
+                await conn.execute(
+                    f"""WITH liked AS (
+                            INSERT INTO likes (user_id, cafe_id)
+                            VALUES ($1, $2)
+                            ON CONFLICT DO NOTHING
+                            RETURNING cafe_id),
+                         fanned AS ({fanout})
+                        UPDATE cafes
+                        SET trending_score = trending_score + {weight}
+                        WHERE id IN (SELECT cafe_id FROM liked)""",
+                    user_id, cafe_id)
+                await conn.execute(trim, user_id)
+        except asyncpg.ForeignKeyViolationError as e:
+            if 'user_id' in (e.constraint_name or ''):
+                return 200, {"error": "Not logged in"}
+            return 404, {"error": "Not found"}
+
+        return 200, {"liked": cafe_id}
+
+    async def unlike_cafe(self, conn, user_id, cafe_id):
+        """Unlike a cafe"""
+
+        weight = weight_sql('deleted.created_at')
+        unfanout = feed.unfanout_sql(
+            '$1', '$2', '(SELECT created_at FROM deleted)')
+        found = await conn.fetchval(
+            f"""WITH cafe AS (SELECT id FROM cafes WHERE id = $2),
+                     deleted AS (DELETE FROM likes
+                                 WHERE user_id = $1
+                                   AND cafe_id IN (SELECT id FROM cafe)
+                                 RETURNING cafe_id, created_at),
+                     scored AS (UPDATE cafes
+                                SET trending_score = greatest(
+                                    0, trending_score - {weight})
+                                FROM deleted
+                                WHERE cafes.id = deleted.cafe_id),
+                     unfanned AS ({unfanout})
+                SELECT count(*) FROM cafe""",
+            user_id, cafe_id)
+
+        if not found:
+            return 404, {"error": "Not found"}
+        return 200, {"unliked": cafe_id}
+
+
+app = LikeAPI(DATABASE_URL)
@@ -0,0 +1,62 @@
+"""Fingerprinted URLs for static files.
+
+static_url('js/liking.js') -> '/static/js/liking.js?v=3f2a9c01b7'
+
+The version is a hash of the file's contents, so a URL changes exactly
+when its file does, and browsers and CDNs can cache static files for
+good.
+"""
+
+import hashlib
+import os
+import threading
+
+from flask import current_app
+
+# libraries every page loads (base.html), pinned to exact versions, so
+# each URL's contents never change and may be cached for good
+LIBRARIES = (
+    'https://unpkg.com/bootswatch@4.4.1/dist/journal/bootstrap.css',
+    'https://unpkg.com/jquery@3.4.1/dist/jquery.js',
+    'https://unpkg.com/bootstrap@4.4.1/dist/js/bootstrap.js',
+    'https://unpkg.com/axios@0.19.2/dist/axios.js',
+)
+
+# path -> (mtime, size, hash); rehashed when the file changes
+_hashes = {}
+_lock = threading.Lock()
+
+
+def file_hash(path):
+    """Return a short content hash of the file at path (None if missing)."""
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _hashes.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+
+    version = digest.hexdigest()[:10]
+    with _lock:
+        _hashes[path] = (key, version)
+    return version
+
+
+def static_url(filename):
+    """Return the URL for a file in static/, versioned by its contents."""
+
+    filename = filename.lstrip('/')
+    version = file_hash(os.path.join(current_app.static_folder, filename))
+
+    if version is None:
+        return f"/static/{filename}"
+    return f"/static/{filename}?v={version}"
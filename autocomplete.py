@@ -0,0 +1,191 @@
+"""In-memory type-ahead search over cafe and city names."""
+
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from operator import itemgetter
+
+from models import db, tables_changed, Cafe, City
+
+NON_WORD_RE = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(text):
+    """Lowercase, strip accents and punctuation.
+
+    'Café du Soleil!' -> 'cafe du soleil'
+    """
+
+    text = unicodedata.normalize('NFKD', text)
+    text = text.encode('ascii', 'ignore').decode('ascii')
+    return NON_WORD_RE.sub(' ', text.lower()).strip()
+
+
+def word_suffixes(text):
+    """Return normalized text from each word on, so any word can match.
+
+    'blue bean cafe' -> ['blue bean cafe', 'bean cafe', 'cafe']
+    """
+
+    words = normalize(text).split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+class PrefixIndex:
+    """Sorted array of (key, ref) pairs, searched with bisect.
+
+    Keys and refs live in two parallel lists, which is far more compact
+    than a trie of dicts or a list of tuples.
+    """
+
+    def __init__(self, pairs=()):
+        # refs are cafe ids and city codes, which don't compare
+        pairs = sorted(pairs, key=itemgetter(0))
+        self.keys = [key for key, ref in pairs]
+        self.refs = [ref for key, ref in pairs]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, ref, text):
+        for key in word_suffixes(text):
+            i = bisect_left(self.keys, key)
+            self.keys.insert(i, key)
+            self.refs.insert(i, ref)
+
+    def remove(self, ref, text):
+        for key in word_suffixes(text):
+            i = bisect_left(self.keys, key)
+            while i < len(self.keys) and self.keys[i] == key:
+                if self.refs[i] == ref:
+                    del self.keys[i]
+                    del self.refs[i]
+                    break
+                i += 1
+
+    def search(self, prefix, limit):
+        """Return up to `limit` distinct refs with a key starting with prefix."""
+
+        found = []
+        seen = set()
+        i = bisect_left(self.keys, prefix)
+
+        while i < len(self.keys) and len(found) < limit:
+            if not self.keys[i].startswith(prefix):
+                break
+            ref = self.refs[i]
+            if ref not in seen:
+                seen.add(ref)
+                found.append(ref)
+            i += 1
+
+        return found
+
+
+class CafeSearch:
+    """Autocomplete over cafe names (refs are ids) and cities (codes).
+
+    Built from the database once; commits to cafes are applied
+    incrementally on the next lookup, by reloading just those rows.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.cafes = {}
+        self.stale_ids = set()
+        self.lock = threading.Lock()
+
+    def build(self):
+        """(Re)build the whole index from the database; return it."""
+
+        rows = db.session.query(Cafe.id, Cafe.name, Cafe.city_code).all()
+        registry = City.get_registry()
+
+        pairs = [(key, id) for id, name, city_code in rows
+                 for key in word_suffixes(name)]
+        pairs += [(key, code) for code, (name, state) in registry.cities.items()
+                  for key in word_suffixes(name)]
+
+        index = PrefixIndex(pairs)
+        with self.lock:
+            self.index = index
+            self.cafes = {id: (name, city_code) for id, name, city_code in rows}
+        return index
+
+    def refresh(self):
+        """Build the index if needed, and reload cafes changed since.
+
+        Returns the index.
+        """
+
+        index = self.index
+        if index is None:
+            return self.build()
+
+        with self.lock:
+            ids, self.stale_ids = self.stale_ids, set()
+        if not ids:
+            return index
+
+        rows = (db.session.query(Cafe.id, Cafe.name, Cafe.city_code)
+                .filter(Cafe.id.in_(ids))
+                .all())
+
+        with self.lock:
+            for id in ids:
+                old = self.cafes.pop(id, None)
+                if old:
+                    index.remove(id, old[0])
+            for id, name, city_code in rows:
+                index.add(id, name)
+                self.cafes[id] = (name, city_code)
+
+        return index
+
+    def search(self, q, limit=10):
+        """Return result dicts for cafes and cities matching prefix q."""
+
+        prefix = normalize(q)
+        if not prefix:
+            return []
+
+        index = self.refresh()
+
+        registry = City.get_registry()
+        results = []
+
+        with self.lock:
+            refs = index.search(prefix, limit)
+            for ref in refs:
+                if isinstance(ref, str):
+                    if ref in registry:
+                        results.append({
+                            "type": "city",
+                            "code": ref,
+                            "name": registry.get_city_state(ref),
+                            "url": f"/cafes?city={ref}",
+                        })
+                elif ref in self.cafes:
+                    name, city_code = self.cafes[ref]
+                    results.append({
+                        "type": "cafe",
+                        "id": ref,
+                        "name": name,
+                        "city": registry.get_city_state(city_code),
+                        "url": f"/cafes/{ref}",
+                    })
+
+        return results
+
+
+cafe_search = CafeSearch()
+
+
+@tables_changed.connect
+def _mark_changed_cafes(sender, changes, **kwargs):
+    if 'cities' in changes or None in changes.get('cafes', ()):
+        cafe_search.index = None
+    elif 'cafes' in changes:
+        with cafe_search.lock:
+            cafe_search.stale_ids.update(changes['cafes'])
@@ -0,0 +1 @@
+"""Data generation and load-testing tools for Flask Cafe."""
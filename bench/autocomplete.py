@@ -0,0 +1,64 @@
+"""Benchmark the autocomplete prefix index.
+
+Builds a PrefixIndex over synthetic cafe names (no database needed) and
+reports build time, memory, and lookup latency for 1-5 letter prefixes.
+
+    python -m bench.autocomplete --names 100000
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from autocomplete import PrefixIndex, normalize, word_suffixes
+from bench.generate import ADJECTIVES, NOUNS, KINDS
+from bench.loadtest import percentile
+
+
+def make_names(rng, n):
+    return [f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} '
+            f'{rng.choice(KINDS)} {i}' for i in range(1, n + 1)]
+
+
+def run(n_names, n_lookups, seed):
+    rng = random.Random(seed)
+    names = make_names(rng, n_names)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = PrefixIndex(
+        (key, id) for id, name in enumerate(names, start=1)
+        for key in word_suffixes(name))
+    build_secs = time.perf_counter() - start
+    memory, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    prefixes = []
+    for _ in range(n_lookups):
+        word = normalize(rng.choice(names)).split()[rng.randint(0, 2)]
+        prefixes.append(word[:rng.randint(1, 5)])
+
+    timings = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        index.search(prefix, 10)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    print(f"names:   {n_names} ({len(index)} keys)")
+    print(f"build:   {build_secs * 1000:.0f}ms")
+    print(f"memory:  {memory / 2**20:.1f}MiB (peak during build "
+          f"{peak / 2**20:.1f}MiB)")
+    print(f"lookup:  p50 {percentile(timings, 50) * 1e6:.1f}us, "
+          f"p99 {percentile(timings, 99) * 1e6:.1f}us, "
+          f"max {timings[-1] * 1e6:.1f}us")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--names', type=int, default=100_000)
+    parser.add_argument('--lookups', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    run(args.names, args.lookups, args.seed)
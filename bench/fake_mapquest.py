@@ -0,0 +1,70 @@
+"""Local stand-in for the MapQuest static map API.
+
+Serves the same small JPEG for every map request, after an optional
+delay, so benchmarks and imports don't depend on (or get billed by)
+MapQuest. Point the app at it with:
+
+    MAPQUEST_BASE_URL=http://127.0.0.1:8089 flask run
+
+Run with:
+
+    python -m bench.fake_mapquest --port 8089 --delay-ms 50
+"""
+
+import argparse
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+IMAGE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'static', 'images', 'default-cafe.jpg')
+
+
+def make_handler(image, delay):
+    """Return a request handler class serving `image` after `delay` secs."""
+
+    class MapHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not self.path.startswith('/staticmap/'):
+                self.send_error(404)
+                return
+
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MapHandler
+
+
+def serve(port=8089, delay_ms=0, background=False):
+    """Start the fake MapQuest server; return it if run in background."""
+
+    with open(IMAGE_PATH, 'rb') as f:
+        image = f.read()
+
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', port), make_handler(image, delay_ms / 1000))
+
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    print(f"Fake MapQuest on http://127.0.0.1:{port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--delay-ms', type=int, default=0,
+                        help="simulated MapQuest latency")
+    args = parser.parse_args()
+    serve(args.port, args.delay_ms)
@@ -0,0 +1,115 @@
+"""Benchmark the activity feed's fan-out trade-off.
+
+For accounts with more and more followers, likes a batch of cafes as
+that account with fan-out on write (one feed row per follower per like)
+and with fan-out on read (feeds merge the likes in when read), and
+reports the cost of each like and of reading a follower's first feed
+page. Runs against the app's database, which needs at least as many
+users as the largest follower count (see bench.generate); everything
+it writes is rolled back.
+
+    python -m bench.feed --followers 10 100 1000 10000 --likes 50
+"""
+
+import argparse
+import time
+
+from sqlalchemy import text
+
+import feed
+from app import create_app
+from bench.loadtest import percentile
+from models import db
+
+MODES = [
+    # (name, follower_count to record, so feed.py picks the mode)
+    ('write', 0),
+    ('read', feed.FANOUT_MAX_FOLLOWERS + 1),
+]
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def measure(followers, follower_count, cafe_ids, reads):
+    """Like each cafe as a new account with `followers` followers; return
+    ([seconds per like], feed rows written per like, [seconds per read])."""
+
+    session = db.session
+    star = session.execute(text(
+        "INSERT INTO users (username, admin, email, first_name, last_name,"
+        " description, image_url, hashed_password, follower_count)"
+        " VALUES ('bench-feed-star', false, '', 'Bench', 'Star', '', '', '',"
+        " :count)"
+        " RETURNING id"), {"count": follower_count}).scalar()
+    session.execute(text(
+        "INSERT INTO follows (follower_id, followed_id)"
+        " SELECT id, :star FROM users WHERE id <> :star"
+        " ORDER BY id LIMIT :followers"),
+        {"star": star, "followers": followers})
+    reader = session.execute(text(
+        "SELECT min(follower_id) FROM follows WHERE followed_id = :star"),
+        {"star": star}).scalar()
+
+    likes = []
+    for cafe_id in cafe_ids:
+        session.execute(text(
+            "INSERT INTO likes (user_id, cafe_id) VALUES (:star, :cafe)"),
+            {"star": star, "cafe": cafe_id})
+        likes.append(timed(feed.add_like, star, cafe_id))
+
+    written = session.execute(text(
+        "SELECT count(*) FROM feed_items WHERE actor_id = :star"),
+        {"star": star}).scalar()
+
+    page = []
+    for _ in range(reads):
+        page.append(timed(feed.get_feed, reader, limit=20))
+
+    return likes, written / len(cafe_ids), page
+
+
+def ms(timings, p):
+    return f"{percentile(sorted(timings), p) * 1000:8.2f}"
+
+
+def run(follower_counts, n_likes, reads):
+    cafe_ids = [id for (id,) in db.session.execute(text(
+        "SELECT id FROM cafes ORDER BY id LIMIT :n"), {"n": n_likes})]
+    users = db.session.execute(text("SELECT count(*) FROM users")).scalar()
+    if len(cafe_ids) < n_likes or users <= max(follower_counts):
+        raise SystemExit(f"Need {n_likes} cafes and more than "
+                         f"{max(follower_counts)} users; generate more data")
+
+    print(f"{'followers':>9} {'mode':>5} {'like p50':>8} {'like p99':>8} "
+          f"{'rows/like':>9} {'read p50':>8} {'read p99':>8}   (ms)")
+
+    for followers in follower_counts:
+        for mode, follower_count in MODES:
+            db.session.begin_nested()
+            try:
+                likes, rows, page = measure(
+                    followers, follower_count, cafe_ids, reads)
+            finally:
+                db.session.rollback()
+            print(f"{followers:9d} {mode:>5} {ms(likes, 50)} {ms(likes, 99)} "
+                  f"{rows:9.0f} {ms(page, 50)} {ms(page, 99)}")
+
+    db.session.rollback()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--followers', type=int, nargs='+',
+                        default=[10, 100, 1000, 10_000])
+    parser.add_argument('--likes', type=int, default=50)
+    parser.add_argument('--reads', type=int, default=100)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_ECHO': False})
+
+    with app.app_context():
+        run(args.followers, args.likes, args.reads)
@@ -0,0 +1,206 @@
+"""Fill the Flask Cafe database with synthetic data.
+
+Drops and recreates all tables, then bulk-loads cities, cafes, users and
+likes with COPY. Every user has the password "secret"; user 1 is an
+admin. Cafe popularity is skewed (Zipf-like) so likes cluster the way
+real ones do. The same --seed always produces the same data.
+
+    python -m bench.generate --cafes 100000 --users 1000000 --likes 10000000
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+
+from app import create_app
+from hours import parse_hours
+from importer import batched
+from models import db, bcrypt, Cafe, User
+from schema import stamp
+from trending import REBUILD_SQL
+
+COPY_ROWS = 50_000
+
+TIMEZONES = {
+    'CA': 'America/Los_Angeles', 'WA': 'America/Los_Angeles',
+    'OR': 'America/Los_Angeles', 'CO': 'America/Denver',
+    'TX': 'America/Chicago', 'IL': 'America/Chicago',
+    'NY': 'America/New_York', 'MA': 'America/New_York',
+    'FL': 'America/New_York', 'GA': 'America/New_York',
+}
+STATES = sorted(TIMEZONES)
+ADJECTIVES = ['Blue', 'Golden', 'Little', 'Sleepy', 'Urban', 'Corner',
+              'Velvet', 'Copper', 'Happy', 'Midnight', 'Rustic', 'Daily']
+NOUNS = ['Bean', 'Cup', 'Roast', 'Grind', 'Leaf', 'Mug', 'Drip',
+         'Kettle', 'Press', 'Crema', 'Bloom', 'Brew']
+KINDS = ['Cafe', 'Coffee', 'Roasters', 'Espresso Bar', 'Tea House']
+HOURS = ['', 'Daily 7:00-17:00', 'Mon-Fri 6:30-18:00; Sat-Sun 8:00-16:00',
+         'Mon closed; Tue-Sun 9:00-21:00', 'Mon-Sat 7:00-22:00; Sun 9-15',
+         'Fri-Sat 18:00-2:00']
+LIKE_DAYS = 90
+
+STREETS = ['Main St', 'Market St', 'Grand Ave', 'Oak St', 'Broadway',
+           'Mission St', '1st Ave', 'Park Blvd', 'Shattuck Ave']
+
+
+def copy_rows(cursor, table, columns, rows, not_null=()):
+    """COPY an iterable of tuples into table; return the row count.
+
+    Empty strings load as NULL, except in the `not_null` columns.
+    """
+
+    options = "FORMAT csv"
+    if not_null:
+        options += f", FORCE_NOT_NULL ({', '.join(not_null)})"
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH ({options})"
+    count = 0
+
+    for chunk in batched(rows, COPY_ROWS):
+        buf = io.StringIO()
+        csv.writer(buf).writerows(chunk)
+        buf.seek(0)
+        cursor.copy_expert(sql, buf)
+        count += len(chunk)
+
+    return count
+
+
+def gen_cities(rng, n):
+    for i in range(1, n + 1):
+        state = rng.choice(STATES)
+        yield (f'c{i}', f'City {i}', state, TIMEZONES[state])
+
+
+def gen_cafes(rng, n, n_cities):
+    bitmaps = {hours: '\\x' + parse_hours(hours).hex() if hours else None
+               for hours in HOURS}
+
+    for i in range(1, n + 1):
+        name = (f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} '
+                f'{rng.choice(KINDS)} {i}')
+        hours = rng.choice(HOURS)
+        yield (
+            i,
+            name,
+            f'A synthetic cafe, number {i}.',
+            f'https://example.com/cafes/{i}',
+            f'{rng.randint(1, 9999)} {rng.choice(STREETS)}',
+            f'c{rng.randint(1, n_cities)}',
+            Cafe._default_img,
+            hours,
+            bitmaps[hours],
+        )
+
+
+def gen_users(n, hashed_password):
+    for i in range(1, n + 1):
+        yield (
+            i,
+            f'user{i}',
+            i == 1,
+            f'user{i}@example.com',
+            'Test',
+            f'User{i}',
+            'A synthetic user.',
+            User._default_img,
+            hashed_password,
+        )
+
+
+def gen_likes(rng, n_likes, n_users, n_cafes):
+    """Yield distinct (user_id, cafe_id, created_at) rows, popular cafes
+    favored, made over the last LIKE_DAYS days."""
+
+    now = datetime.utcnow()
+    span = LIKE_DAYS * 24 * 60 * 60
+
+    ranked = list(range(1, n_cafes + 1))
+    rng.shuffle(ranked)
+    cum_weights = list(itertools.accumulate(
+        1 / (rank ** 0.8) for rank in range(1, n_cafes + 1)))
+
+    per_user, extra = divmod(n_likes, n_users)
+
+    for user_id in range(1, n_users + 1):
+        k = min(per_user + (user_id <= extra), n_cafes)
+        liked = set()
+        while len(liked) < k:
+            picks = rng.choices(ranked, cum_weights=cum_weights, k=k - len(liked))
+            liked.update(picks)
+        for cafe_id in liked:
+            created_at = now - timedelta(seconds=rng.randrange(span))
+            yield (user_id, cafe_id, created_at.isoformat())
+
+
+def timed(label, fn, *args):
+    """Run fn, printing how many rows/s it loaded."""
+
+    start = time.perf_counter()
+    count = fn(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {count} rows in {elapsed:.1f}s "
+          f"({count / elapsed:.0f} rows/s)")
+
+
+def generate(cities, cafes, users, likes, seed):
+    """Recreate all tables and bulk-load synthetic data."""
+
+    rng = random.Random(seed)
+
+    # one hash for everyone; bcrypt for 1M users would take hours
+    hashed = bcrypt.generate_password_hash("secret").decode("utf8")
+
+    db.drop_all()
+    db.create_all()
+    stamp()
+
+    conn = db.engine.raw_connection()
+    try:
+        cur = conn.cursor()
+
+        timed("cities", copy_rows, cur, 'cities',
+              ('code', 'name', 'state', 'timezone'),
+              gen_cities(rng, cities))
+        timed("cafes", copy_rows, cur, 'cafes',
+              ('id', 'name', 'description', 'url', 'address', 'city_code',
+               'image_url', 'hours', 'hours_bitmap'),
+              gen_cafes(rng, cafes, cities), ('hours',))
+        timed("users", copy_rows, cur, 'users',
+              ('id', 'username', 'admin', 'email', 'first_name', 'last_name',
+               'description', 'image_url', 'hashed_password'),
+              gen_users(users, hashed))
+        timed("likes", copy_rows, cur, 'likes',
+              ('user_id', 'cafe_id', 'created_at'),
+              gen_likes(rng, likes, users, cafes))
+
+        cur.execute(REBUILD_SQL.text)
+
+        for table in ('cafes', 'users'):
+            cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'),"
+                        f" (SELECT coalesce(max(id), 1) FROM {table}))")
+        conn.commit()
+
+        # fresh planner statistics, so benchmarks see realistic plans
+        conn.set_isolation_level(0)
+        cur.execute("ANALYZE")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cities', type=int, default=50)
+    parser.add_argument('--cafes', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--likes', type=int, default=10_000_000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_ECHO': False})
+
+    with app.app_context():
+        generate(args.cities, args.cafes, args.users, args.likes, args.seed)
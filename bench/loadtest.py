@@ -0,0 +1,241 @@
+"""HTTP load test for a running Flask Cafe server.
+
+Drives a weighted mix of routes from concurrent virtual users and
+reports latency percentiles and throughput per route. Results can be
+saved as a named baseline and later runs compared against it. Runs are
+reproducible: each virtual user has its own seeded RNG.
+
+Expects data from bench.generate (users "user<n>" / "secret"). Run the
+app against the MapQuest stand-in so nothing leaves the machine:
+
+    python -m bench.fake_mapquest --port 8089 &
+    MAPQUEST_BASE_URL=http://127.0.0.1:8089 WEB_CONCURRENCY=4 \
+        gunicorn -c gunicorn.conf.py wsgi:app &
+    python -m bench.loadtest --users 1000000 --cafes 100000 --save before
+    ...
+    python -m bench.loadtest --users 1000000 --cafes 100000 --compare before
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'baselines')
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+# route name -> weight; roughly what browsing traffic looks like
+MIXES = {
+    'browse': {
+        'cafe_list': 25,
+        'cafe_detail': 45,
+        'homepage': 5,
+        'login': 2,
+        'api_likes': 15,
+        'api_like_toggle': 8,
+    },
+    'api': {
+        'api_likes': 60,
+        'api_like_toggle': 40,
+    },
+    # the mobile client: cafe pages and cafes as MessagePack
+    'mobile': {
+        'api_cafes': 40,
+        'api_cafe': 60,
+    },
+}
+
+MSGPACK = {"Accept": "application/msgpack"}
+
+
+def percentile(sorted_values, pct):
+    """Return the pct-th percentile (nearest-rank) of sorted values."""
+
+    if not sorted_values:
+        return 0.0
+    rank = max(0, int(round(pct / 100 * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+class VirtualUser:
+    """One simulated visitor with its own HTTP session and RNG."""
+
+    def __init__(self, base_url, rng, n_users, n_cafes):
+        self.base_url = base_url
+        self.rng = rng
+        self.n_users = n_users
+        self.n_cafes = n_cafes
+        self.http = requests.Session()
+        self.liked = set()
+
+    def login(self):
+        resp = self.http.get(f"{self.base_url}/login")
+        token = CSRF_RE.search(resp.text)
+        username = f"user{self.rng.randint(1, self.n_users)}"
+        return self.http.post(f"{self.base_url}/login", data={
+            "csrf_token": token.group(1) if token else "",
+            "username": username,
+            "password": "secret",
+        }, allow_redirects=False)
+
+    def homepage(self):
+        return self.http.get(f"{self.base_url}/")
+
+    def cafe_list(self):
+        return self.http.get(f"{self.base_url}/cafes")
+
+    def cafe_detail(self):
+        cafe_id = self.rng.randint(1, self.n_cafes)
+        return self.http.get(f"{self.base_url}/cafes/{cafe_id}")
+
+    def api_cafes(self):
+        after = self.rng.randint(0, self.n_cafes)
+        return self.http.get(f"{self.base_url}/api/cafes",
+                             params={"after": after, "fields": "name,city"},
+                             headers=MSGPACK)
+
+    def api_cafe(self):
+        cafe_id = self.rng.randint(1, self.n_cafes)
+        return self.http.get(f"{self.base_url}/api/cafes/{cafe_id}",
+                             headers=MSGPACK)
+
+    def api_likes(self):
+        cafe_id = self.rng.randint(1, self.n_cafes)
+        return self.http.get(f"{self.base_url}/api/likes",
+                             params={"cafe_id": cafe_id})
+
+    def api_like_toggle(self):
+        cafe_id = self.rng.randint(1, self.n_cafes)
+        if cafe_id in self.liked:
+            self.liked.discard(cafe_id)
+            return self.http.post(f"{self.base_url}/api/unlike",
+                                  json={"cafe_id": cafe_id})
+        self.liked.add(cafe_id)
+        return self.http.post(f"{self.base_url}/api/like",
+                              json={"cafe_id": cafe_id})
+
+
+def run_user(user, mix, deadline, results, lock):
+    """Issue requests from `mix` until deadline; record latencies."""
+
+    routes = list(mix)
+    weights = [mix[r] for r in routes]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+
+    # like API calls need a logged-in session
+    if any(r.startswith('api_') for r in routes):
+        user.login()
+
+    while time.perf_counter() < deadline:
+        route = user.rng.choices(routes, weights)[0]
+        start = time.perf_counter()
+        try:
+            resp = getattr(user, route)()
+            ok = resp.status_code < 400
+        except requests.RequestException:
+            ok = False
+        latencies[route].append(time.perf_counter() - start)
+        if not ok:
+            errors[route] += 1
+
+    with lock:
+        for route, values in latencies.items():
+            results['latencies'][route].extend(values)
+        for route, count in errors.items():
+            results['errors'][route] += count
+
+
+def summarize(results, duration):
+    """Return {route: stats} with latencies in milliseconds."""
+
+    summary = {}
+    for route, values in sorted(results['latencies'].items()):
+        values.sort()
+        summary[route] = {
+            'requests': len(values),
+            'errors': results['errors'][route],
+            'rps': round(len(values) / duration, 1),
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+        }
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print(f"{'route':<18}{'reqs':>8}{'errs':>6}{'rps':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, s in summary.items():
+        print(f"{route:<18}{s['requests']:>8}{s['errors']:>6}{s['rps']:>9}"
+              f"{s['p50_ms']:>9}{s['p95_ms']:>9}{s['p99_ms']:>9}")
+        old = (baseline or {}).get(route)
+        if old:
+            deltas = [
+                f"{key} {(s[key] - old[key]) / old[key] * 100:+.0f}%"
+                for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms') if old[key]
+            ]
+            print(f"{'  vs baseline':<18}" + ", ".join(deltas))
+
+
+def run(base_url, mix, duration, concurrency, n_users, n_cafes, seed):
+    """Run the load test; return the per-route summary."""
+
+    results = {'latencies': defaultdict(list), 'errors': defaultdict(int)}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    threads = []
+    for i in range(concurrency):
+        user = VirtualUser(base_url, random.Random(seed + i), n_users, n_cafes)
+        thread = threading.Thread(
+            target=run_user, args=(user, mix, deadline, results, lock))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return summarize(results, duration)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='browse')
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds to run")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=1_000_000,
+                        help="number of generated users")
+    parser.add_argument('--cafes', type=int, default=100_000,
+                        help="number of generated cafes")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', metavar='NAME',
+                        help="save results as baseline NAME")
+    parser.add_argument('--compare', metavar='NAME',
+                        help="compare results to baseline NAME")
+    args = parser.parse_args()
+
+    summary = run(args.base_url, MIXES[args.mix], args.duration,
+                  args.concurrency, args.users, args.cafes, args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)['routes']
+
+    print_summary(summary, baseline)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f"{args.save}.json"), 'w') as f:
+            json.dump({'args': vars(args), 'routes': summary}, f, indent=2)
@@ -0,0 +1,110 @@
+"""Benchmark the per-request ORM lookups, plain and baked.
+
+Times each lookup in queries.py against the Query it replaced, and
+against running the same SQL on the raw DB-API connection, which is
+the floor: "overhead" is the time spent above it, building, compiling
+and loading. Needs a database with cafes, users and likes (see
+bench.generate).
+
+    python -m bench.queries --calls 5000
+"""
+
+import argparse
+import time
+
+import queries
+from app import create_app
+from bench.loadtest import percentile
+from models import db, Cafe, Like, User
+
+
+def lookups(user, cafe):
+    """{name: (plain Query call, baked call, raw SQL, raw parameters)}"""
+
+    return {
+        'get user': (
+            lambda: User.query.get(user.id),
+            lambda: queries.get_user(user.id),
+            "SELECT * FROM users WHERE id = %s", (user.id,)),
+        'get cafe': (
+            lambda: Cafe.query.get(cafe.id),
+            lambda: queries.get_cafe(cafe.id),
+            "SELECT * FROM cafes WHERE id = %s", (cafe.id,)),
+        'user likes cafe': (
+            lambda: Like.query.filter_by(
+                user_id=user.id, cafe_id=cafe.id).first() is not None,
+            lambda: queries.user_likes_cafe(user.id, cafe.id),
+            "SELECT user_id FROM likes WHERE user_id = %s AND cafe_id = %s"
+            " LIMIT 1", (user.id, cafe.id)),
+        'find login': (
+            lambda: User.query.filter(
+                db.func.lower(User.username) == user.username.lower()).first(),
+            lambda: queries.find_login(user.username),
+            "SELECT * FROM users WHERE lower(username) = %s LIMIT 1",
+            (user.username.lower(),)),
+    }
+
+
+def time_calls(call, n):
+    """Return per-call seconds, sorted; the session is emptied before each
+    call, so lookups by primary key really query."""
+
+    timings = []
+    for _ in range(n):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings
+
+
+def time_raw(sql, params, n):
+    cursor = db.session.connection().connection.cursor()
+    timings = []
+    for _ in range(n):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings
+
+
+def run(n_calls):
+    user = User.query.order_by(User.id).first()
+    cafe = Cafe.query.order_by(Cafe.id).first()
+    if user is None or cafe is None:
+        raise SystemExit("Need at least one user and one cafe")
+
+    print(f"{'lookup':<16} {'raw':>7} {'plain':>7} {'baked':>7} "
+          f"{'overhead':>13}   (p50 us)")
+
+    def us(seconds):
+        return f"{seconds * 1e6:7.0f}"
+
+    for name, (plain, baked, sql, params) in lookups(user, cafe).items():
+        # warm up: connect, and bake
+        time_calls(plain, 10)
+        time_calls(baked, 10)
+
+        raw_time = percentile(time_raw(sql, params, n_calls), 50)
+        plain_time = percentile(time_calls(plain, n_calls), 50)
+        baked_time = percentile(time_calls(baked, n_calls), 50)
+
+        print(f"{name:<16} {us(raw_time)} {us(plain_time)} {us(baked_time)} "
+              f"{us(plain_time - raw_time)} -> "
+              f"{us(baked_time - raw_time).strip()}")
+
+    db.session.rollback()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=5000)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_ECHO': False})
+
+    with app.app_context():
+        run(args.calls)
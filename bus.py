@@ -0,0 +1,266 @@
+"""Cache invalidation across workers and hosts, over Postgres NOTIFY.
+
+In-process caches hear about changes through models.tables_changed, but
+only for commits made in their own process. With the bus on, every
+commit that changed rows also sends one NOTIFY on CHANNEL, inside the
+transaction, so it's delivered exactly when (and only if) the commit
+is. Each worker runs a Listener thread that turns other processes'
+notifications back into tables_changed signals, so the same handlers
+evict the same keys everywhere.
+
+Only changes to RELAYED_TABLES are sent: no cache keeps anything else.
+A notification's payload is JSON:
+
+    {"o": "host:pid", "t": unix time sent,
+     "c": {"cafes": [3, 7], "cities": null}}
+
+A null table (or a table with more than MAX_IDS changed rows) means
+the whole table is stale.
+"""
+
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from models import db, tables_changed
+
+CHANNEL = 'cache_changes'
+
+# the tables tables_changed handlers act on; add one with its handler
+RELAYED_TABLES = ('cafes', 'cities')
+
+# beyond this many rows, say "the whole table" instead of listing them
+MAX_IDS = 200
+
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7500
+
+RETRY_SECONDS = 5
+
+NOTIFY_SQL = text(
+    "SELECT pg_notify(:channel, json_build_object("
+    "'o', CAST(:origin AS text), 't', CAST(:sent AS float8), "
+    "'c', CAST(:changes AS json))::text)")
+
+log = logging.getLogger(__name__)
+
+
+def process_origin():
+    """Name this process, so a listener can skip its own notifications."""
+
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def encode_changes(changes):
+    """{table: set of keys} -> JSON text, listing keys where it can."""
+
+    tables = {}
+    for table, keys in changes.items():
+        if None in keys or len(keys) > MAX_IDS:
+            tables[table] = None
+        else:
+            tables[table] = sorted(keys, key=repr)
+
+    data = json.dumps(tables)
+    if len(data) > MAX_PAYLOAD:
+        data = json.dumps({table: None for table in changes})
+    return data
+
+
+def decode_changes(tables):
+    """The inverse of encode_changes (given the parsed JSON)."""
+
+    return {
+        table: {None} if keys is None else {
+            tuple(key) if isinstance(key, list) else key for key in keys}
+        for table, keys in tables.items()
+    }
+
+
+def merge_changes(changes, more):
+    for table, keys in more.items():
+        changes.setdefault(table, set()).update(keys)
+
+
+@event.listens_for(Session, 'before_commit')
+def _publish_changes(session):
+    app = getattr(session, 'app', None)
+    if app is None or not app.config['INVALIDATION_BUS']:
+        return
+
+    # the commit flushes after this runs; flush now so we see everything
+    session.flush()
+
+    changes = {table: keys
+               for table, keys in session.info.get('changes', {}).items()
+               if table in RELAYED_TABLES}
+    if changes:
+        session.execute(NOTIFY_SQL, {
+            'channel': CHANNEL,
+            'origin': process_origin(),
+            'sent': time.time(),
+            'changes': encode_changes(changes),
+        })
+
+
+class Listener:
+    """Thread relaying other processes' change notifications.
+
+    Notifications arriving within `coalesce` seconds of each other are
+    merged into one tables_changed signal. After losing its connection
+    it can't know what it missed, so it reports every table as stale.
+    """
+
+    def __init__(self, app, coalesce=0.05, origin=None):
+        self.app = app
+        self.coalesce = coalesce
+        # notifications from this origin are ours, and already handled
+        self.origin = origin or process_origin()
+        self.pid = os.getpid()
+
+        self.listening = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.connections = 0
+
+        self.received = 0
+        self.signals = 0
+        self.last_lag = None
+        self.max_lag = 0
+        self.total_lag = 0
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name='invalidation-bus', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except Exception:
+                log.exception("Invalidation bus disconnected")
+            self.listening.clear()
+            self.stopped.wait(RETRY_SECONDS)
+
+    def connect(self):
+        uri = self.app.config['INVALIDATION_BUS_DATABASE_URI']
+        engine = (create_engine(uri, poolclass=NullPool) if uri
+                  else db.get_engine(self.app))
+
+        raw = engine.raw_connection()
+        # ours for good; a LISTENing connection can't go back to the pool
+        raw.detach()
+        conn = raw.connection
+        # end the transaction a pre-ping may have started
+        conn.rollback()
+        conn.autocommit = True
+        return conn
+
+    def listen(self):
+        conn = self.connect()
+
+        try:
+            conn.cursor().execute(f"LISTEN {CHANNEL}")
+            if self.connections:
+                self.send({table: {None} for table in RELAYED_TABLES})
+            self.connections += 1
+            self.listening.set()
+
+            while not self.stopped.is_set():
+                if not select.select([conn], [], [], 1)[0]:
+                    continue
+                conn.poll()
+
+                # collect whatever else arrives in the next moment
+                deadline = time.monotonic() + self.coalesce
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if select.select([conn], [], [], remaining)[0]:
+                        conn.poll()
+
+                payloads = [notify.payload for notify in conn.notifies]
+                del conn.notifies[:]
+                self.dispatch(payloads)
+        finally:
+            conn.close()
+
+    def dispatch(self, payloads):
+        """Signal the changes in these payloads, all at once."""
+
+        changes = {}
+        now = time.time()
+
+        for payload in payloads:
+            try:
+                message = json.loads(payload)
+                if message['o'] == self.origin:
+                    continue
+                merge_changes(changes, decode_changes(message['c']))
+                lag = now - message['t']
+            except (ValueError, KeyError, TypeError, AttributeError):
+                log.warning("Bad invalidation message: %r", payload)
+                continue
+
+            self.received += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+
+        if changes:
+            self.send(changes)
+
+    def send(self, changes):
+        with self.app.app_context():
+            tables_changed.send(self, changes=changes, committed=True,
+                                remote=True)
+        self.signals += 1
+
+    def stats(self):
+        """Counts and delivery delays (commit to eviction) so far."""
+
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 1)
+
+        return {
+            "listening": self.listening.is_set(),
+            "received": self.received,
+            "signals": self.signals,
+            "last_lag_ms": ms(self.last_lag),
+            "max_lag_ms": ms(self.max_lag),
+            "mean_lag_ms": ms(self.total_lag / self.received
+                              if self.received else None),
+        }
+
+
+listener = None
+
+
+def start(app):
+    """Start this process's listener (once), if the bus is on."""
+
+    global listener
+
+    if not app.config['INVALIDATION_BUS']:
+        return None
+    # a listener forked from a parent process doesn't run here
+    if listener is None or listener.pid != os.getpid():
+        listener = Listener(
+            app, app.config['INVALIDATION_BUS_COALESCE_MS'] / 1000).start()
+    return listener
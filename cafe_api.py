@@ -0,0 +1,118 @@
+"""Field selection and encoding for the machine-readable cafe API.
+
+Clients ask for just the fields they need (?fields=id,name,city), and
+only those columns are selected; the city name and state cost a join
+only when asked for. Responses are JSON, or MessagePack for clients that
+send `Accept: application/msgpack`.
+"""
+
+from flask import current_app, request
+
+from models import db, Cafe, City
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# API field name -> column
+FIELDS = {
+    'id': Cafe.id,
+    'name': Cafe.name,
+    'description': Cafe.description,
+    'url': Cafe.url,
+    'address': Cafe.address,
+    'city_code': Cafe.city_code,
+    'hours': Cafe.hours,
+    'city': City.name,
+    'state': City.state,
+    'image_url': Cafe.image_url,
+}
+
+CITY_FIELDS = {'city', 'state'}
+
+JSON_TYPE = 'application/json'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+class FieldError(ValueError):
+    """Unknown field asked for."""
+
+
+def parse_fields(value):
+    """Return the field names listed in a ?fields= value, in FIELDS order.
+
+    An empty value means every field. 'id' is always included, since it
+    is the paging cursor.
+    """
+
+    if not value:
+        return list(FIELDS)
+
+    wanted = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = wanted - FIELDS.keys()
+    if unknown:
+        raise FieldError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    wanted.add('id')
+    return [name for name in FIELDS if name in wanted]
+
+
+def select_cafes(fields):
+    """Return a query for rows of just these fields."""
+
+    query = db.session.query(*(FIELDS[name] for name in fields))
+    if CITY_FIELDS.intersection(fields):
+        query = query.join(City, Cafe.city_code == City.code)
+    else:
+        query = query.select_from(Cafe)
+    return query
+
+
+def snapshot_values(fields, rows):
+    """Return tuples of these fields for snapshot CafeRows."""
+
+    cities = City.get_registry().cities
+    values = []
+
+    for row in rows:
+        name, state = cities.get(row.city_code, (None, None))
+        extra = {'city': name, 'state': state}
+        values.append(tuple(
+            extra[f] if f in extra else getattr(row, f) for f in fields))
+
+    return values
+
+
+def to_dicts(fields, rows):
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def encode_json(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    import json
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def encode_msgpack(data):
+    import msgpack
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def api_response(data, status=200):
+    """Return data encoded as the client's Accept header prefers."""
+
+    best = request.accept_mimetypes.best_match((JSON_TYPE,) + MSGPACK_TYPES)
+
+    if best in MSGPACK_TYPES:
+        body = encode_msgpack(data)
+        mimetype = best
+    else:
+        body = encode_json(data)
+        mimetype = JSON_TYPE
+
+    resp = current_app.response_class(body, status=status, mimetype=mimetype)
+    resp.vary.add('Accept')
+    return resp
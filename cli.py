@@ -0,0 +1,38 @@
+"""`flask` commands that are imported only when run.
+
+Processes serving requests never run them, and their modules are slow
+to import (`flask db` needs Alembic), so create_app registers
+stand-ins instead of the commands themselves.
+"""
+
+import importlib
+
+import click
+
+
+class LazyCommand(click.Command):
+    """Stands in for the command or group at `import_name` ("module:name"),
+    importing it when it's run or asked for help.
+
+    `help` is shown in `flask --help`, which lists it without importing.
+    """
+
+    def __init__(self, name, import_name, help):
+        super().__init__(name, help=help)
+        self.import_name = import_name
+        self._command = None
+
+    @property
+    def command(self):
+        if self._command is None:
+            module, name = self.import_name.split(':')
+            self._command = getattr(importlib.import_module(module), name)
+        return self._command
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # the context is the real command's, so it's the one invoked
+        return self.command.make_context(info_name, args, parent=parent,
+                                         **extra)
+
+    def invoke(self, ctx):
+        return self.command.invoke(ctx)
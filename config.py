@@ -1,4 +1,27 @@
 import os
 
 DATABASE_URL = os.environ.get('DATABASE_URL', 'postgres:///flaskcafe')
+# comma-separated; read-only views are spread over these
+DATABASE_REPLICA_URLS = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url]
+# the primary without PgBouncer in between, for LISTEN (bus.py)
+DATABASE_DIRECT_URL = os.environ.get('DATABASE_DIRECT_URL')
+
+# SQLAlchemy pool, per worker process and database
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+
+# connecting through PgBouncer in transaction mode: no prepared statements
+PGBOUNCER = os.environ.get('PGBOUNCER', '0') == '1'
+
 MAPQUEST_API_KEY = os.environ.get('MAPQUEST_API_KEY')
+MAPQUEST_BASE_URL = os.environ.get(
+    'MAPQUEST_BASE_URL', 'https://www.mapquestapi.com')
+
+# asyncpg pool for the ASGI like API (per uvicorn worker)
+ASYNC_DB_POOL_MIN = int(os.environ.get('ASYNC_DB_POOL_MIN', 2))
+ASYNC_DB_POOL_MAX = int(os.environ.get('ASYNC_DB_POOL_MAX', 20))
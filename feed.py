@@ -0,0 +1,256 @@
+"""Activity feed: recent likes by the people a user follows.
+
+Likes are fanned out on write: liking a cafe copies the like into the
+feed_items of each of the liker's followers, so reading a feed is one
+index range scan.
+
+That costs a row per follower per like, which is fine for most users
+but not for an account with tens of thousands of followers. Likes by
+users with more than FANOUT_MAX_FOLLOWERS followers aren't copied
+anywhere; a feed merges them in on read, from the likes table, instead.
+(bench/feed.py measures both sides of that trade.)
+
+Feeds are capped at about FEED_MAX_ITEMS rows. Finding a feed's cut-off
+reads that many index entries, so rather than trimming every follower's
+feed on every like, each like trims a random TRIM_CHANCE of them; a feed
+overshoots by around 1 / TRIM_CHANCE rows between trims.
+
+Feeds are paged by cursor: each page ends with an opaque token for the
+last item shown, and the next page starts after it, so new likes never
+shift or repeat items on later pages.
+"""
+
+import base64
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db, record_change
+from trending import NOW_SQL
+
+FANOUT_MAX_FOLLOWERS = 1000
+
+FEED_MAX_ITEMS = 200
+
+TRIM_CHANCE = 0.05
+
+FeedEntry = namedtuple(
+    'FeedEntry', 'user_id username cafe_id cafe_name liked_at')
+
+
+# Like trending scores, feeds are derived data: written with Core SQL, and
+# not reported to tables_changed. The SQL is built from placeholders so
+# asgi.py can run the same statements with asyncpg ($1, ...).
+
+def fans_out_sql(actor):
+    """SQL condition: `actor`'s likes are copied into followers' feeds."""
+
+    return (f"(SELECT follower_count FROM users WHERE id = {actor})"
+            f" <= {FANOUT_MAX_FOLLOWERS}")
+
+
+def fanout_sql(actor, cafe, liked='(SELECT 1) AS liked'):
+    """SQL copying `actor`'s like of `cafe`, made now, into followers'
+    feeds; `liked` is a FROM item with a row only if the like was made."""
+
+    return (
+        f"INSERT INTO feed_items (user_id, liked_at, actor_id, cafe_id)"
+        f" SELECT follows.follower_id, {NOW_SQL}, {actor}, {cafe}"
+        f" FROM follows, {liked}"
+        f" WHERE follows.followed_id = {actor} AND {fans_out_sql(actor)}"
+        f" ON CONFLICT DO NOTHING")
+
+
+def unfanout_sql(actor, cafe, at):
+    """SQL removing `actor`'s like of `cafe`, made at `at`, from feeds."""
+
+    return (
+        f"DELETE FROM feed_items"
+        f" WHERE user_id IN (SELECT follower_id FROM follows"
+        f" WHERE followed_id = {actor})"
+        f" AND liked_at = {at} AND actor_id = {actor} AND cafe_id = {cafe}")
+
+
+def trim_sql(users):
+    """SQL dropping all but the newest FEED_MAX_ITEMS items from the feeds
+    of `users` (SQL selecting user ids)."""
+
+    return (
+        f"DELETE FROM feed_items USING ("
+        f" SELECT feeds.user_id, cut.liked_at, cut.actor_id, cut.cafe_id"
+        f" FROM ({users}) AS feeds (user_id)"
+        f" CROSS JOIN LATERAL (SELECT liked_at, actor_id, cafe_id"
+        f" FROM feed_items WHERE feed_items.user_id = feeds.user_id"
+        f" ORDER BY liked_at DESC, actor_id DESC, cafe_id DESC"
+        f" OFFSET {FEED_MAX_ITEMS} LIMIT 1) AS cut) AS oldest"
+        f" WHERE feed_items.user_id = oldest.user_id"
+        f" AND (feed_items.liked_at, feed_items.actor_id, feed_items.cafe_id)"
+        f" <= (oldest.liked_at, oldest.actor_id, oldest.cafe_id)")
+
+
+def followers_sql(actor, chance):
+    """SQL selecting a random `chance` of the followers whose feeds
+    `actor`'s likes reach."""
+
+    return (f"SELECT follower_id FROM follows"
+            f" WHERE followed_id = {actor} AND {fans_out_sql(actor)}"
+            f" AND random() < {chance}")
+
+
+ADD_LIKE_SQL = text(fanout_sql(':user_id', ':cafe_id'))
+
+TRIM_FOLLOWERS_SQL = text(
+    trim_sql(followers_sql(':user_id', 'CAST(:chance AS float8)')))
+
+REMOVE_LIKE_SQL = text(unfanout_sql(':user_id', ':cafe_id', ':created_at'))
+
+FOLLOW_SQL = text(
+    "INSERT INTO follows (follower_id, followed_id) VALUES (:user_id, :other)"
+    " ON CONFLICT DO NOTHING RETURNING followed_id")
+
+UNFOLLOW_SQL = text(
+    "DELETE FROM follows WHERE follower_id = :user_id"
+    " AND followed_id = :other RETURNING followed_id")
+
+COUNT_FOLLOWER_SQL = text(
+    "UPDATE users SET follower_count = follower_count + :change"
+    " WHERE id = :other")
+
+BACKFILL_SQL = text(
+    f"INSERT INTO feed_items (user_id, liked_at, actor_id, cafe_id)"
+    f" SELECT :user_id, created_at, user_id, cafe_id FROM likes"
+    f" WHERE user_id = :other AND {fans_out_sql(':other')}"
+    f" ORDER BY created_at DESC LIMIT {FEED_MAX_ITEMS}"
+    f" ON CONFLICT DO NOTHING")
+
+TRIM_USER_SQL = text(trim_sql("SELECT CAST(:user_id AS integer)"))
+
+CLEAR_FOLLOWED_SQL = text(
+    "DELETE FROM feed_items WHERE user_id = :user_id AND actor_id = :other")
+
+
+def add_like(user_id, cafe_id):
+    """Copy a like made now (in this transaction) into followers' feeds."""
+
+    params = {"user_id": user_id, "cafe_id": cafe_id, "chance": TRIM_CHANCE}
+    db.session.execute(ADD_LIKE_SQL, params)
+    db.session.execute(TRIM_FOLLOWERS_SQL, params)
+
+
+def remove_like(user_id, cafe_id, created_at):
+    """Take a deleted like, made at created_at, out of followers' feeds."""
+
+    db.session.execute(REMOVE_LIKE_SQL, {
+        "user_id": user_id, "cafe_id": cafe_id, "created_at": created_at})
+
+
+def follow(user_id, other_id):
+    """Have user follow other; return False if they already did."""
+
+    params = {"user_id": user_id, "other": other_id}
+    if db.session.execute(FOLLOW_SQL, params).first() is None:
+        return False
+
+    db.session.execute(COUNT_FOLLOWER_SQL, dict(params, change=1))
+    # start the feed off with what they've liked lately
+    db.session.execute(BACKFILL_SQL, params)
+    db.session.execute(TRIM_USER_SQL, params)
+    record_change(db.session, 'follows', (user_id, other_id))
+    return True
+
+
+def unfollow(user_id, other_id):
+    """Have user stop following other; return False if they didn't."""
+
+    params = {"user_id": user_id, "other": other_id}
+    if db.session.execute(UNFOLLOW_SQL, params).first() is None:
+        return False
+
+    db.session.execute(COUNT_FOLLOWER_SQL, dict(params, change=-1))
+    db.session.execute(CLEAR_FOLLOWED_SQL, params)
+    record_change(db.session, 'follows', (user_id, other_id))
+    return True
+
+
+#######################################
+# reading
+
+
+def encode_cursor(entry):
+    key = f"{entry.liked_at.isoformat()} {entry.user_id} {entry.cafe_id}"
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (liked_at, user_id, cafe_id); raise ValueError if bad."""
+
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        liked_at, user_id, cafe_id = key.decode().split(' ')
+        return (datetime.fromisoformat(liked_at), int(user_id), int(cafe_id))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Bad cursor: {cursor!r}") from e
+
+
+FEED_SQL = """
+SELECT items.actor_id, users.username, items.cafe_id, cafes.name,
+       items.liked_at
+FROM (
+    (SELECT actor_id, cafe_id, liked_at FROM feed_items
+     WHERE user_id = :user_id {items_before}
+     ORDER BY liked_at DESC, actor_id DESC, cafe_id DESC
+     LIMIT :limit)
+    -- (UNION drops likes fanned out before the account got big)
+    UNION
+    -- accounts too big to fan out: merge in their latest likes
+    (SELECT big.followed_id, recent.cafe_id, recent.created_at
+     FROM follows AS big
+     JOIN users AS followed ON followed.id = big.followed_id
+     CROSS JOIN LATERAL (
+         SELECT cafe_id, created_at FROM likes
+         WHERE likes.user_id = big.followed_id {likes_before}
+         ORDER BY created_at DESC, cafe_id DESC
+         LIMIT :limit) AS recent
+     WHERE big.follower_id = :user_id
+       AND followed.follower_count > :max_followers)
+) AS items
+JOIN users ON users.id = items.actor_id
+JOIN cafes ON cafes.id = items.cafe_id
+ORDER BY items.liked_at DESC, items.actor_id DESC, items.cafe_id DESC
+LIMIT :limit
+"""
+
+ITEMS_BEFORE = ("AND (liked_at, actor_id, cafe_id)"
+                " < (:before_at, :before_user, :before_cafe)")
+
+# created_at <= first, so the (user_id, created_at) index bounds the scan
+LIKES_BEFORE = ("AND likes.created_at <= :before_at"
+                " AND (likes.created_at, likes.user_id, likes.cafe_id)"
+                " < (:before_at, :before_user, :before_cafe)")
+
+FEED_PAGE_SQL = text(FEED_SQL.format(items_before='', likes_before=''))
+
+FEED_PAGE_BEFORE_SQL = text(
+    FEED_SQL.format(items_before=ITEMS_BEFORE, likes_before=LIKES_BEFORE))
+
+
+def get_feed(user_id, before=None, limit=20):
+    """Return (entries, cursor) for a page of user's feed, newest first.
+
+    `before` is the cursor of the previous page; the returned cursor is
+    None on the last page.
+    """
+
+    params = {"user_id": user_id, "limit": limit + 1,
+              "max_followers": FANOUT_MAX_FOLLOWERS}
+    sql = FEED_PAGE_SQL
+    if before is not None:
+        sql = FEED_PAGE_BEFORE_SQL
+        params['before_at'], params['before_user'], params['before_cafe'] = (
+            decode_cursor(before))
+
+    entries = [FeedEntry(*row) for row in db.session.execute(sql, params)]
+    if len(entries) > limit:
+        return entries[:limit], encode_cursor(entries[limit - 1])
+    return entries, None
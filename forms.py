@@ -3,6 +3,18 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, SelectField, TextAreaField, PasswordField
 from wtforms.validators import InputRequired, Length, URL, Optional, Email
+from wtforms.validators import ValidationError
+
+from hours import HoursError, parse_hours
+
+
+def valid_hours(form, field):
+    """Check field holds opening hours we can read."""
+
+    try:
+        parse_hours(field.data)
+    except HoursError as e:
+        raise ValidationError(str(e))
 
 
 class CafeAddEditForm(FlaskForm):
@@ -13,6 +25,9 @@ class CafeAddEditForm(FlaskForm):
     url = StringField("URL", validators=[Optional(), URL()])
     address = StringField("Address", validators=[InputRequired()])
     city_code = SelectField("City")
+    hours = TextAreaField(
+        "Opening hours (optional), e.g. 'Mon-Fri 7:00-18:00; Sat 9-14'",
+        validators=[Optional(), valid_hours])
     image_url = StringField("Image URL (optional)", validators=[Optional(), URL()])
 
 
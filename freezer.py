@@ -0,0 +1,237 @@
+"""Render the public cafe catalog to static files (`flask freeze`).
+
+The homepage, cafe list pages, city pages and cafe detail pages are
+rendered as an anonymous visitor sees them, and static/ (assets and
+maps) is copied alongside, so a CDN or plain web server can serve them
+without the app.
+
+Each URL is written to <path>/index.html, with query arguments as extra
+directories: /cafes?city=sf&page=2 -> cafes/city=sf/page=2/index.html.
+
+Later runs only re-render cafes updated since the last run (a watermark
+kept in .freeze.json) and the list pages, unless --full is given.
+"""
+
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from importer import batched
+from models import db, Cafe, City
+
+STATE_FILE = '.freeze.json'
+
+# re-render cafes updated this long before the last watermark too, in
+# case a transaction that started earlier committed after we looked
+WATERMARK_LAG = timedelta(minutes=1)
+
+URLS_PER_TASK = 200
+
+
+def page_path(url):
+    """Return the file (relative to the output dir) for a page URL."""
+
+    path, _, query = url.partition('?')
+    parts = [part for part in path.split('/') if part]
+    if query:
+        parts += sorted(query.split('&'))
+    return os.path.join(*parts, 'index.html')
+
+
+def list_urls():
+    """Return URLs for every page of /cafes, overall and for each city,
+    and the city pages."""
+
+    per_page = current_app.config['CAFES_PER_PAGE']
+    counts = Cafe.get_city_counts()
+    urls = []
+
+    filters = [(None, sum(counts.values()))]
+    filters += [(code, counts.get(code, 0))
+                for code, name in City.get_registry().choices]
+
+    for city_code, total in filters:
+        pages = max(1, -(-total // per_page))
+        for page in range(1, pages + 1):
+            args = {}
+            if city_code:
+                args['city'] = city_code
+            if page > 1:
+                args['page'] = page
+            urls.append(f"/cafes?{urlencode(args)}" if args else "/cafes")
+
+    urls += [f"/cities/{code}" for code, name in City.get_registry().choices]
+    return urls
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def remove_page(out, url):
+    try:
+        os.remove(os.path.join(out, page_path(url)))
+    except FileNotFoundError:
+        pass
+
+
+def render_pages(urls, out):
+    """Render urls with the current app into out; return URLs that failed."""
+
+    client = current_app.test_client()
+    failed = []
+
+    for url in urls:
+        resp = client.get(url)
+        if resp.status_code == 200:
+            write_file(os.path.join(out, page_path(url)), resp.get_data())
+        else:
+            failed.append(url)
+
+    return failed
+
+
+_worker_app = None
+
+
+def _init_worker(config):
+    global _worker_app
+
+    from app import create_app
+    _worker_app = create_app(config)
+
+
+def _render_in_worker(urls, out):
+    with _worker_app.app_context():
+        return render_pages(urls, out)
+
+
+def render_parallel(urls, out, workers):
+    """Render urls across worker processes; return URLs that failed."""
+
+    if workers <= 1 or len(urls) <= URLS_PER_TASK:
+        return render_pages(urls, out)
+
+    # workers build their own app; don't let them inherit our session
+    # and connections, which are the same sockets after a fork
+    db.session.remove()
+    db.engine.dispose()
+
+    config = dict(current_app.config)
+    failed = []
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(config,)) as pool:
+        chunks = [list(chunk) for chunk in batched(urls, URLS_PER_TASK)]
+        for chunk_failed in pool.map(_render_in_worker, chunks,
+                                     [out] * len(chunks)):
+            failed.extend(chunk_failed)
+
+    return failed
+
+
+def copy_static(out):
+    """Copy new or changed files in static/ to out/static; return count."""
+
+    src_root = current_app.static_folder
+    dest_root = os.path.join(out, 'static')
+    copied = 0
+
+    for folder, dirs, files in os.walk(src_root):
+        for name in files:
+            src = os.path.join(folder, name)
+            dest = os.path.join(dest_root, os.path.relpath(src, src_root))
+            src_stat = os.stat(src)
+            try:
+                dest_stat = os.stat(dest)
+                if (dest_stat.st_size == src_stat.st_size
+                        and dest_stat.st_mtime >= src_stat.st_mtime):
+                    continue
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copy2(src, dest)
+            copied += 1
+
+    return copied
+
+
+def load_state(out):
+    try:
+        with open(os.path.join(out, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(out, state):
+    write_file(os.path.join(out, STATE_FILE), json.dumps(state).encode())
+
+
+@click.command('freeze')
+@click.argument('out', default='build', type=click.Path(file_okay=False))
+@click.option('--full', is_flag=True,
+              help="Re-render every page, not just changed cafes.")
+@click.option('--workers', default=os.cpu_count(), show_default=True,
+              help="Processes rendering pages.")
+@with_appcontext
+def freeze(out, full, workers):
+    """Render the public catalog to static files in OUT."""
+
+    # pages are rendered once each; don't fill the page cache with them
+    current_app.config['PAGE_CACHE_TTL'] = 0
+
+    state = None if full else load_state(out)
+    started = db.session.query(
+        db.func.timezone('utc', db.func.now())).scalar()
+
+    cafes = db.session.query(Cafe.id, Cafe.updated_at).all()
+    cafe_ids = {id for id, updated_at in cafes}
+
+    if state:
+        since = datetime.fromisoformat(state['watermark']) - WATERMARK_LAG
+        changed = sorted(id for id, updated_at in cafes if updated_at > since)
+        removed = set(state['cafe_ids']) - cafe_ids
+    else:
+        changed = sorted(cafe_ids)
+        removed = set()
+
+    urls = []
+    lists = list_urls()
+    if not state or changed or removed:
+        urls += ['/'] + lists
+    urls += [f"/cafes/{id}" for id in changed]
+
+    failed = render_parallel(urls, out, workers)
+
+    for id in removed:
+        remove_page(out, f"/cafes/{id}")
+    if state:
+        for url in set(state['list_urls']) - set(lists):
+            remove_page(out, url)
+
+    copied = copy_static(out)
+
+    click.echo(f"Pages: {len(urls) - len(failed)} rendered, "
+               f"{len(removed)} removed; static files: {copied} copied")
+
+    if failed:
+        # leave the watermark alone, so the next run tries these again
+        raise click.ClickException(
+            f"{len(failed)} pages failed: {', '.join(failed[:10])}")
+
+    save_state(out, {
+        'watermark': started.isoformat(),
+        'cafe_ids': sorted(cafe_ids),
+        'list_urls': lists,
+    })
@@ -0,0 +1,75 @@
+"""Gunicorn settings for Flask Cafe.
+
+The app is built once in the master (preload_app) and workers are
+forked from it, so they share its memory copy-on-write and start
+without re-importing anything.
+"""
+
+import gc
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+# This file is read before the app is loaded. No collections until the
+# workers fork: a collection writes to every object's header and would
+# dirty pages we want the workers to share.
+gc.disable()
+
+
+def when_ready(server):
+    flask_app = server.app.wsgi()
+    times = flask_app.config['BOOT_TIMES']
+    server.log.info("App loaded: imports %.0fms, create_app %.0fms",
+                    times['import'] * 1000, times['create_app'] * 1000)
+
+    # compile templates and configure mappers once, for every worker
+    from sqlalchemy.orm import configure_mappers
+    from warmup import compile_templates
+    configure_mappers()
+    compile_templates(flask_app)
+
+    # build in-memory indexes before forking, so workers share them
+    from autocomplete import cafe_search
+    try:
+        with flask_app.app_context():
+            cafe_search.build()
+    except Exception:
+        server.log.exception("Couldn't build autocomplete index; "
+                             "workers will build their own")
+
+    # close the connections warm-up opened, so the workers inherit none
+    # (and the pool's objects are garbage before the freeze, not after)
+    from models import db
+    from routing import dispose_engines
+    dispose_engines(db, flask_app)
+
+    # park everything allocated so far in the permanent generation, so
+    # the workers' collectors never write to (and so copy) those pages
+    gc.freeze()
+    gc.enable()
+
+
+def post_fork(server, worker):
+    flask_app = server.app.wsgi()
+
+    # the master closed its connections; this makes sure no pooled one
+    # is ever shared, whatever opened it
+    from models import db
+    from routing import dispose_engines
+    dispose_engines(db, flask_app)
+
+    # the worker doesn't accept connections until this returns
+    from warmup import warm_up
+    try:
+        steps = warm_up(flask_app)
+    except Exception:
+        server.log.exception("Worker %s warm-up failed; /readyz will retry",
+                             worker.pid)
+        return
+
+    server.log.info("Worker %s warmed up: %s", worker.pid, ", ".join(
+        f"{name} {seconds * 1000:.0f}ms" for name, seconds in steps.items()))
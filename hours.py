@@ -0,0 +1,126 @@
+"""Weekly opening hours: parsing them, and slots of the week.
+
+Hours are written one day range per line (or separated by ';'):
+
+    Mon-Fri 7:00-18:00
+    Sat 8:00-12:00, 13:00-17:00
+    Sun closed
+
+A range ending at or before its start runs past midnight into the next
+day (Fri 20:00-2:00). Cafes store the text as entered, plus a bitmap of
+the 7 x 96 fifteen-minute slots of the week they're open (Monday 0:00 is
+slot 0), which SQL tests with get_bit().
+"""
+
+import re
+
+from sqlalchemy import text
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+SLOTS = 7 * SLOTS_PER_DAY
+BITMAP_BYTES = SLOTS // 8
+
+LINE_RE = re.compile(r'^(?P<days>[a-z ,-]+?)\s+(?P<times>closed|[0-9: ,-]+)$')
+TIME_RE = re.compile(r'^(\d{1,2})(?::(\d{2}))?$')
+
+
+class HoursError(ValueError):
+    """Opening hours text that can't be parsed."""
+
+
+def parse_days(text):
+    """'mon-wed, sat' -> [0, 1, 2, 5]"""
+
+    if text.strip() == 'daily':
+        return list(range(7))
+
+    days = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        try:
+            start = DAYS.index(first.strip()[:3])
+            end = DAYS.index(last.strip()[:3]) if last else start
+        except ValueError:
+            raise HoursError(f"Unknown day in '{part.strip()}'")
+        # ranges may wrap around the week (Sat-Mon)
+        days += [(start + i) % 7 for i in range((end - start) % 7 + 1)]
+    return days
+
+
+def parse_minutes(text):
+    """'7:30' -> 450"""
+
+    match = TIME_RE.match(text.strip())
+    if not match:
+        raise HoursError(f"Bad time '{text.strip()}'")
+
+    hour, minute = int(match.group(1)), int(match.group(2) or 0)
+    if hour > 24 or minute > 59 or (hour == 24 and minute):
+        raise HoursError(f"Bad time '{text.strip()}'")
+    return hour * 60 + minute
+
+
+def parse_hours(text):
+    """Return the bitmap (bytes) of the week's open slots in hours text.
+
+    Raises HoursError if text isn't valid hours.
+    """
+
+    bits = bytearray(BITMAP_BYTES)
+
+    for line in re.split(r'[\n;]', text.lower()):
+        line = line.strip()
+        if not line:
+            continue
+
+        match = LINE_RE.match(line)
+        if not match:
+            raise HoursError(f"Can't read '{line}'")
+        if match.group('times') == 'closed':
+            continue
+
+        for day in parse_days(match.group('days')):
+            for times in match.group('times').split(','):
+                start, sep, end = times.partition('-')
+                if not sep:
+                    raise HoursError(f"Bad time range '{times.strip()}'")
+                start, end = parse_minutes(start), parse_minutes(end)
+                if end <= start:
+                    end += 24 * 60
+
+                first = day * SLOTS_PER_DAY + start // SLOT_MINUTES
+                last = day * SLOTS_PER_DAY + -(-end // SLOT_MINUTES)
+                for slot in range(first, last):
+                    slot %= SLOTS
+                    bits[slot // 8] |= 1 << (slot % 8)
+
+    return bytes(bits)
+
+
+def slot_at(local):
+    """Return the week slot of a local (naive) datetime."""
+
+    minutes = local.hour * 60 + local.minute
+    return local.weekday() * SLOTS_PER_DAY + minutes // SLOT_MINUTES
+
+
+def is_open(bitmap, slot):
+    """Is a cafe with this hours bitmap open in this slot?"""
+
+    return bool(bitmap) and bool(bitmap[slot // 8] >> (slot % 8) & 1)
+
+
+# slot of a local timestamp, in SQL
+SLOT_SQL = (
+    f"((extract(isodow FROM {{local}})::int - 1) * {SLOTS_PER_DAY}"
+    f" + (extract(hour FROM {{local}})::int * 60"
+    f" + extract(minute FROM {{local}})::int) / {SLOT_MINUTES})")
+
+# (timezone, slot) at instant :at (default now) for each of :timezones;
+# the database does the conversion, so its zone data is the one we use
+LOCAL_SLOTS_SQL = text(
+    "SELECT tz, " + SLOT_SQL.format(local="timezone(tz, coalesce("
+                                          "CAST(:at AS timestamptz), now()))")
+    + " FROM unnest(CAST(:timezones AS text[])) AS tz")
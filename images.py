@@ -0,0 +1,296 @@
+"""Resizing image proxy for cafe and user images.
+
+Remote images (e.g. full-size Yelp originals) are fetched once, checked,
+scaled down to a few fixed widths and kept in a size-bounded disk cache.
+Templates ask for them with image_attrs(), which emits src/srcset for
+URLs that are signed (so this isn't an open proxy) and never change for
+a given source, so browsers and CDNs may cache them for good.
+"""
+
+import hashlib
+import hmac
+import io
+import ipaddress
+import os
+import socket
+import threading
+from urllib.parse import quote, urljoin, urlsplit, urlunsplit
+
+from flask import Blueprint, Markup, abort, current_app, escape, request
+from flask import send_file
+
+from assets import static_url
+
+images = Blueprint('images', __name__)
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# redirects followed when fetching a source image (each one checked)
+MAX_REDIRECTS = 5
+
+
+class ImageError(Exception):
+    """Source can't be fetched or isn't a usable image."""
+
+
+def sign(url):
+    """Return the signature for proxying url."""
+
+    key = current_app.config['SECRET_KEY'].encode()
+    return hmac.new(key, url.encode(), hashlib.sha256).hexdigest()[:20]
+
+
+def proxied_url(url, width):
+    return f"/images/{width}/{sign(url)}.jpg?src={quote(url, safe='')}"
+
+
+@images.app_template_global()
+def image_attrs(url, sizes='100vw'):
+    """Return src, srcset and sizes attributes for an <img> of url.
+
+    Local images are used as they are (versioned, if in static/).
+    """
+
+    if not url.startswith(('http://', 'https://')):
+        if url.startswith('/static/'):
+            url = static_url(url[len('/static/'):])
+        return Markup(f'src="{escape(url)}"')
+
+    widths = current_app.config['IMAGE_WIDTHS']
+    src = proxied_url(url, widths[len(widths) // 2])
+    srcset = ', '.join(f'{proxied_url(url, w)} {w}w' for w in widths)
+    return Markup(f'src="{escape(src)}" srcset="{escape(srcset)}" '
+                  f'sizes="{escape(sizes)}"')
+
+
+def check_url(url):
+    """Return the address to fetch url from; raise ImageError unless url
+    is http(s) on a public address.
+
+    Sources are users' image URLs, so without this anyone could make us
+    fetch from internal hosts (localhost, the cloud metadata service,
+    private networks).
+    """
+
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError("not an http(s) URL")
+
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or 80,
+                                   proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError, ValueError) as e:
+        raise ImageError(str(e))
+
+    addresses = []
+    for family, type_, proto, canonname, sockaddr in infos:
+        # drop any IPv6 zone ("fe80::1%eth0")
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global:
+            raise ImageError(f"{parts.hostname} is not a public address")
+        addresses.append(str(address))
+    # the one a connection would try first
+    return addresses[0]
+
+
+def get_from(url, address):
+    """GET url from address (as check_url returned it), streamed.
+
+    Resolving the host again could give a different, internal address
+    (DNS rebinding), so the connection goes to address; the Host header,
+    and for https the SNI name and certificate check, still use the
+    URL's host.
+    """
+
+    import requests
+    from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+    parts = urlsplit(url)
+    host = f"[{address}]" if ':' in address else address
+    pinned = parts._replace(
+        netloc=f"{host}:{parts.port}" if parts.port else host)
+
+    with requests.Session() as http:
+        if parts.scheme == 'https':
+            adapter = HTTPAdapter()
+            adapter.init_poolmanager(
+                DEFAULT_POOLSIZE, DEFAULT_POOLSIZE,
+                server_hostname=parts.hostname,
+                assert_hostname=parts.hostname)
+            http.mount('https://', adapter)
+
+        return http.get(urlunsplit(pinned), stream=True, timeout=5,
+                        allow_redirects=False,
+                        headers={'Host': parts.netloc.rpartition('@')[2]})
+
+
+def fetch(url, max_bytes):
+    """Download url; return its bytes if it claims to be an image.
+
+    Redirects are followed by hand, so check_url sees every hop.
+    """
+
+    import requests
+
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            resp = get_from(url, check_url(url))
+            if not resp.is_redirect:
+                break
+            resp.close()
+            url = urljoin(url, resp.headers['Location'])
+        else:
+            raise ImageError("too many redirects")
+
+        resp.raise_for_status()
+        if not resp.headers.get('Content-Type', '').startswith('image/'):
+            raise ImageError("not an image")
+
+        data = bytearray()
+        for chunk in resp.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > max_bytes:
+                raise ImageError("image too large")
+        return bytes(data)
+
+    except requests.RequestException as e:
+        raise ImageError(str(e))
+
+
+def resize(data, widths, max_pixels):
+    """Return {width: JPEG bytes} of the image scaled to each width.
+
+    Images are never scaled up.
+    """
+
+    from PIL import Image
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.width * img.height > max_pixels:
+            raise ImageError("image has too many pixels")
+        img.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageError(str(e))
+
+    img = img.convert('RGB')
+    resized = {}
+
+    for width in widths:
+        scaled = img
+        if img.width > width:
+            height = round(img.height * width / img.width)
+            scaled = img.resize((width, height), Image.LANCZOS)
+        out = io.BytesIO()
+        scaled.save(out, 'JPEG', quality=80, optimize=True, progressive=True)
+        resized[width] = out.getvalue()
+
+    return resized
+
+
+class DiskCache:
+    """Files in one directory, evicting least recently used over max_bytes.
+
+    Hits bump a file's mtime, so mtime order is recency order.
+    """
+
+    def __init__(self):
+        self.size = None
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(current_app.config['IMAGE_CACHE_DIR'], key)
+
+    def get(self, key):
+        """Return the cached file, open for reading, or None.
+
+        An open file can still be read after another worker evicts it.
+        """
+
+        try:
+            file = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(file.fileno())
+        return file
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self.lock:
+            if self.size is None:
+                self.size = self._scan_size()
+            else:
+                self.size += len(data)
+            if self.size > current_app.config['IMAGE_CACHE_MAX_BYTES']:
+                self._evict()
+
+        return path
+
+    def _entries(self):
+        folder = current_app.config['IMAGE_CACHE_DIR']
+        for entry in os.scandir(folder):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                yield entry
+
+    def _scan_size(self):
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _evict(self):
+        """Delete oldest files until 90% full (other workers share the dir)."""
+
+        target = current_app.config['IMAGE_CACHE_MAX_BYTES'] * 0.9
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in entries)
+
+        for entry in entries:
+            if size <= target:
+                break
+            try:
+                size -= entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+        self.size = size
+
+
+disk_cache = DiskCache()
+
+
+@images.route('/images/<int:width>/<sig>.jpg')
+def resized_image(width, sig):
+    """Serve the source image (?src=) scaled to width."""
+
+    url = request.args.get('src', '')
+    config = current_app.config
+
+    if width not in config['IMAGE_WIDTHS'] or not hmac.compare_digest(
+            sig, sign(url)):
+        abort(404)
+
+    key = hashlib.sha256(url.encode()).hexdigest()
+    file = disk_cache.get(f"{key}-{width}.jpg")
+
+    if file is None:
+        try:
+            data = fetch(url, config['IMAGE_MAX_SOURCE_BYTES'])
+            resized = resize(data, config['IMAGE_WIDTHS'],
+                             config['IMAGE_MAX_PIXELS'])
+        except ImageError:
+            abort(404)
+
+        # one fetch fills every width the srcset will ask for
+        for w, jpeg in resized.items():
+            disk_cache.put(f"{key}-{w}.jpg", jpeg)
+        file = io.BytesIO(resized[width])
+
+    resp = send_file(file, mimetype='image/jpeg', cache_timeout=ONE_YEAR)
+    resp.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+    return resp
@@ -0,0 +1,545 @@
+"""Bulk import commands for Flask Cafe."""
+
+import csv
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED
+
+import bcrypt
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.datastructures import MultiDict
+
+from forms import CafeAddEditForm, SignupForm
+from hours import parse_hours
+from mapping import save_map
+from models import db, record_change, Cafe, City, User
+from snapshot import catalog
+import stats
+
+cafes_cli = AppGroup('cafes', help="Manage cafes.")
+users_cli = AppGroup('users', help="Manage users.")
+
+CAFE_FIELDS = ('name', 'description', 'url', 'address', 'city_code',
+               'hours', 'image_url')
+
+USER_FIELDS = ('username', 'email', 'first_name', 'last_name',
+               'description', 'image_url')
+
+# bcrypt ignores anything past this many bytes; newer versions refuse it
+MAX_PASSWORD_BYTES = 72
+
+
+#######################################
+# reading input / reporting
+
+
+def read_records(file, fmt):
+    """Yield (line number, record, errors) for each record of a
+    CSV/JSON/JSONL file.
+
+    CSV and JSON Lines are streamed; a JSON array is loaded whole. A JSON
+    Lines line that isn't JSON is yielded as read, with errors saying
+    why; other errors are None. JSON records may be anything; see
+    record_errors.
+    """
+
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row, None
+
+    elif fmt == 'jsonl':
+        for line_num, line in enumerate(file, start=1):
+            if line.strip():
+                try:
+                    yield line_num, json.loads(line), None
+                except ValueError as e:
+                    yield (line_num, line.rstrip('\n'),
+                           {"record": [f"Not valid JSON: {e}"]})
+
+    else:
+        for line_num, row in enumerate(json.load(file), start=1):
+            yield line_num, row, None
+
+
+def record_errors(row):
+    """Return errors if row isn't an object of fields, else None."""
+
+    if not isinstance(row, dict):
+        return {"record": ["Not an object."]}
+    return None
+
+
+def guess_format(path):
+    """Guess input format from file extension (default: csv)."""
+
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    return {'json': 'json', 'jsonl': 'jsonl', 'ndjson': 'jsonl'}.get(ext, 'csv')
+
+
+class Progress:
+    """Counts processed/rejected rows and reports throughput."""
+
+    def __init__(self, label):
+        self.label = label
+        self.start = time.perf_counter()
+        self.done = 0
+        self.rejected = 0
+
+    @property
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.done / elapsed if elapsed else 0.0
+
+    def report(self, final=False):
+        prefix = "Done:" if final else "..."
+        click.echo(
+            f"{prefix} {self.done} {self.label} imported, "
+            f"{self.rejected} rejected ({self.rate:.0f} rows/s)")
+
+
+class RejectWriter:
+    """Writes rejected rows, with reasons, as JSON Lines (opened lazily)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def write(self, line_num, row, errors):
+        if self.file is None:
+            self.file = open(self.path, 'w')
+        record = {"line": line_num, "row": row, "errors": errors}
+        self.file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def batched(iterable, size):
+    """Yield lists of up to `size` items from iterable."""
+
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+#######################################
+# cafes
+
+
+def validate_cafe(row, registry, city_names):
+    """Return (values, errors) for an input row, using the cafe form rules.
+
+    Rows may give either `city_code` or a `city` name.
+    """
+
+    errors = record_errors(row)
+    if errors:
+        return None, errors
+
+    data = {field: str(row.get(field) or '').strip() for field in CAFE_FIELDS}
+    if not data['city_code'] and row.get('city'):
+        data['city_code'] = city_names.get(str(row['city']).strip().lower(), '')
+
+    form = CafeAddEditForm(formdata=MultiDict(data), meta={'csrf': False})
+    form.city_code.choices = registry.choices
+
+    if not form.validate():
+        return None, form.errors
+
+    values = {field: form[field].data for field in CAFE_FIELDS}
+    values['description'] = values['description'] or ''
+    values['url'] = values['url'] or ''
+    values['image_url'] = values['image_url'] or Cafe._default_img
+    values['hours'] = values['hours'] or ''
+    values['hours_bitmap'] = (
+        parse_hours(values['hours']) if values['hours'] else None)
+
+    if row.get('id'):
+        try:
+            values['id'] = int(row['id'])
+        except (TypeError, ValueError):
+            return None, {"id": ["Not a valid integer."]}
+
+    return values, None
+
+
+def upsert_cafes(values):
+    """Insert (or update, for rows with an id) a batch of cafes.
+
+    Returns [(id, address, city_code)] for the written rows.
+    """
+
+    table = Cafe.__table__
+    returning = (table.c.id, table.c.address, table.c.city_code)
+    written = []
+
+    # one statement can't touch a row twice; the last row for an id wins
+    with_id = list({v['id']: v for v in values if 'id' in v}.values())
+    without_id = [v for v in values if 'id' not in v]
+
+    if with_id:
+        stmt = insert(table).values(with_id)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_=dict(
+                {field: stmt.excluded[field]
+                 for field in CAFE_FIELDS + ('hours_bitmap',)},
+                updated_at=db.func.timezone('utc', db.func.now())),
+        ).returning(*returning)
+        written.extend(db.session.execute(stmt).fetchall())
+
+        # explicit ids don't advance the serial; keep it past them
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('cafes', 'id'), "
+            "(SELECT max(id) FROM cafes))")
+
+    if without_id:
+        stmt = insert(table).values(without_id).returning(*returning)
+        written.extend(db.session.execute(stmt).fetchall())
+
+    for cafe_id, address, city_code in written:
+        record_change(db.session, 'cafes', cafe_id)
+
+    return written
+
+
+class MapRenderer:
+    """Renders cafe maps on a bounded thread pool.
+
+    At most `workers` requests are in flight and at most `workers * 4`
+    are queued, so a huge import doesn't pile up pending work.
+    """
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = workers * 4
+        self.pending = set()
+        self.rendered = 0
+        self.failed = 0
+
+    def submit(self, cafe_id, address, city, state):
+        while len(self.pending) >= self.max_pending:
+            self._collect(FIRST_COMPLETED)
+        self.pending.add(
+            self.executor.submit(save_map, cafe_id, address, city, state))
+
+    def _collect(self, return_when):
+        done, self.pending = wait(self.pending, return_when=return_when)
+        for future in done:
+            if future.exception():
+                self.failed += 1
+            else:
+                self.rendered += 1
+
+    def close(self):
+        if self.pending:
+            self._collect(ALL_COMPLETED)
+        self.executor.shutdown()
+
+
+@cafes_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json', 'jsonl']),
+              help="Input format (default: from file extension).")
+@click.option('--batch-size', default=500, show_default=True,
+              help="Rows per INSERT/commit.")
+@click.option('--map-workers', default=8, show_default=True,
+              help="Maps to fetch concurrently.")
+@click.option('--maps/--no-maps', default=True,
+              help="Render MapQuest maps for imported cafes.")
+@click.option('--rejects', type=click.Path(dir_okay=False),
+              help="Where to write rejected rows (default: PATH.rejects.jsonl).")
+def import_cafes(path, fmt, batch_size, map_workers, maps, rejects):
+    """Import cafes from a CSV, JSON or JSON Lines file.
+
+    Rows are validated like the add cafe form; rows with an `id` update
+    that cafe, others are added.
+    """
+
+    fmt = fmt or guess_format(path)
+    rejects = RejectWriter(rejects or f"{path}.rejects.jsonl")
+    progress = Progress("cafes")
+    renderer = MapRenderer(map_workers) if maps else None
+
+    registry = City.get_registry()
+    city_names = {name.lower(): code
+                  for code, (name, state) in registry.cities.items()}
+    cities = set()
+
+    try:
+        with open(path, newline='') as file:
+            records = read_records(file, fmt)
+
+            for batch in batched(records, batch_size):
+                values = []
+                for line_num, row, errors in batch:
+                    if not errors:
+                        cafe, errors = validate_cafe(
+                            row, registry, city_names)
+                    if errors:
+                        rejects.write(line_num, row, errors)
+                        progress.rejected += 1
+                    else:
+                        values.append(cafe)
+
+                written = upsert_cafes(values) if values else []
+                db.session.commit()
+                progress.done += len(written)
+
+                if renderer:
+                    for cafe_id, address, city_code in written:
+                        name, state = registry.cities[city_code]
+                        renderer.submit(cafe_id, address, name, state)
+                        cities.add(city_code)
+
+                progress.report()
+    finally:
+        rejects.close()
+        if renderer:
+            renderer.close()
+
+    progress.report(final=True)
+    if current_app.config['CATALOG_SNAPSHOT']:
+        catalog.rebuild()
+    stats.refresh()
+    db.session.commit()
+    if renderer:
+        click.echo(f"Maps: {renderer.rendered} rendered, "
+                   f"{renderer.failed} failed")
+        save_city_maps(sorted(cities))
+    if progress.rejected:
+        click.echo(f"Rejected rows written to {rejects.path}")
+
+
+def save_city_maps(codes):
+    """Redraw the overview maps of these cities, reporting each."""
+
+    for code in codes:
+        try:
+            count = City.query.get(code).save_map()
+        except Exception as e:
+            click.echo(f"{code}: map failed ({e})")
+        else:
+            click.echo(f"{code}: {count} map(s)")
+
+
+@cafes_cli.command('city-maps')
+@click.argument('codes', nargs=-1)
+def city_maps(codes):
+    """Draw overview maps of the cities CODES (default: all cities).
+
+    Maps are only fetched for cities whose cafes moved since last time.
+    """
+
+    save_city_maps(codes or sorted(City.get_registry().cities))
+
+
+#######################################
+# users
+
+
+def validate_user(row, seen):
+    """Return (values, errors) for an input row, using the signup form
+    rules; `seen` holds the (lowercased) usernames read so far."""
+
+    errors = record_errors(row)
+    if errors:
+        return None, errors
+
+    data = {field: str(row.get(field) or '').strip() for field in USER_FIELDS}
+    data['password'] = str(row.get('password') or '')
+
+    form = SignupForm(formdata=MultiDict(data), meta={'csrf': False})
+    if not form.validate():
+        return None, form.errors
+    if len(data['password'].encode('utf8')) > MAX_PASSWORD_BYTES:
+        return None, {"password": [
+            f"Longer than {MAX_PASSWORD_BYTES} bytes."]}
+
+    # logins are case-insensitive, so usernames must be too
+    key = data['username'].lower()
+    if key in seen:
+        return None, {"username": ["Repeats an earlier row."]}
+    seen.add(key)
+
+    values = {field: form[field].data for field in USER_FIELDS}
+    values['description'] = values['description'] or ''
+    values['image_url'] = values['image_url'] or User._default_img
+    values['admin'] = False
+    values['password'] = data['password']
+    return values, None
+
+
+def taken_usernames(usernames):
+    """Return which of these (lowercased) usernames are already users."""
+
+    return {name for (name,) in db.session.query(db.func.lower(User.username))
+            .filter(db.func.lower(User.username).in_(usernames))}
+
+
+def hash_passwords(passwords, rounds, prefix):
+    """Return bcrypt hashes of passwords, as User.register makes them.
+
+    Runs in a worker process, so it can't use the app's Bcrypt object.
+    """
+
+    return [bcrypt.hashpw(password.encode('utf8'),
+                          bcrypt.gensalt(rounds, prefix)).decode('utf8')
+            for password in passwords]
+
+
+class PasswordHasher:
+    """Hashes batches of passwords on a process pool, one batch per task.
+
+    Up to `workers * 2` batches are in flight, so workers always have
+    the next batch queued while the caller inserts finished ones; next()
+    returns them in the order they were submitted.
+    """
+
+    def __init__(self, workers, rounds, prefix):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.max_pending = workers * 2
+        self.rounds = rounds
+        self.prefix = prefix
+        self.pending = deque()
+
+    def submit(self, batch):
+        """Hash the passwords of a batch of [(line, row, values)]."""
+
+        passwords = [values.pop('password') for line_num, row, values in batch]
+        future = self.executor.submit(
+            hash_passwords, passwords, self.rounds, self.prefix)
+        self.pending.append((batch, future))
+
+    def full(self):
+        return len(self.pending) >= self.max_pending
+
+    def next(self):
+        """Wait for the oldest batch; return it, with hashed_password set."""
+
+        batch, future = self.pending.popleft()
+        for (line_num, row, values), hashed in zip(batch, future.result()):
+            values['hashed_password'] = hashed
+        return batch
+
+    def close(self):
+        # after an error, don't wait for batches nobody will insert
+        for batch, future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+
+
+def insert_users(values):
+    """Insert a batch of users, skipping taken usernames.
+
+    Returns the (lowercased) usernames inserted.
+    """
+
+    table = User.__table__
+    # no conflict target: either unique index (exact or lowercased) counts
+    stmt = (insert(table).values(values).on_conflict_do_nothing()
+            .returning(table.c.id, table.c.username))
+
+    inserted = set()
+    for user_id, username in db.session.execute(stmt):
+        record_change(db.session, 'users', user_id)
+        inserted.add(username.lower())
+    return inserted
+
+
+@users_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json', 'jsonl']),
+              help="Input format (default: from file extension).")
+@click.option('--batch-size', default=100, show_default=True,
+              help="Passwords per hashing task; rows per INSERT/commit.")
+@click.option('--workers', type=int,
+              help="Hashing processes (default: one per CPU).")
+@click.option('--rejects', type=click.Path(dir_okay=False),
+              help="Where to write rejected rows (default: PATH.rejects.jsonl).")
+def import_users(path, fmt, batch_size, workers, rejects):
+    """Import users from a CSV, JSON or JSON Lines file.
+
+    Rows are validated like the signup form. Passwords are hashed on a
+    process pool while finished batches are inserted; rows whose
+    username is taken are rejected.
+    """
+
+    config = current_app.config
+    fmt = fmt or guess_format(path)
+    rejects = RejectWriter(rejects or f"{path}.rejects.jsonl")
+    progress = Progress("users")
+    hasher = PasswordHasher(workers or os.cpu_count(),
+                            config.get('BCRYPT_LOG_ROUNDS', 12),
+                            config.get('BCRYPT_HASH_PREFIX', '2b').encode())
+    seen = set()
+
+    def reject_taken(batch, taken):
+        kept = []
+        for line_num, row, values in batch:
+            if values['username'].lower() in taken:
+                rejects.write(line_num, row,
+                              {"username": ["Username already taken."]})
+                progress.rejected += 1
+            else:
+                kept.append((line_num, row, values))
+        return kept
+
+    def insert_next():
+        batch = hasher.next()
+        inserted = insert_users([values for line_num, row, values in batch])
+        db.session.commit()
+        progress.done += len(inserted)
+
+        # lost a race with another insert of the same username
+        reject_taken(batch, {values['username'].lower()
+                             for line_num, row, values in batch} - inserted)
+        progress.report()
+
+    try:
+        with open(path, newline='') as file:
+            records = read_records(file, fmt)
+
+            for records_batch in batched(records, batch_size):
+                batch = []
+                for line_num, row, errors in records_batch:
+                    if not errors:
+                        values, errors = validate_user(row, seen)
+                    if errors:
+                        rejects.write(line_num, row, errors)
+                        progress.rejected += 1
+                    else:
+                        batch.append((line_num, row, values))
+
+                # don't spend CPU hashing passwords we can't insert
+                batch = reject_taken(batch, taken_usernames(
+                    [values['username'].lower()
+                     for line_num, row, values in batch]))
+                if batch:
+                    hasher.submit(batch)
+
+                while hasher.full():
+                    insert_next()
+
+            while hasher.pending:
+                insert_next()
+    finally:
+        rejects.close()
+        hasher.close()
+
+    progress.report(final=True)
+    if progress.rejected:
+        click.echo(f"Rejected rows written to {rejects.path}")
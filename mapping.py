@@ -1,15 +1,23 @@
 """Mapping APIs for Flask Cafe"""
 
-import requests
+import hashlib
+import json
 import os
+from urllib.parse import quote
 
-from config import MAPQUEST_API_KEY
+from config import MAPQUEST_API_KEY, MAPQUEST_BASE_URL
+
+# most markers MapQuest draws on one static map
+MAX_MAP_LOCATIONS = 100
+
+CITY_MAPS_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), 'static', 'maps', 'cities')
 
 
 def get_map_url(address, city, state):
     """Get MapQuest URL for a static map for this location"""
 
-    base = f"https://www.mapquestapi.com/staticmap/v5/map?key={MAPQUEST_API_KEY}"
+    base = f"{MAPQUEST_BASE_URL}/staticmap/v5/map?key={MAPQUEST_API_KEY}"
     where = f"{address},{city},{state}"
     return f"{base}&center={where}&size=@2x&zoom=15&locations={where}"
 
@@ -17,6 +25,9 @@ def get_map_url(address, city, state):
 def save_map(id, address, city, state):
     """Get static map and save in static/maps directory of this app"""
 
+    # requests is slow to import and only needed when maps change
+    import requests
+
     url = get_map_url(address, city, state)
     response = requests.get(url)
 
@@ -24,3 +35,81 @@ def save_map(id, address, city, state):
 
     with open(f"{path}/static/maps/{id}.jpg", "wb") as file:
         file.write(response.content)
+
+
+def get_city_map_url(locations):
+    """Get MapQuest URL for a static map with a marker at each location.
+
+    With no center or zoom, the map is fitted around the markers.
+    """
+
+    base = f"{MAPQUEST_BASE_URL}/staticmap/v5/map?key={MAPQUEST_API_KEY}"
+    where = '||'.join(quote(location, safe=',') for location in locations)
+    return f"{base}&size=@2x&locations={where}"
+
+
+def get_city_map_count(code):
+    """Return how many overview maps city `code` has (0 if none yet)."""
+
+    try:
+        with open(os.path.join(CITY_MAPS_DIR, f"{code}.json")) as file:
+            return json.load(file)['maps']
+    except FileNotFoundError:
+        return 0
+
+
+def save_city_maps(code, addresses, city, state):
+    """Save overview maps of these cafe addresses in a city.
+
+    Each map shows up to MAX_MAP_LOCATIONS cafes; they're saved as
+    static/maps/cities/<code>-<n>.jpg, n from 1. The manifest keeps a
+    digest of each map's addresses, and only maps whose addresses changed
+    since last time are fetched. Returns the map count.
+    """
+
+    locations = [f"{address},{city},{state}" for address in addresses]
+    chunks = [locations[i:i + MAX_MAP_LOCATIONS]
+              for i in range(0, len(locations), MAX_MAP_LOCATIONS)]
+    digests = [hashlib.sha256('\n'.join(chunk).encode()).hexdigest()
+               for chunk in chunks]
+
+    def map_path(n):
+        return os.path.join(CITY_MAPS_DIR, f"{code}-{n}.jpg")
+
+    manifest_path = os.path.join(CITY_MAPS_DIR, f"{code}.json")
+    try:
+        with open(manifest_path) as file:
+            saved = json.load(file).get('digests', [])
+    except FileNotFoundError:
+        saved = []
+
+    # cafes are in id order, so a new cafe only changes the last map
+    changed = [n for n, digest in enumerate(digests, start=1)
+               if saved[n - 1:n] != [digest]
+               or not os.path.exists(map_path(n))]
+
+    if changed:
+        # requests is slow to import and only needed when maps change
+        import requests
+
+        os.makedirs(CITY_MAPS_DIR, exist_ok=True)
+
+        with requests.Session() as http:
+            for n in changed:
+                response = http.get(get_city_map_url(chunks[n - 1]),
+                                    timeout=30)
+                response.raise_for_status()
+                with open(map_path(n), "wb") as file:
+                    file.write(response.content)
+
+    # drop maps left over from when the city had more cafes
+    n = len(chunks) + 1
+    while os.path.exists(map_path(n)):
+        os.remove(map_path(n))
+        n += 1
+
+    if digests != saved:
+        with open(manifest_path, "w") as file:
+            json.dump({"digests": digests, "maps": len(chunks)}, file)
+
+    return len(chunks)
@@ -0,0 +1,52 @@
+"""Alembic environment: migrates the current Flask app's database.
+
+Run migrations with `flask db upgrade` (see schema.py), which provides
+the app context this needs.
+"""
+
+from alembic import context
+from flask import current_app
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from models import db
+
+config = context.config
+target_metadata = db.metadata
+
+
+def get_url():
+    return (config.attributes.get('url')
+            or current_app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+def run_migrations_offline():
+    """Print the SQL instead of running it (`flask db upgrade --sql`)."""
+
+    context.configure(url=get_url(), target_metadata=target_metadata,
+                      literal_binds=True)
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    engine = create_engine(get_url(), poolclass=NullPool)
+
+    with engine.connect() as connection:
+        # give up on a lock rather than queue every query behind us
+        connection.execute("SET lock_timeout = '5s'")
+
+        context.configure(connection=connection,
+                          target_metadata=target_metadata,
+                          transaction_per_migration=True,
+                          compare_type=True)
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
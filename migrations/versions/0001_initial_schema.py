@@ -0,0 +1,71 @@
+"""Initial schema
+
+The tables as db.create_all() made them before migrations. To adopt
+migrations on such a database, run `flask db stamp 0001` once, then
+`flask db upgrade`.
+
+Revision ID: 0001
+Revises:
+Create Date: 2020-03-02 10:12:41.528310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cities',
+        sa.Column('code', sa.Text(), nullable=False),
+        sa.Column('name', sa.Text(), nullable=False),
+        sa.Column('state', sa.String(length=2), nullable=False),
+        sa.PrimaryKeyConstraint('code'),
+    )
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.Text(), nullable=False),
+        sa.Column('admin', sa.Boolean(), nullable=False),
+        sa.Column('email', sa.Text(), nullable=False),
+        sa.Column('first_name', sa.Text(), nullable=False),
+        sa.Column('last_name', sa.Text(), nullable=False),
+        sa.Column('description', sa.Text(), nullable=False),
+        sa.Column('image_url', sa.Text(), nullable=False),
+        sa.Column('hashed_password', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username'),
+    )
+    op.create_table(
+        'cafes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.Text(), nullable=False),
+        sa.Column('description', sa.Text(), nullable=False),
+        sa.Column('url', sa.Text(), nullable=False),
+        sa.Column('address', sa.Text(), nullable=False),
+        sa.Column('city_code', sa.Text(), nullable=False),
+        sa.Column('image_url', sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(['city_code'], ['cities.code']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'likes',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('cafe_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['cafe_id'], ['cafes.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('user_id', 'cafe_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('likes')
+    op.drop_table('cafes')
+    op.drop_table('users')
+    op.drop_table('cities')
@@ -0,0 +1,84 @@
+"""City time zones, cafe hours, trending scores and update times
+
+Columns with constant or now() defaults don't rewrite their tables
+(PostgreSQL 11+): existing likes and cafes get the migration's time as
+created_at/updated_at. Scores start at 0, so run `flask trending
+rebuild` afterwards. Indexes are built CONCURRENTLY, as in 0003.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2020-03-02 11:05:19.664082
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_cafes_city_code_name', 'cafes', ['city_code', 'name']),
+    ('ix_cafes_trending_score', 'cafes', ['trending_score']),
+    ('ix_cafes_updated_at', 'cafes', ['updated_at']),
+]
+
+
+def index_state(name):
+    """True if index `name` is valid, False if invalid, None if missing."""
+
+    if context.is_offline_mode():
+        return None
+    return op.get_bind().execute(
+        "SELECT indisvalid FROM pg_index"
+        " WHERE indexrelid = to_regclass(%s)", (name,)).scalar()
+
+
+def upgrade():
+    op.add_column('cities', sa.Column('timezone', sa.Text(),
+                                      server_default='UTC', nullable=False))
+    op.create_table(
+        'trending_epoch',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('epoch', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.add_column('cafes', sa.Column('trending_score', sa.Float(),
+                                     server_default='0', nullable=False))
+    op.add_column('cafes', sa.Column('hours', sa.Text(), server_default='',
+                                     nullable=False))
+    op.add_column('cafes', sa.Column('hours_bitmap', sa.LargeBinary(),
+                                     nullable=True))
+    op.add_column('cafes', sa.Column(
+        'updated_at', sa.DateTime(),
+        server_default=sa.text("timezone('utc', now())"), nullable=False))
+    op.add_column('likes', sa.Column(
+        'created_at', sa.DateTime(),
+        server_default=sa.text("timezone('utc', now())"), nullable=False))
+
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            state = index_state(name)
+            if state:
+                continue
+            if state is False:
+                op.execute(f"DROP INDEX CONCURRENTLY {name}")
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
+    op.drop_column('likes', 'created_at')
+    op.drop_column('cafes', 'updated_at')
+    op.drop_column('cafes', 'hours_bitmap')
+    op.drop_column('cafes', 'hours')
+    op.drop_column('cafes', 'trending_score')
+    op.drop_table('trending_epoch')
+    op.drop_column('cities', 'timezone')
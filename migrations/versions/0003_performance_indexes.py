@@ -0,0 +1,67 @@
+"""Indexes for the cafe list, reverse like lookups and logins
+
+Built CONCURRENTLY, so the tables stay writable meanwhile. A concurrent
+build that fails leaves an INVALID index behind; it's dropped and
+rebuilt on the next run.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2020-03-02 11:40:07.203518
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    # /cafes lists by name (id breaks ties, for stable pages)
+    ('ix_cafes_name_id', 'cafes', ['name', 'id'], False),
+    # cafe.liking_users; the primary key only helps lookups by user
+    ('ix_likes_cafe_id', 'likes', ['cafe_id'], False),
+    # logins match usernames case-insensitively
+    ('ix_users_username_lower', 'users', [sa.text('lower(username)')], True),
+]
+
+
+def index_state(name):
+    """True if index `name` is valid, False if invalid, None if missing."""
+
+    if context.is_offline_mode():
+        return None
+    return op.get_bind().execute(
+        "SELECT indisvalid FROM pg_index"
+        " WHERE indexrelid = to_regclass(%s)", (name,)).scalar()
+
+
+def upgrade():
+    if not context.is_offline_mode():
+        taken = op.get_bind().execute(
+            "SELECT lower(username) FROM users"
+            " GROUP BY 1 HAVING count(*) > 1 LIMIT 5").fetchall()
+        if taken:
+            raise RuntimeError(
+                "Usernames differing only in case must be renamed first: "
+                + ", ".join(name for (name,) in taken))
+
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in INDEXES:
+            state = index_state(name)
+            if state:
+                continue
+            if state is False:
+                op.execute(f"DROP INDEX CONCURRENTLY {name}")
+            op.create_index(name, table, columns, unique=unique,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
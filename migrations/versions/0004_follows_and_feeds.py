@@ -0,0 +1,75 @@
+"""Follows and activity feeds
+
+Adding users.follower_count with a constant default doesn't rewrite the
+table (PostgreSQL 11+). The index on likes is built CONCURRENTLY, as in
+0003.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2020-03-09 15:02:33.871204
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def index_state(name):
+    """True if index `name` is valid, False if invalid, None if missing."""
+
+    if context.is_offline_mode():
+        return None
+    return op.get_bind().execute(
+        "SELECT indisvalid FROM pg_index"
+        " WHERE indexrelid = to_regclass(%s)", (name,)).scalar()
+
+
+def upgrade():
+    op.add_column('users', sa.Column('follower_count', sa.Integer(),
+                                     server_default='0', nullable=False))
+    op.create_table(
+        'follows',
+        sa.Column('follower_id', sa.Integer(), nullable=False),
+        sa.Column('followed_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(),
+                  server_default=sa.text("timezone('utc', now())"),
+                  nullable=False),
+        sa.ForeignKeyConstraint(['followed_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['follower_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('follower_id', 'followed_id'),
+    )
+    op.create_index('ix_follows_followed_id', 'follows', ['followed_id'])
+    op.create_table(
+        'feed_items',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('liked_at', sa.DateTime(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('cafe_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('user_id', 'liked_at', 'actor_id',
+                                'cafe_id'),
+    )
+
+    with op.get_context().autocommit_block():
+        state = index_state('ix_likes_user_id_created_at')
+        if state is False:
+            op.execute("DROP INDEX CONCURRENTLY ix_likes_user_id_created_at")
+        if not state:
+            op.create_index('ix_likes_user_id_created_at', 'likes',
+                            ['user_id', 'created_at'],
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_likes_user_id_created_at', table_name='likes',
+                      postgresql_concurrently=True)
+    op.drop_table('feed_items')
+    op.drop_index('ix_follows_followed_id', table_name='follows')
+    op.drop_table('follows')
+    op.drop_column('users', 'follower_count')
@@ -0,0 +1,59 @@
+"""Per-city statistics for the admin dashboard
+
+A materialized view, so creating it computes it once, reading every
+like. Later refreshes run CONCURRENTLY (`flask stats refresh`), which
+needs the unique index.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2020-03-16 10:21:48.530917
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+CREATE MATERIALIZED VIEW city_stats AS
+WITH cafe_likes AS (
+    SELECT cafes.id, cafes.city_code, count(likes.cafe_id) AS likes
+    FROM cafes LEFT JOIN likes ON likes.cafe_id = cafes.id
+    GROUP BY cafes.id
+)
+SELECT cities.code AS city_code,
+       coalesce(counts.cafes, 0) AS cafe_count,
+       coalesce(counts.likes, 0) AS like_count,
+       top.id AS top_cafe_id,
+       top.likes AS top_cafe_likes,
+       coalesce(active.users, 0) AS active_users,
+       timezone('utc', now()) AS refreshed_at
+FROM cities
+LEFT JOIN (
+    SELECT city_code, count(*) AS cafes, CAST(sum(likes) AS bigint) AS likes
+    FROM cafe_likes GROUP BY city_code
+) counts ON counts.city_code = cities.code
+LEFT JOIN LATERAL (
+    SELECT id, likes FROM cafe_likes
+    WHERE city_code = cities.code AND likes > 0
+    ORDER BY likes DESC, id LIMIT 1
+) top ON true
+LEFT JOIN (
+    SELECT cafes.city_code, count(DISTINCT likes.user_id) AS users
+    FROM likes JOIN cafes ON cafes.id = likes.cafe_id
+    WHERE likes.created_at > timezone('utc', now()) - interval '30 days'
+    GROUP BY cafes.city_code
+) active ON active.city_code = cities.code
+""")
+    op.execute("CREATE UNIQUE INDEX ix_city_stats_city_code"
+               " ON city_stats (city_code)")
+
+
+def downgrade():
+    op.execute("DROP MATERIALIZED VIEW city_stats")
@@ -1,12 +1,25 @@
 """Data models for Flask Cafe"""
 
+from collections import defaultdict
+
+from blinker import Namespace
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, validates
 
-from mapping import save_map
+from hours import LOCAL_SLOTS_SQL, parse_hours, slot_at
+from mapping import save_city_maps, save_map
+from routing import RoutingSQLAlchemy
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+_signals = Namespace()
+
+# Sent after every commit/rollback that touched a table, with
+# changes={tablename: set of primary keys}. A key of None means rows we
+# can't name changed (bulk update/delete), so treat the whole table as stale.
+tables_changed = _signals.signal('tables-changed')
 
 
 class City(db.Model):
@@ -17,15 +30,92 @@ class City(db.Model):
     code = db.Column(db.Text, primary_key=True)
     name = db.Column(db.Text, nullable=False)
     state = db.Column(db.String(2), nullable=False)
+    # IANA name, e.g. 'America/Los_Angeles'; cafe hours are local to it
+    timezone = db.Column(db.Text, nullable=False, default='UTC',
+                         server_default='UTC')
+
+    # process-wide CityRegistry; loaded on first use, cleared on City writes
+    _registry = None
 
     def __repr__(self):
         return f'<City code={self.code}, name={self.name}, state={self.state}>'
 
+    @classmethod
+    def get_registry(cls):
+        """Return the in-memory CityRegistry, loading it if needed."""
+
+        registry = cls._registry
+        if registry is None:
+            rows = (db.session.query(
+                        cls.code, cls.name, cls.state, cls.timezone)
+                    .order_by(cls.name)
+                    .all())
+            registry = cls._registry = CityRegistry(rows)
+        return registry
+
+    @classmethod
+    def clear_registry(cls):
+        """Forget the cached registry; next use reloads it from the db."""
+
+        cls._registry = None
+
+    @classmethod
+    def get_local_slots(cls, at=None):
+        """Return {city code: slot of the week (hours.py)} at instant `at`
+        (default now), each in the city's time zone."""
+
+        timezones = cls.get_registry().timezones
+        if not timezones:
+            return {}
+
+        # the database does the conversion, once per zone in use
+        slots = dict(db.session.execute(
+            LOCAL_SLOTS_SQL,
+            {"at": at, "timezones": sorted(set(timezones.values()))}
+        ).fetchall())
+        return {code: slots[tz] for code, tz in timezones.items()}
+
     @classmethod
     def get_city_codes(cls):
         """Get a list of city codes"""
 
-        return [(city.code, city.name) for city in City.query.order_by('name').all()]
+        return list(cls.get_registry().choices)
+
+    def get_map_addresses(self):
+        """Get the addresses of this city's cafes, in overview map order"""
+
+        return [address for (address,) in (
+            db.session.query(Cafe.address)
+            .filter_by(city_code=self.code)
+            .order_by(Cafe.id))]
+
+    def save_map(self):
+        """Save overview map(s) of this city's cafes; return how many."""
+
+        return save_city_maps(self.code, self.get_map_addresses(),
+                              self.name, self.state)
+
+
+class CityRegistry:
+    """Read-only snapshot of the cities table.
+
+    Cities almost never change, so this is loaded once per process and
+    serves city lookups for forms and templates without a query.
+    """
+
+    def __init__(self, rows):
+        self.cities = {code: (name, state) for code, name, state, tz in rows}
+        self.timezones = {code: tz for code, name, state, tz in rows}
+        self.choices = [(code, name) for code, name, state, tz in rows]
+
+    def __contains__(self, code):
+        return code in self.cities
+
+    def get_city_state(self, code):
+        """Return 'city, state' for city code."""
+
+        name, state = self.cities[code]
+        return f'{name}, {state}'
 
 
 class Cafe(db.Model):
@@ -33,6 +123,15 @@ class Cafe(db.Model):
 
     _default_img = "/static/images/default-cafe.jpg"
     __tablename__ = 'cafes'
+    __table_args__ = (
+        # city filter on the cafe list, in list order
+        db.Index('ix_cafes_city_code_name', 'city_code', 'name'),
+        # the cafe list's order
+        db.Index('ix_cafes_name_id', 'name', 'id'),
+    )
+
+    # process-wide {city code: number of cafes}; cleared on Cafe writes
+    _city_counts = None
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text, nullable=False)
@@ -49,6 +148,26 @@ class Cafe(db.Model):
         nullable=False,
         default=_default_img
     )
+    # time-decayed like count; see trending.py
+    trending_score = db.Column(
+        db.Float,
+        nullable=False,
+        default=0,
+        server_default='0',
+        index=True
+    )
+    # weekly opening hours as entered (see hours.py), and the bitmap of
+    # open 15-minute slots that "open now" filters test
+    hours = db.Column(db.Text, nullable=False, default='', server_default='')
+    hours_bitmap = db.Column(db.LargeBinary)
+    # last edit; `flask freeze` re-renders cafes changed since its last run
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.timezone('utc', db.func.now()),
+        onupdate=db.func.timezone('utc', db.func.now()),
+        index=True
+    )
 
     city = db.relationship('City', backref='cafes')
 
@@ -61,16 +180,71 @@ class Cafe(db.Model):
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
 
+    @classmethod
+    def get_city_counts(cls):
+        """Return {city code: number of cafes}, counted once and cached."""
+
+        counts = cls._city_counts
+        if counts is None:
+            rows = (db.session.query(cls.city_code, db.func.count())
+                    .group_by(cls.city_code)
+                    .all())
+            counts = cls._city_counts = dict(rows)
+        return counts
+
+    @validates('hours')
+    def _set_hours_bitmap(self, key, hours):
+        self.hours_bitmap = parse_hours(hours) if hours else None
+        return hours
+
+    @classmethod
+    def open_at(cls, at=None):
+        """Return a filter for cafes open at datetime `at`.
+
+        An aware `at` (or None, for now) is an instant, seen in each
+        cafe's city time zone; a naive one is local time wherever the
+        cafe is. Cafes without hours never match.
+        """
+
+        def open_in(slot):
+            return db.func.get_bit(cls.hours_bitmap, slot) == 1
+
+        if at is not None and at.tzinfo is None:
+            return db.and_(cls.hours_bitmap.isnot(None), open_in(slot_at(at)))
+
+        # cities in the same slot share one bit test, and no join
+        by_slot = defaultdict(list)
+        for code, slot in City.get_local_slots(at).items():
+            by_slot[slot].append(code)
+        if not by_slot:
+            return db.false()
+
+        return db.and_(cls.hours_bitmap.isnot(None), db.or_(*(
+            db.and_(cls.city_code.in_(codes), open_in(slot))
+            for slot, codes in by_slot.items())))
+
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
+        registry = City.get_registry()
+        if self.city_code in registry:
+            return registry.get_city_state(self.city_code)
+
+        # city newer than our registry (e.g. added by another process)
+        City.clear_registry()
         city = self.city
         return f'{city.name}, {city.state}'
 
     def save_map(self):
         """Save map for this cafe."""
 
-        save_map(self.id, self.address, self.city.name, self.city.state)
+        registry = City.get_registry()
+        if self.city_code in registry:
+            name, state = registry.cities[self.city_code]
+        else:
+            name, state = self.city.name, self.city.state
+
+        save_map(self.id, self.address, name, state)
 
 
 class User(db.Model):
@@ -92,6 +266,18 @@ class User(db.Model):
         default=_default_img
     )
     hashed_password = db.Column(db.Text, nullable=False)
+    # kept by feed.follow/unfollow; decides how likes reach followers
+    follower_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    # read-only: follow with feed.follow(), which also fills the feed
+    following = db.relationship(
+        'User',
+        secondary='follows',
+        primaryjoin='User.id == Follow.follower_id',
+        secondaryjoin='User.id == Follow.followed_id',
+        order_by='User.username',
+        viewonly=True)
 
     def __repr__(self):
         return f'<User id={self.id} username="{self.username}">'
@@ -136,7 +322,9 @@ class User(db.Model):
         """Validate that user exists and password is correct.
         Return user if valid; else return False.
         """
-        u = User.query.filter_by(username=username).first()
+        # queries imports this module
+        from queries import find_login
+        u = find_login(username)
 
         if u and bcrypt.check_password_hash(u.hashed_password, password):
             # return user instance
@@ -145,20 +333,124 @@ class User(db.Model):
             return False
 
 
+# logins are case-insensitive, so usernames must be too
+db.Index('ix_users_username_lower', db.func.lower(User.username), unique=True)
+
+
 class Like(db.Model):
     """Likes for users liking cafes."""
 
     __tablename__ = 'likes'
+    __table_args__ = (
+        # a user's recent likes, for feeds
+        db.Index('ix_likes_user_id_created_at', 'user_id', 'created_at'),
+    )
 
     user_id = db.Column(
             db.Integer, db.ForeignKey('users.id'), primary_key=True)
     cafe_id = db.Column(
-            db.Integer, db.ForeignKey('cafes.id'), primary_key=True)
+            db.Integer, db.ForeignKey('cafes.id'), primary_key=True,
+            index=True)
+    created_at = db.Column(
+            db.DateTime,
+            nullable=False,
+            server_default=db.func.timezone('utc', db.func.now()))
 
     user = db.relationship('User', backref='likes')
     cafe = db.relationship('Cafe', backref='cafes')
 
 
+class Follow(db.Model):
+    """Users following other users."""
+
+    __tablename__ = 'follows'
+
+    follower_id = db.Column(
+            db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    followed_id = db.Column(
+            db.Integer, db.ForeignKey('users.id'), primary_key=True,
+            index=True)
+    created_at = db.Column(
+            db.DateTime,
+            nullable=False,
+            server_default=db.func.timezone('utc', db.func.now()))
+
+
+class FeedItem(db.Model):
+    """A like by someone a user follows, copied into the user's feed.
+
+    Derived from likes and follows (see feed.py), so no foreign keys: they
+    would only slow down fan-out.
+    """
+
+    __tablename__ = 'feed_items'
+
+    user_id = db.Column(db.Integer, primary_key=True)
+    liked_at = db.Column(db.DateTime, primary_key=True)
+    actor_id = db.Column(db.Integer, primary_key=True)
+    cafe_id = db.Column(db.Integer, primary_key=True)
+
+
+class TrendingEpoch(db.Model):
+    """Reference time for Cafe.trending_score (a single row, id 1)."""
+
+    __tablename__ = 'trending_epoch'
+
+    id = db.Column(db.Integer, primary_key=True)
+    epoch = db.Column(db.DateTime, nullable=False)
+
+
+#######################################
+# change tracking for in-process caches
+
+
+def record_change(session, table, key):
+    """Note that row `key` of `table` changed in this transaction."""
+
+    session.info.setdefault('changes', {}).setdefault(table, set()).add(key)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_flushed_rows(session, flush_context):
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        pk = inspect(obj).mapper.primary_key_from_instance(obj)
+        key = pk[0] if len(pk) == 1 else tuple(pk)
+        record_change(session, obj.__tablename__, key)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _track_bulk_rows(context):
+    record_change(context.session, context.mapper.local_table.name, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _send_committed_changes(session):
+    changes = session.info.pop('changes', None)
+    if changes:
+        tables_changed.send(session, changes=changes, committed=True)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _send_rolled_back_changes(session, previous_transaction):
+    # caches may have been refilled with rows that no longer exist
+    changes = session.info.pop('changes', None)
+    if changes:
+        tables_changed.send(session, changes=changes, committed=False)
+
+
+@tables_changed.connect
+def _clear_city_registry(sender, changes, **kwargs):
+    if 'cities' in changes:
+        City.clear_registry()
+
+
+@tables_changed.connect
+def _clear_city_counts(sender, changes, **kwargs):
+    if 'cafes' in changes or 'cities' in changes:
+        Cafe._city_counts = None
+
+
 def connect_db(app):
     """Connect this database to provided Flask app."""
     db.app = app
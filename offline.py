@@ -0,0 +1,88 @@
+"""Service worker, so repeat visits and likes work offline (/sw.js).
+
+The worker (templates/sw.js) precaches the files in MANIFEST_DIRS and
+the pinned libraries base.html loads (assets.LIBRARIES), in a cache named for the
+manifest's version; a deploy that changes any of them changes the
+version, so browsers install the new worker and drop the old cache.
+Write the manifest at build time with `flask offline manifest`; if it's
+missing, the first request for /sw.js writes it.
+
+Everything else it caches as it's used: fingerprinted files (maps,
+proxied images) cache-first, and catalog pages, which are shown from
+the cache only when the network fails.
+Likes made offline are queued and sent when the device is back online.
+"""
+
+import hashlib
+import json
+import os
+
+import click
+from flask import Blueprint, abort, current_app, render_template
+from flask.cli import AppGroup
+
+from assets import LIBRARIES, static_url
+
+offline = Blueprint('offline', __name__)
+offline_cli = AppGroup('offline', help="Manage the offline service worker.")
+
+# static/ subdirectories to precache (maps are many: cached when seen)
+MANIFEST_DIRS = ('js', 'images')
+
+
+def build_manifest():
+    """Return {'version', 'precache': [URL]} for the current files."""
+
+    urls = []
+    for directory in MANIFEST_DIRS:
+        root = os.path.join(current_app.static_folder, directory)
+        for name in sorted(os.listdir(root)):
+            if os.path.isfile(os.path.join(root, name)):
+                urls.append(static_url(f"{directory}/{name}"))
+    urls += LIBRARIES
+
+    version = hashlib.sha256(json.dumps(urls).encode()).hexdigest()[:10]
+    return {'version': version, 'precache': urls}
+
+
+def write_manifest():
+    manifest = build_manifest()
+    path = current_app.config['SERVICE_WORKER_MANIFEST']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+    return manifest
+
+
+def load_manifest():
+    """Return the manifest written at build time, writing it if missing."""
+
+    try:
+        with open(current_app.config['SERVICE_WORKER_MANIFEST']) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return write_manifest()
+
+
+@offline.route('/sw.js')
+def service_worker():
+    """Serve the worker from the root, so it controls every page."""
+
+    if not current_app.config['SERVICE_WORKER']:
+        abort(404)
+
+    body = render_template('sw.js', manifest=load_manifest())
+    # browsers check for a new worker at most daily; make that a fresh check
+    return body, {'Content-Type': 'application/javascript; charset=utf-8',
+                  'Cache-Control': 'no-cache'}
+
+
+@offline_cli.command('manifest')
+def manifest_command():
+    """Write the service worker's precache manifest (at build time)."""
+
+    manifest = write_manifest()
+    click.echo(f"Manifest {manifest['version']}: "
+               f"{len(manifest['precache'])} files.")
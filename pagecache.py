@@ -0,0 +1,145 @@
+"""Full-page cache for anonymous visitors to Flask Cafe."""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import partial, wraps
+from urllib.parse import urlencode
+
+from flask import current_app, g, request, session
+
+from models import tables_changed
+
+
+class PageCache:
+    """In-process LRU of rendered pages, each kept for a limited time.
+
+    Entries are (path, expires, body, status, content type), keyed by
+    path plus sorted query string.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, path, ttl, body, status, content_type, max_entries):
+        entry = (path, time.monotonic() + ttl, body, status, content_type)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+
+    def purge(self, paths=None, prefixes=()):
+        """Drop pages for these paths, and paths starting with any of
+        these prefixes (all pages if neither is given)."""
+
+        with self.lock:
+            if paths is None and not prefixes:
+                self.entries.clear()
+                return
+            paths = paths or ()
+            for key in [k for k, e in self.entries.items()
+                        if e[0] in paths or e[0].startswith(tuple(prefixes))]:
+                del self.entries[key]
+
+
+page_cache = PageCache()
+
+
+def cache_key():
+    """Return path plus sorted query string for this request."""
+
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return f"{request.path}?{query}"
+
+
+class CacheWhenSent:
+    """A streamed page's body, passed through; calls save(body) once it
+    has all been sent. A page cut short (an error, or the client going
+    away) isn't saved."""
+
+    def __init__(self, chunks, charset, save):
+        self.chunks = chunks
+        self.charset = charset
+        self.save = save
+
+    def __iter__(self):
+        body = []
+        for chunk in self.chunks:
+            body.append(chunk.encode(self.charset) if isinstance(chunk, str)
+                        else chunk)
+            yield chunk
+        self.save(b''.join(body))
+
+    def close(self):
+        # even if never iterated: a streamed page holds its request context
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def cache_page(view):
+    """Serve this view from the page cache for anonymous visitors.
+
+    Logged-in users, and anyone with flashed messages waiting, always get
+    a fresh page. Cacheable responses say so to downstream proxies.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        ttl = current_app.config['PAGE_CACHE_TTL']
+
+        if not ttl or g.user or '_flashes' in session:
+            return view(*args, **kwargs)
+
+        key = cache_key()
+        entry = page_cache.get(key)
+
+        if entry is not None:
+            path, expires, body, status, content_type = entry
+            resp = current_app.response_class(
+                body, status=status, content_type=content_type)
+            resp.headers['X-Page-Cache'] = 'HIT'
+
+        else:
+            resp = current_app.make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+            save = partial(
+                page_cache.set, key, request.path, ttl,
+                status=resp.status_code, content_type=resp.content_type,
+                max_entries=current_app.config['PAGE_CACHE_MAX_ENTRIES'])
+            if resp.is_streamed:
+                resp.response = CacheWhenSent(
+                    resp.response, resp.charset, save)
+            else:
+                save(resp.get_data())
+            resp.headers['X-Page-Cache'] = 'MISS'
+
+        resp.headers['Cache-Control'] = f'public, max-age=0, s-maxage={ttl}'
+        resp.vary.add('Cookie')
+        return resp
+
+    return wrapper
+
+
+@tables_changed.connect
+def _purge_cafe_pages(sender, changes, **kwargs):
+    if 'cities' in changes or None in changes.get('cafes', ()):
+        page_cache.purge()
+    elif 'cafes' in changes:
+        paths = {'/cafes'} | {f'/cafes/{id}' for id in changes['cafes']}
+        # city pages list their cafes, and we don't know which city
+        page_cache.purge(paths, prefixes=['/cities/'])
@@ -0,0 +1,65 @@
+"""Baked versions of the ORM lookups every request makes.
+
+Building a Query and compiling it to SQL costs more Python than running
+it does for a primary key lookup. A baked query is built and compiled
+once, then reused with new parameter values, so these only pay for
+binding parameters and loading rows. (bench/queries.py measures the
+difference.)
+
+Like Query.get, the `get_*` functions return an object already in the
+session without querying.
+"""
+
+from flask import abort
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+
+from models import db, Cafe, Like, User
+
+bakery = baked.bakery()
+
+
+def get_user(user_id):
+    return bakery(lambda session: session.query(User))(db.session()).get(
+        user_id)
+
+
+def get_cafe(cafe_id):
+    return bakery(lambda session: session.query(Cafe))(db.session()).get(
+        cafe_id)
+
+
+def get_cafe_or_404(cafe_id):
+    cafe = get_cafe(cafe_id)
+    if cafe is None:
+        abort(404)
+    return cafe
+
+
+def get_user_or_404(user_id):
+    user = get_user(user_id)
+    if user is None:
+        abort(404)
+    return user
+
+
+def user_likes_cafe(user_id, cafe_id):
+    """Has user liked cafe?"""
+
+    query = bakery(lambda session: session.query(Like.user_id))
+    query += lambda q: q.filter(Like.user_id == bindparam('user_id'),
+                                Like.cafe_id == bindparam('cafe_id'))
+    query += lambda q: q.limit(1)
+
+    rows = query(db.session()).params(user_id=user_id, cafe_id=cafe_id).all()
+    return bool(rows)
+
+
+def find_login(username):
+    """Return the user with this username (ignoring case), or None."""
+
+    query = bakery(lambda session: session.query(User))
+    query += lambda q: q.filter(
+        db.func.lower(User.username) == bindparam('username'))
+
+    return query(db.session()).params(username=username.lower()).first()
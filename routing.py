@@ -0,0 +1,124 @@
+"""Sending read-only requests to read replicas.
+
+Views marked @read_only run their queries on a replica (one per
+request, picked at random from SQLALCHEMY_REPLICA_URIS); everything
+else uses the primary. Within a read-only view, a session that has
+written goes back to the primary, and after a request commits a write
+the user's next READ_YOUR_WRITES_SECONDS of requests all use the
+primary, so they see their own changes even if the replicas lag.
+"""
+
+import random
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import UpdateBase
+
+# Flask session key: until when (unix time) this user reads the primary
+PRIMARY_UNTIL_KEY = 'primary_until'
+# default READ_YOUR_WRITES_SECONDS
+READ_YOUR_WRITES_SECONDS = 10
+
+
+def read_only(view):
+    """Mark a view as only reading, so it may use a replica."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return view(*args, **kwargs)
+
+    wrapper.read_only = True
+    return wrapper
+
+
+def add_replica_binds(app):
+    """Add a bind for each of SQLALCHEMY_REPLICA_URIS, keyed 'replica-N',
+    and list the keys in SQLALCHEMY_REPLICA_BINDS."""
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    keys = []
+    for n, uri in enumerate(app.config['SQLALCHEMY_REPLICA_URIS']):
+        keys.append(f'replica-{n}')
+        binds[keys[-1]] = uri
+
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.config['SQLALCHEMY_REPLICA_BINDS'] = keys
+
+
+def dispose_engines(db, app):
+    """Close the pooled connections of the primary and every replica,
+    e.g. in a process forked after they were opened."""
+
+    keys = [None] + list(app.config.get('SQLALCHEMY_REPLICA_BINDS') or ())
+    for key in keys:
+        engine = db.get_engine(app, bind=key)
+        pre_ping = engine.pool._pre_ping
+        engine.dispose()
+        # the new pool doesn't inherit pool_pre_ping (SQLAlchemy 1.3.5)
+        engine.pool._pre_ping = pre_ping
+
+
+class RoutingSession(SignallingSession):
+    """Session picking the primary or a replica for each statement."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+
+        key = self.replica_key(clause)
+        if key is not None:
+            return get_state(self.app).db.get_engine(self.app, bind=key)
+        return super().get_bind(mapper, clause)
+
+    def replica_key(self, clause):
+        """Return the bind key of the replica to use, or None for the
+        primary."""
+
+        replicas = self.app.config.get('SQLALCHEMY_REPLICA_BINDS')
+        if not replicas or not has_request_context():
+            return None
+
+        if self._flushing or self.info.get('wrote'):
+            return None
+
+        view = current_app.view_functions.get(request.endpoint)
+        if not getattr(view, 'read_only', False):
+            return None
+
+        if session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+            return None
+
+        # one replica for the whole request, so reads agree with each other
+        if 'replica' not in g:
+            g.replica = random.choice(replicas)
+        return g.replica
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _note_write(db_session, flush_context):
+    db_session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _forget_write(db_session, previous_transaction):
+    db_session.info.pop('wrote', None)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _read_your_writes(db_session):
+    if not db_session.info.pop('wrote', False):
+        return
+    if (has_request_context()
+            and db_session.app.config.get('SQLALCHEMY_REPLICA_BINDS')):
+        session[PRIMARY_UNTIL_KEY] = (
+            time.time() + current_app.config['READ_YOUR_WRITES_SECONDS'])
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with RoutingSession as its session."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,261 @@
+"""Schema migrations (`flask db ...`), and a check that hot queries use
+indexes.
+
+Migrations live in migrations/versions and run with Alembic:
+
+    flask db upgrade            # to the latest revision
+    flask db revision -m "Add cafe phone numbers" --autogenerate
+
+`flask db check-plans` requests the hot pages as a visitor (and as a
+logged-in user) would, EXPLAINs every SELECT they run, and fails if any
+plan reads a table with more than --rows rows by sequential scan.
+"""
+
+import os
+
+import click
+from alembic import command
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import CURR_USER_KEY
+from models import Cafe, User
+
+MIGRATIONS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# (method, URL, logged in?) for each hot page; {cafe} and {city} are
+# filled in from the database. /cafes?open_now=1 is left
+# out: it tests every cafe's hours, so it scans by design.
+HOT_PAGES = [
+    ('GET', '/cafes', False),
+    ('GET', '/cafes?city={city}', False),
+    ('GET', '/cafes?city={city}&page=2', False),
+    ('GET', '/cafes/{cafe}', True),
+    ('GET', '/cities/{city}', False),
+    ('GET', '/cafes/trending', False),
+    ('GET', '/api/cafes', False),
+    ('GET', '/api/cafes?after={cafe}', False),
+    ('GET', '/api/cafes/{cafe}', False),
+    ('GET', '/profile', True),
+    ('GET', '/api/likes?cafe_id={cafe}', True),
+    ('GET', '/api/feed', True),
+    ('POST', '/login', False),
+]
+
+
+def alembic_config(url=None):
+    """Alembic settings; url overrides the app's database."""
+
+    config = Config()
+    config.set_main_option('script_location', MIGRATIONS_DIR)
+    config.attributes['url'] = url
+    return config
+
+
+def upgrade(revision='head', url=None):
+    command.upgrade(alembic_config(url), revision)
+
+
+def downgrade(revision, url=None):
+    command.downgrade(alembic_config(url), revision)
+
+
+def stamp(revision='head', url=None):
+    command.stamp(alembic_config(url), revision)
+
+
+db_cli = AppGroup('db', help="Manage the database schema.")
+
+
+@db_cli.command('upgrade')
+@click.argument('revision', default='head')
+@click.option('--sql', is_flag=True, help="Print the SQL; don't run it.")
+def upgrade_command(revision, sql):
+    """Migrate the database up to REVISION (default: the latest)."""
+
+    command.upgrade(alembic_config(), revision, sql=sql)
+
+
+@db_cli.command('downgrade')
+@click.argument('revision')
+@click.option('--sql', is_flag=True, help="Print the SQL; don't run it.")
+def downgrade_command(revision, sql):
+    """Migrate the database down to REVISION."""
+
+    command.downgrade(alembic_config(), revision, sql=sql)
+
+
+@db_cli.command('stamp')
+@click.argument('revision', default='head')
+def stamp_command(revision):
+    """Record that the database is at REVISION, without migrating."""
+
+    stamp(revision)
+
+
+@db_cli.command('current')
+def current_command():
+    """Show the database's revision."""
+
+    command.current(alembic_config())
+
+
+@db_cli.command('history')
+def history_command():
+    """List the migrations."""
+
+    command.history(alembic_config())
+
+
+@db_cli.command('revision')
+@click.option('-m', '--message', required=True)
+@click.option('--autogenerate', is_flag=True,
+              help="Fill it in from differences between models and database.")
+def revision_command(message, autogenerate):
+    """Start a new migration."""
+
+    config = alembic_config()
+    # number them in order: 0001, 0002, ...
+    count = len(list(ScriptDirectory.from_config(config).walk_revisions()))
+    command.revision(config, message, autogenerate=autogenerate,
+                     rev_id=f"{count + 1:04d}")
+
+
+#######################################
+# query plans
+
+
+def seq_scans(plan):
+    """Yield the table names a plan (EXPLAIN JSON) reads by seq scan."""
+
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', ()):
+        yield from seq_scans(child)
+
+
+def table_rows(conn, table):
+    """Return the planner's row count for table (counting if unknown)."""
+
+    cursor = conn.cursor()
+    cursor.execute("SELECT reltuples FROM pg_class"
+                   " WHERE oid = CAST(%s AS regclass)", (table,))
+    rows = cursor.fetchone()[0]
+    if rows < 0:
+        # never analyzed
+        cursor.execute(f'SELECT count(*) FROM "{table}"')
+        rows = cursor.fetchone()[0]
+    return int(rows)
+
+
+def capture_queries(pages, user_id, username):
+    """Request pages; return [(page, engine, statement, parameters)] for
+    the SELECTs each ran the second time (when caches are warm)."""
+
+    client = current_app.test_client()
+    queries = []
+    page = None
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            queries.append((page, conn.engine, statement, parameters))
+
+    for capturing in (False, True):
+        if capturing:
+            event.listen(Engine, 'before_cursor_execute', capture)
+        try:
+            for method, url, logged_in in pages:
+                page = url
+                with client.session_transaction() as session:
+                    session.clear()
+                    if logged_in:
+                        session[CURR_USER_KEY] = user_id
+                if method == 'POST':
+                    resp = client.post(url, data={
+                        'username': username, 'password': 'not-the-password'})
+                else:
+                    resp = client.get(url)
+                # streamed pages query as they're read
+                resp.get_data()
+                resp.close()
+        finally:
+            if capturing:
+                event.remove(Engine, 'before_cursor_execute', capture)
+
+    return queries
+
+
+def check_plans(rows=1000):
+    """EXPLAIN the hot pages' queries; return [(page, table, table rows,
+    statement)] for each sequential scan of a table over `rows` rows."""
+
+    cafe = Cafe.query.order_by(Cafe.id).first()
+    user = User.query.order_by(User.id).first()
+    if cafe is None or user is None:
+        raise ValueError("Need at least one cafe and one user")
+
+    pages = [(method, url.format(cafe=cafe.id, city=cafe.city_code), login)
+             for method, url, login in HOT_PAGES]
+
+    # exercise the queries behind the caches, and don't need CSRF tokens
+    config = current_app.config
+    overrides = dict(PAGE_CACHE_TTL=0, CATALOG_SNAPSHOT=False,
+                     WTF_CSRF_ENABLED=False)
+    # WTF_CSRF_ENABLED is usually unset (Flask-WTF defaults it to on)
+    saved = {key: config[key] for key in overrides if key in config}
+    config.update(overrides)
+    try:
+        queries = capture_queries(pages, user.id, user.username)
+    finally:
+        for key in overrides:
+            config.pop(key)
+        config.update(saved)
+
+    failures = []
+    seen = set()
+
+    for page, engine, statement, parameters in queries:
+        if (engine.url, statement) in seen:
+            continue
+        seen.add((engine.url, statement))
+
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            plan = cursor.fetchone()[0][0]['Plan']
+            for table in set(seq_scans(plan)):
+                count = table_rows(conn, table)
+                if count > rows:
+                    failures.append((page, table, count, statement))
+        finally:
+            conn.rollback()
+            conn.close()
+
+    return failures
+
+
+@db_cli.command('check-plans')
+@click.option('--rows', default=1000, show_default=True,
+              help="Largest table a hot query may scan sequentially.")
+def check_plans_command(rows):
+    """EXPLAIN hot-page queries; fail on big sequential scans."""
+
+    try:
+        failures = check_plans(rows)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    for page, table, count, statement in failures:
+        click.echo(f"{page}: seq scan on {table} ({count} rows)\n"
+                   f"    {' '.join(statement.split())}\n")
+
+    if failures:
+        raise click.ClickException(
+            f"{len(failures)} hot queries scan big tables")
+    click.echo(f"No sequential scans of tables over {rows} rows.")
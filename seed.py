@@ -1,26 +1,26 @@
 """Initial data."""
-from config import DATABASE_URL
-from models import City, Cafe, User, db, connect_db
-from flask import Flask
+from app import create_app
+from models import City, Cafe, User, db
+from schema import stamp
 
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-
-connect_db(app)
+app = create_app()
 
 db.drop_all()
 db.create_all()
+# create_all made the latest schema; tell migrations so
+with app.app_context():
+    stamp()
 
 
 #######################################
 # add cities
 
-sf = City(code='sf', name='San Francisco', state='CA')
-berk = City(code='berk', name='Berkeley', state='CA')
-oak = City(code='oak', name='Oakland', state='CA')
+sf = City(code='sf', name='San Francisco', state='CA',
+          timezone='America/Los_Angeles')
+berk = City(code='berk', name='Berkeley', state='CA',
+            timezone='America/Los_Angeles')
+oak = City(code='oak', name='Oakland', state='CA',
+           timezone='America/Los_Angeles')
 
 db.session.add_all([sf, berk, oak])
 db.session.commit()
@@ -35,6 +35,7 @@ c1 = Cafe(
         ' and code.',
     address="3966 24th St",
     city_code='sf',
+    hours='Mon-Fri 6:30-18:00; Sat-Sun 7:00-18:00',
     url='https://www.yelp.com/biz/bernies-san-francisco',
     image_url='https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg'
 )
@@ -45,6 +46,7 @@ c2 = Cafe(
         ' around Oakland.',
     address='440 Grand Ave',
     city_code='oak',
+    hours='Daily 7:00-17:00',
     url='https://perchoffee.com',
     image_url='https://s3-media4.fl.yelpcdn.com/bphoto/0vhzcgkzIUIEPIyL2rF_YQ/o.jpg',
 )
@@ -55,6 +57,7 @@ c3 = Cafe(
         ' in a corner bistro.',
     address='200 Fillmore St',
     city_code='sf',
+    hours='Mon-Thu 6:00-22:00; Fri-Sat 6:00-0:00; Sun 6:00-22:00',
     url='http://cafe-du-soleil.cafes-city.com/',
     image_url='https://s3-media2.fl.yelpcdn.com/bphoto/l6oeG-xz1sJ5PWDJEG-zHg/o.jpg',
 )
@@ -64,6 +67,7 @@ c4 = Cafe(
     description="Berkeley's board game cafe plus craft coffee and beer.",
     address='1797 Shattuck Ave',
     city_code='berk',
+    hours='Mon closed; Tue-Thu 11:00-22:00; Fri-Sat 11:00-1:00; Sun 11:00-21:00',
     url='https://www.victorypointcafe.com/',
     image_url='https://s3-media1.fl.yelpcdn.com/bphoto/oZHI0cmzCnUDMP7WPAjEEw/o.jpg',
 )
@@ -0,0 +1,371 @@
+"""Read-only catalog of listable cafe data in a memory-mapped file.
+
+Every worker on a host maps the same file, so they share one copy of
+the catalog in the page cache instead of each querying and holding
+their own, and cafe lists and the cafe API can be served without a
+database round trip. Strings are decoded only for the rows a request
+actually shows, so a worker's memory doesn't grow with the catalog.
+
+File layout (little-endian):
+
+    header     HEADER
+    records    RECORD per cafe, in list order (by name)
+    by_id      u32 record number per cafe, in id order
+    cities     CITY per city code, sorted by code
+    in_city    u32 record numbers, in list order, city after city
+    blob       UTF-8 strings and hours bitmaps; records point at them by
+               (offset, length)
+
+Writers replace the file (write a new one, then rename over it); readers
+notice the new inode and map it. A fingerprint of the cafes table kept in
+the header lets any process spot a stale file and rebuild it. Rebuilds
+take turns on a lock file, and read the primary: a replica may not have
+the change that made the file stale yet.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import orm
+
+from models import db, tables_changed, Cafe, City
+
+# bumped with the layout; it's in the file name, so processes still
+# running older code keep their own file
+FORMAT = 2
+MAGIC = b'CAFESNP' + str(FORMAT).encode()
+
+HEADER = struct.Struct('<8s9I')
+TEXT_FIELDS = ('name', 'description', 'url', 'address', 'image_url', 'hours')
+# id, city number, a span per text field, and the hours bitmap's span
+RECORD = struct.Struct('<IH' + 'II' * (len(TEXT_FIELDS) + 1))
+CITY = struct.Struct('<IIII')
+
+
+class CafeRow(namedtuple('CafeRow', ('id', 'city_code') + TEXT_FIELDS)):
+    """One cafe from the snapshot; stands in for Cafe in list templates."""
+
+    __slots__ = ()
+
+    def get_city_state(self):
+        return City.get_registry().get_city_state(self.city_code)
+
+
+class Snapshot:
+    """A mapped snapshot file."""
+
+    def __init__(self, mm):
+        self.mm = mm
+        (magic, self.count, n_cities, self.records_at, self.by_id_at,
+         cities_at, self.in_city_at, self.blob_at, fp_at, fp_len
+         ) = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError("not a catalog snapshot")
+
+        self.fingerprint = self.text(fp_at, fp_len)
+
+        # {code: (start, count)} into in_city; a handful of entries
+        self.cities = {}
+        for i in range(n_cities):
+            code_at, code_len, start, count = CITY.unpack_from(
+                mm, cities_at + i * CITY.size)
+            self.cities[self.text(code_at, code_len)] = (start, count)
+
+        # records refer to cities by number
+        self.city_codes = list(self.cities)
+
+        # {((city code, slot), ...): record numbers open then}
+        self.open_cache = {}
+
+    def __len__(self):
+        return self.count
+
+    def text(self, at, length):
+        start = self.blob_at + at
+        return self.mm[start:start + length].decode('utf8')
+
+    def row(self, n):
+        """Return record n (in list order) as a CafeRow."""
+
+        values = RECORD.unpack_from(self.mm, self.records_at + n * RECORD.size)
+        id, city = values[:2]
+        texts = [self.text(values[i], values[i + 1])
+                 for i in range(2, len(values) - 2, 2)]
+        return CafeRow(id, self.city_codes[city], *texts)
+
+    def rows(self, numbers):
+        return [self.row(n) for n in numbers]
+
+    def city_counts(self):
+        return {code: count for code, (start, count) in self.cities.items()
+                if count}
+
+    def _u32(self, at, i):
+        return struct.unpack_from('<I', self.mm, at + 4 * i)[0]
+
+    def page(self, city_code, offset, limit):
+        """Return rows offset..offset+limit in list order, for one city
+        (or all, if city_code is None)."""
+
+        if city_code is None:
+            end = min(offset + limit, self.count)
+            return [self.row(n) for n in range(offset, end)]
+
+        start, count = self.cities.get(city_code, (0, 0))
+        end = min(offset + limit, count)
+        return [self.row(self._u32(self.in_city_at, start + i))
+                for i in range(offset, end)]
+
+    def open_records(self, slots):
+        """Return the numbers (in list order) of the records open in
+        their city's slot of the week; `slots` is {city code: slot}, and
+        cities not in it don't match.
+
+        The answer only changes with the slots, every 15 minutes, so it's
+        kept for the next request.
+        """
+
+        key = tuple(sorted(slots.items()))
+        found = self.open_cache.get(key)
+        if found is not None:
+            return found
+
+        city_slots = [slots.get(code) for code in self.city_codes]
+        found = array('I')
+        for n in range(self.count):
+            values = RECORD.unpack_from(
+                self.mm, self.records_at + n * RECORD.size)
+            slot = city_slots[values[1]]
+            at, length = values[-2:]
+            if slot is not None and length:
+                byte = self.mm[self.blob_at + at + slot // 8]
+                if byte >> (slot % 8) & 1:
+                    found.append(n)
+
+        # this slot's keys (all cities, or one at a time); older go
+        if len(self.open_cache) > 2 * len(self.cities):
+            self.open_cache.clear()
+        self.open_cache[key] = found
+        return found
+
+    def _id_at(self, i):
+        n = self._u32(self.by_id_at, i)
+        return RECORD.unpack_from(self.mm, self.records_at + n * RECORD.size)[0]
+
+    def _ids(self):
+        return _Sequence(self.count, self._id_at)
+
+    def get(self, cafe_id):
+        """Return the row for cafe_id, or None."""
+
+        i = bisect_right(self._ids(), cafe_id) - 1
+        if i >= 0 and self._id_at(i) == cafe_id:
+            return self.row(self._u32(self.by_id_at, i))
+        return None
+
+    def after(self, cafe_id, limit):
+        """Return up to limit rows with ids after cafe_id, in id order."""
+
+        i = bisect_right(self._ids(), cafe_id) if cafe_id is not None else 0
+        end = min(i + limit, self.count)
+        return [self.row(self._u32(self.by_id_at, j)) for j in range(i, end)]
+
+
+class _Sequence:
+    """Just enough of a sequence for bisect."""
+
+    def __init__(self, length, getitem):
+        self.length = length
+        self.getitem = getitem
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.getitem(i)
+
+
+@contextmanager
+def primary_session():
+    """A session of its own on the primary, whose reads all see the same
+    (REPEATABLE READ) transaction."""
+
+    with db.get_engine(current_app).connect() as conn:
+        session = orm.Session(bind=conn.execution_options(
+            isolation_level='REPEATABLE READ'))
+        try:
+            yield session
+        finally:
+            session.close()
+
+
+def _fingerprint(session):
+    count, updated, cities = session.query(
+        db.func.count(Cafe.id), db.func.max(Cafe.updated_at),
+        session.query(db.func.count(City.code)).as_scalar()).one()
+    return f"{count}:{updated.isoformat() if updated else ''}:{cities}"
+
+
+def get_fingerprint():
+    """Return a string that changes whenever listable cafe data does."""
+
+    with primary_session() as session:
+        return _fingerprint(session)
+
+
+def write_snapshot(path):
+    """Write a snapshot of the cafes table to path (replacing it)."""
+
+    with primary_session() as session:
+        fingerprint = _fingerprint(session)
+        codes = sorted(code for (code,) in session.query(City.code))
+        rows = (session.query(Cafe.id, Cafe.city_code,
+                              *(getattr(Cafe, f) for f in TEXT_FIELDS),
+                              Cafe.hours_bitmap)
+                .order_by(Cafe.name, Cafe.id)
+                .all())
+
+    city_numbers = {code: i for i, code in enumerate(codes)}
+
+    blob = bytearray()
+    offsets = {}
+
+    def add_bytes(data):
+        data = bytes(data or b'')
+        if data not in offsets:
+            offsets[data] = len(blob)
+            blob.extend(data)
+        return offsets[data], len(data)
+
+    def add_text(value):
+        return add_bytes((value or '').encode('utf8'))
+
+    records = bytearray()
+    in_city = {code: array('I') for code in codes}
+
+    for n, (id, city_code, *texts, bitmap) in enumerate(rows):
+        spans = [part for text in texts for part in add_text(text)]
+        records += RECORD.pack(id, city_numbers[city_code], *spans,
+                               *add_bytes(bitmap))
+        in_city[city_code].append(n)
+
+    by_id = array('I', sorted(range(len(rows)), key=lambda n: rows[n][0]))
+
+    cities = bytearray()
+    in_city_all = array('I')
+    for code in codes:
+        cities += CITY.pack(*add_text(code), len(in_city_all),
+                            len(in_city[code]))
+        in_city_all.extend(in_city[code])
+
+    fp_at, fp_len = add_text(fingerprint)
+
+    records_at = HEADER.size
+    by_id_at = records_at + len(records)
+    cities_at = by_id_at + 4 * len(by_id)
+    in_city_at = cities_at + len(cities)
+    blob_at = in_city_at + 4 * len(in_city_all)
+
+    header = HEADER.pack(MAGIC, len(rows), len(codes), records_at, by_id_at,
+                         cities_at, in_city_at, blob_at, fp_at, fp_len)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        for part in (header, records, by_id.tobytes(), cities,
+                     in_city_all.tobytes(), blob):
+            f.write(part)
+    os.replace(tmp, path)
+
+
+class Catalog:
+    """This process's view of the snapshot file for the app's database.
+
+    get() maps the current file, noticing when another process replaced
+    it. When this process has committed cafe changes, or every
+    CATALOG_SNAPSHOT_CHECK seconds, it compares the file's fingerprint
+    with the database and rebuilds a stale (or missing) file.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.inode = None
+        self.checked = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def path(self):
+        config = current_app.config
+        # one file per database, so test and dev data never mix
+        uri = config['SQLALCHEMY_DATABASE_URI']
+        name = hashlib.sha256(uri.encode()).hexdigest()[:12]
+        return os.path.join(config['CATALOG_SNAPSHOT_DIR'],
+                            f"catalog-{name}-v{FORMAT}.snap")
+
+    def get(self):
+        """Return the current Snapshot, or None if snapshots are off."""
+
+        if not current_app.config['CATALOG_SNAPSHOT']:
+            return None
+
+        path = self.path()
+        snapshot = self._open(path)
+
+        interval = current_app.config['CATALOG_SNAPSHOT_CHECK']
+        if (snapshot is None or self.dirty
+                or time.monotonic() - self.checked > interval):
+            self.checked = time.monotonic()
+            self.dirty = False
+            if snapshot is None or snapshot.fingerprint != get_fingerprint():
+                snapshot = self.rebuild()
+
+        return snapshot
+
+    def rebuild(self):
+        """Write a fresh snapshot file, unless one is current, and map it.
+
+        One process (and thread) rebuilds at a time; the others wait, and
+        then find the file the first wrote.
+        """
+
+        path = self.path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock, open(f"{path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            snapshot = self._open(path)
+            if snapshot is None or snapshot.fingerprint != get_fingerprint():
+                write_snapshot(path)
+        return self._open(path)
+
+    def _open(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        if stat.st_ino != self.inode:
+            with open(path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.snapshot = Snapshot(mm)
+            self.inode = stat.st_ino
+
+        return self.snapshot
+
+
+catalog = Catalog()
+
+
+@tables_changed.connect
+def _mark_catalog_dirty(sender, changes, committed=True, **kwargs):
+    if committed and ('cafes' in changes or 'cities' in changes):
+        catalog.dirty = True
@@ -0,0 +1,48 @@
+$(function() {
+    const DELAY_MS = 100;
+    let timer = null;
+    let lastQuery = "";
+
+    $("#search").on("input", function() {
+        clearTimeout(timer);
+        timer = setTimeout(suggest, DELAY_MS);
+    });
+
+    $("#search-form").on("submit", function(evt) {
+        evt.preventDefault();
+        let first = $("#search-results a").first();
+        if (first.length) window.location = first.attr("href");
+    });
+
+    $(document).on("click", function(evt) {
+        if (!$(evt.target).closest("#search-form").length) {
+            $("#search-results").removeClass("show");
+        }
+    });
+
+    async function suggest() {
+        let q = $("#search").val().trim();
+        if (q === lastQuery) return;
+        lastQuery = q;
+
+        if (!q) {
+            $("#search-results").removeClass("show").empty();
+            return;
+        }
+
+        let response = await axios.get("/api/cafes/autocomplete", {params: { q }});
+
+        // a newer keystroke may have answered first
+        if (q !== lastQuery) return;
+
+        let $results = $("#search-results").empty();
+        for (let result of response.data.results) {
+            let detail = result.type === "cafe" ? result.city : "All cafes";
+            $("<a>", {"class": "dropdown-item", href: result.url})
+                .text(result.name)
+                .append($("<small>", {"class": "ml-2 text-muted"}).text(detail))
+                .appendTo($results);
+        }
+        $results.toggleClass("show", response.data.results.length > 0);
+    }
+});
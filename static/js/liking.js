@@ -2,6 +2,11 @@ $(async function() {
     $("#unlike").on("click", unlike);
     $("#like").on("click", like);
 
+    // likes made offline are queued by the service worker; browsers
+    // without Background Sync need telling when to send them
+    replayLikes();
+    window.addEventListener("online", replayLikes);
+
     let response = await axios.get("/api/likes", {params: { cafe_id: cafeId} });
     let result = response.data;
     console.log(response.data);
@@ -41,4 +46,9 @@ async function like(evt) {
         $("#like").hide();
         $("#unlike").show();
     }
-}
\ No newline at end of file
+}
+
+function replayLikes() {
+    let worker = navigator.serviceWorker && navigator.serviceWorker.controller;
+    if (worker && navigator.onLine) worker.postMessage("replay-likes");
+}
@@ -0,0 +1,99 @@
+"""Per-city statistics for the admin dashboard.
+
+Counting cafes, likes and active users live would aggregate the whole
+likes table on every view, so the numbers are kept in a materialized
+view, city_stats, and the dashboard reads one row per city. Refresh it
+on a schedule (`flask stats refresh`); imports refresh it when done.
+Each row records when it was computed, and the dashboard shows that.
+
+The refresh is CONCURRENTLY, so the dashboard keeps reading the old
+rows meanwhile; that needs the unique index on city_code.
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import DDL, event, text
+
+from models import db
+
+stats_cli = AppGroup('stats', help="Maintain the admin dashboard's numbers.")
+
+# users who liked a cafe in a city this recently are active there
+ACTIVE_DAYS = 30
+
+# also in migrations/versions/0005: change both (with a new migration)
+CITY_STATS_SQL = f"""
+CREATE MATERIALIZED VIEW city_stats AS
+WITH cafe_likes AS (
+    SELECT cafes.id, cafes.city_code, count(likes.cafe_id) AS likes
+    FROM cafes LEFT JOIN likes ON likes.cafe_id = cafes.id
+    GROUP BY cafes.id
+)
+SELECT cities.code AS city_code,
+       coalesce(counts.cafes, 0) AS cafe_count,
+       coalesce(counts.likes, 0) AS like_count,
+       top.id AS top_cafe_id,
+       top.likes AS top_cafe_likes,
+       coalesce(active.users, 0) AS active_users,
+       timezone('utc', now()) AS refreshed_at
+FROM cities
+LEFT JOIN (
+    SELECT city_code, count(*) AS cafes, CAST(sum(likes) AS bigint) AS likes
+    FROM cafe_likes GROUP BY city_code
+) counts ON counts.city_code = cities.code
+LEFT JOIN LATERAL (
+    SELECT id, likes FROM cafe_likes
+    WHERE city_code = cities.code AND likes > 0
+    ORDER BY likes DESC, id LIMIT 1
+) top ON true
+LEFT JOIN (
+    SELECT cafes.city_code, count(DISTINCT likes.user_id) AS users
+    FROM likes JOIN cafes ON cafes.id = likes.cafe_id
+    WHERE likes.created_at > timezone('utc', now()) - interval '{ACTIVE_DAYS} days'
+    GROUP BY cafes.city_code
+) active ON active.city_code = cities.code
+"""
+
+CITY_STATS_INDEX_SQL = (
+    "CREATE UNIQUE INDEX ix_city_stats_city_code ON city_stats (city_code)")
+
+# the view isn't a model, so create_all/drop_all (tests) need telling
+event.listen(db.metadata, 'after_create', DDL(CITY_STATS_SQL))
+event.listen(db.metadata, 'after_create', DDL(CITY_STATS_INDEX_SQL))
+event.listen(db.metadata, 'before_drop',
+             DDL("DROP MATERIALIZED VIEW IF EXISTS city_stats"))
+
+STATS_SQL = text("""
+SELECT cities.code, cities.name, cities.state,
+       city_stats.cafe_count, city_stats.like_count,
+       city_stats.top_cafe_id, cafes.name AS top_cafe_name,
+       city_stats.top_cafe_likes, city_stats.active_users,
+       city_stats.refreshed_at
+FROM city_stats
+JOIN cities ON cities.code = city_stats.city_code
+LEFT JOIN cafes ON cafes.id = city_stats.top_cafe_id
+ORDER BY cities.name
+""")
+
+
+def get_city_stats():
+    """Return a row per city, as of its refreshed_at (UTC)."""
+
+    return db.session.execute(STATS_SQL).fetchall()
+
+
+def refresh():
+    """Recompute city_stats, without blocking readers; the caller
+    commits."""
+
+    db.session.execute(text(
+        "REFRESH MATERIALIZED VIEW CONCURRENTLY city_stats"))
+
+
+@stats_cli.command('refresh')
+def refresh_command():
+    """Recompute the per-city statistics."""
+
+    refresh()
+    db.session.commit()
+    click.echo("City statistics refreshed.")
@@ -0,0 +1,81 @@
+"""Sending pages while their templates render.
+
+render_template builds the whole page before the first byte goes out,
+so long lists delay the response and sit in memory whole. A streamed
+page goes out in chunks of about STREAM_BUFFER_BYTES as it renders.
+Everything up to </head> goes out as soon as it's rendered, so the
+browser can start fetching stylesheets and scripts while the rest of
+the page is rendered.
+
+Since the status and headers have gone out before the body renders, a
+template error partway through just ends the page early.
+"""
+
+from flask import _request_ctx_stack, current_app, render_template
+
+HEAD_END = '</head>'
+
+
+def buffered(pieces, size):
+    """Join a template's many small pieces into chunks of about `size`
+    characters, ending one early after </head>."""
+
+    buffer = []
+    length = 0
+    in_head = True
+
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+
+        head_done = in_head and HEAD_END in piece
+        if head_done:
+            in_head = False
+        if head_done or length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def with_request_context(pieces):
+    """Like flask.stream_with_context: keep this request's context while
+    the response is sent. But always pop it after, even when the test
+    client preserves contexts (Flask's version then never pops it)."""
+
+    ctx = _request_ctx_stack.top
+
+    def generate():
+        ctx.push()
+        try:
+            # started here, so closing it unread still pops the context
+            yield None
+            yield from pieces
+        finally:
+            ctx.pop()
+
+    stream = generate()
+    next(stream)
+    return stream
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but return a response streaming the page.
+
+    Lists in the context may be iterators (e.g. Query.yield_per), and
+    are then read as they're shown. Renders all at once if
+    STREAM_TEMPLATES is off.
+    """
+
+    app = current_app._get_current_object()
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    pieces = buffered(template.generate(context),
+                      app.config['STREAM_BUFFER_BYTES'])
+    return app.response_class(with_request_context(pieces),
+                              mimetype='text/html')
@@ -0,0 +1,223 @@
+// Flask Cafe service worker; served by offline.py at /sw.js.
+
+const MANIFEST = {{ manifest | tojson }};
+
+const STATIC_CACHE = `flaskcafe-static-${MANIFEST.version}`;
+// fingerprinted files seen while browsing (maps, images)
+const RUNTIME_CACHE = "flaskcafe-runtime";
+const PAGES_CACHE = "flaskcafe-pages";
+const MAX_ENTRIES = {[RUNTIME_CACHE]: 300, [PAGES_CACHE]: 100};
+
+// /, /cafes (any filters), /cafes/<id>, /cafes/trending, /cities/<code>
+const CATALOG_PAGE = /^\/(cafes(\/\d+|\/trending)?|cities\/[^/]+)?$/;
+const LIKE_API = /^\/api\/(like|unlike)$/;
+// unpkg URLs naming an exact version (assets.LIBRARIES): /jquery@3.4.1/...
+const UNPKG_VERSIONED = /^\/(@[^/]+\/)?[^/@]+@\d+\.\d+\.\d+\//;
+const AUTH_PAGE = /^\/(login|logout|signup)$/;
+
+const QUEUE_DB = "flaskcafe-likes";
+const QUEUE_STORE = "queue";
+const SYNC_TAG = "replay-likes";
+
+
+self.addEventListener("install", evt => {
+    evt.waitUntil(precache().then(() => self.skipWaiting()));
+});
+
+self.addEventListener("activate", evt => {
+    evt.waitUntil((async () => {
+        for (let name of await caches.keys()) {
+            if (name.startsWith("flaskcafe-static-") && name !== STATIC_CACHE) {
+                await caches.delete(name);
+            }
+        }
+        await self.clients.claim();
+        await replayLikes().catch(() => {});
+    })());
+});
+
+self.addEventListener("fetch", evt => {
+    let request = evt.request;
+    let url = new URL(request.url);
+    let sameOrigin = url.origin === self.location.origin;
+
+    if (request.method === "POST" && sameOrigin) {
+        if (LIKE_API.test(url.pathname)) {
+            evt.respondWith(sendLike(request, url.pathname.slice(5)));
+        } else if (AUTH_PAGE.test(url.pathname)) {
+            // cached pages show who was logged in; forget them before
+            // the redirect after logging in or out is requested
+            evt.respondWith(caches.delete(PAGES_CACHE).then(
+                () => fetch(request)));
+        }
+        return;
+    }
+    if (request.method !== "GET") return;
+
+    if (isFingerprinted(url)) {
+        evt.respondWith(cacheFirst(request));
+    } else if (sameOrigin && url.pathname === "/api/likes") {
+        evt.respondWith(likesState(request, url));
+    } else if (sameOrigin && CATALOG_PAGE.test(url.pathname)) {
+        evt.respondWith(networkFirst(request));
+    }
+});
+
+// browsers with Background Sync replay the queue once back online
+self.addEventListener("sync", evt => {
+    if (evt.tag === SYNC_TAG) evt.waitUntil(replayLikes());
+});
+
+// others: liking.js asks when the page sees the device come back online
+self.addEventListener("message", evt => {
+    if (evt.data === SYNC_TAG) evt.waitUntil(replayLikes().catch(() => {}));
+});
+
+
+/** Contents never change for these URLs, so a cached copy is current. */
+function isFingerprinted(url) {
+    if (url.origin === "https://unpkg.com") {
+        return UNPKG_VERSIONED.test(url.pathname);
+    }
+    if (url.origin !== self.location.origin) return false;
+    return (url.pathname.startsWith("/static/") && url.searchParams.has("v"))
+        || url.pathname.startsWith("/images/");
+}
+
+async function precache() {
+    let cache = await caches.open(STATIC_CACHE);
+    // cross-origin libraries come back opaque, which cache.addAll refuses
+    await Promise.all(MANIFEST.precache.map(async url => {
+        let mode = url.startsWith("/") ? "same-origin" : "no-cors";
+        let request = new Request(url, {mode});
+        let response = await fetch(request);
+        if (response.ok || response.type === "opaque") {
+            await cache.put(request, response);
+        }
+    }));
+}
+
+async function cacheFirst(request) {
+    let cached = await caches.match(request);
+    if (cached) return cached;
+
+    let response = await fetch(request);
+    if (response.ok || response.type === "opaque") {
+        await put(RUNTIME_CACHE, request, response.clone());
+    }
+    return response;
+}
+
+/** Pages change after every edit (and carry flash messages), so the
+ * cached copy is only for when the network fails. */
+async function networkFirst(request) {
+    try {
+        let response = await fetch(request);
+        if (response.ok) await put(PAGES_CACHE, request, response.clone());
+        return response;
+    } catch (err) {
+        let cached = await caches.match(request, {cacheName: PAGES_CACHE});
+        if (cached) return cached;
+        throw err;
+    }
+}
+
+async function put(cacheName, request, response) {
+    let cache = await caches.open(cacheName);
+    await cache.put(request, response);
+
+    // keys() lists oldest first
+    let keys = await cache.keys();
+    for (let key of keys.slice(0, keys.length - MAX_ENTRIES[cacheName])) {
+        await cache.delete(key);
+    }
+}
+
+
+/** Like state for liking.js: the network's, else the last seen, with any
+ * queued like or unlike applied. */
+async function likesState(request, url) {
+    let cafeId = Number(url.searchParams.get("cafe_id"));
+    let queued = await queue("readonly", store => store.get(cafeId));
+
+    try {
+        let response = await fetch(request);
+        if (response.ok) await put(PAGES_CACHE, request, response.clone());
+        if (!queued) return response;
+    } catch (err) {
+        if (!queued) {
+            let cached = await caches.match(request);
+            if (cached) return cached;
+            throw err;
+        }
+    }
+    return json({likes: queued.action === "like"});
+}
+
+
+/** Send a like or unlike; if offline, queue it and answer as if sent. */
+async function sendLike(request, action) {
+    let cafe_id = Number((await request.clone().json()).cafe_id);
+
+    try {
+        let response = await fetch(request);
+        // a queued action for this cafe is older than this one
+        await queue("readwrite", store => store.delete(cafe_id));
+        return response;
+    } catch (err) {
+        // only the latest action per cafe is kept: like, unlike = unlike
+        await queue("readwrite", store => store.put({cafe_id, action}));
+        if (self.registration.sync) {
+            await self.registration.sync.register(SYNC_TAG).catch(() => {});
+        }
+        return json({[`${action}d`]: cafe_id, queued: true});
+    }
+}
+
+/** Send queued actions; rejects (to be retried) if still offline. */
+async function replayLikes() {
+    let queued = await queue("readonly", store => store.getAll());
+
+    for (let {cafe_id, action} of queued) {
+        await fetch(`/api/${action}`, {
+            method: "POST",
+            credentials: "same-origin",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({cafe_id}),
+        });
+        // sent, even if refused (e.g. logged out): retrying won't help.
+        // Unless the user acted again meanwhile: that's still to send.
+        await queue("readwrite", store => {
+            let req = store.get(cafe_id);
+            req.onsuccess = () => {
+                if (req.result && req.result.action === action) {
+                    store.delete(cafe_id);
+                }
+            };
+            return req;
+        });
+    }
+}
+
+function json(body) {
+    return new Response(JSON.stringify(body),
+                        {headers: {"Content-Type": "application/json"}});
+}
+
+/** Run fn(store) on the queue in a transaction; resolve to its result. */
+function queue(mode, fn) {
+    return new Promise((resolve, reject) => {
+        let open = indexedDB.open(QUEUE_DB, 1);
+        open.onupgradeneeded = () => {
+            open.result.createObjectStore(QUEUE_STORE, {keyPath: "cafe_id"});
+        };
+        open.onerror = () => reject(open.error);
+        open.onsuccess = () => {
+            let db = open.result;
+            let tx = db.transaction(QUEUE_STORE, mode);
+            let req = fn(tx.objectStore(QUEUE_STORE));
+            tx.oncomplete = () => { db.close(); resolve(req.result); };
+            tx.onerror = () => { db.close(); reject(tx.error); };
+        };
+    });
+}
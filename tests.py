@@ -1,25 +1,94 @@
 """Tests for Flask Cafe."""
 
 
+import asyncio
+import hashlib
+import json
+import os
 import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from unittest import TestCase
 
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, User, Like
+from app import create_app, update_city_maps, CURR_USER_KEY
+from asgi import LikeAPI
+from models import db, bcrypt, tables_changed
+from models import Cafe, City, User, Like, TrendingEpoch, Follow, FeedItem
+from bus import Listener, decode_changes, encode_changes
+from routing import PRIMARY_UNTIL_KEY, dispose_engines
+import schema
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine
+import bus
+from pagecache import page_cache
+from streaming import buffered
+from autocomplete import PrefixIndex, cafe_search
+from cafe_api import FIELDS, FieldError, parse_fields
+from assets import LIBRARIES, static_url
+from forms import CafeAddEditForm
+from freezer import page_path
+from snapshot import catalog, write_snapshot
+from sqlalchemy import event
+from hours import HoursError, is_open, parse_hours, slot_at
+from warmup import warm_up
+import offline
+import warmup
+from bench.fake_mapquest import serve as serve_fake_mapquest
+import mapping
+from images import disk_cache, image_attrs, proxied_url, resize
+from images import ImageError, check_url, fetch
+import images
+import trending
+import feed
+import importer
+import queries
+import stats
 from flask import session
+from flask.testing import FlaskClient
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import NotFound
 
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///flaskcafe-test"
-app.config['SQLALCHEMY_ECHO'] = False
+app = create_app({
+    # Use test database and don't clutter tests with SQL
+    'SQLALCHEMY_DATABASE_URI': "postgresql:///flaskcafe-test",
+    'SQLALCHEMY_ECHO': False,
+    'CATALOG_SNAPSHOT_DIR': tempfile.mkdtemp(),
 
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
+    # Make Flask errors be real errors, rather than HTML pages with error info
+    'TESTING': True,
 
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+    # This is a bit of hack, but don't use Flask DebugToolbar
+    'DEBUG_TB_HOSTS': ['dont-show-debug-toolbar'],
 
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+    # Don't req CSRF for testing
+    'WTF_CSRF_ENABLED': False,
+
+    # Page caching has its own tests; elsewhere we want fresh pages
+    'PAGE_CACHE_TTL': 0,
+
+    'SERVICE_WORKER_MANIFEST': os.path.join(
+        tempfile.mkdtemp(), 'sw-manifest.json'),
+})
+
+
+
+class BufferedClient(FlaskClient):
+    """Test client reading whole responses by default, so streamed pages
+    finish (and release their request context) before the next request."""
+
+    def open(self, *args, **kwargs):
+        kwargs.setdefault('buffered', True)
+        return super().open(*args, **kwargs)
+
+
+app.test_client_class = BufferedClient
 
 db.drop_all()
 db.create_all()
@@ -157,6 +226,21 @@ class CityModelTestCase(TestCase):
         codes = City.get_city_codes()
         self.assertEqual(codes, [('sf', 'San Francisco')])
 
+    def test_registry_cached(self):
+        registry = City.get_registry()
+        self.assertIs(City.get_registry(), registry)
+        self.assertEqual(registry.get_city_state('sf'), "San Francisco, CA")
+
+    def test_registry_cleared_on_write(self):
+        City.get_registry()
+
+        db.session.add(City(code='oak', name='Oakland', state='CA'))
+        db.session.commit()
+
+        self.assertEqual(
+            City.get_city_codes(),
+            [('oak', 'Oakland'), ('sf', 'San Francisco')])
+
 
 #######################################
 # cafes
@@ -191,6 +275,14 @@ class CafeModelTestCase(TestCase):
     def test_get_city_state(self):
         self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
 
+    def test_city_counts(self):
+        self.assertEqual(Cafe.get_city_counts(), {'sf': 1})
+
+        db.session.add(Cafe(**CAFE_DATA_EDIT))
+        db.session.commit()
+
+        self.assertEqual(Cafe.get_city_counts(), {'sf': 2})
+
 
 class CafeViewsTestCase(TestCase):
     """Tests for views on cafes."""
@@ -224,6 +316,43 @@ class CafeViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Test Cafe", resp.data)
 
+    def test_list_city_filter(self):
+        oak = City(code='oak', name='Oakland', state='CA')
+        db.session.add(oak)
+        db.session.add(Cafe(**dict(CAFE_DATA, name="Oak Cafe", city_code='oak')))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes?city=oak")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Oak Cafe", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+            # facet counts for every city, whatever the filter
+            html = resp.data.decode('utf8')
+            self.assertRegex(html, r'Oakland\s*<span[^>]*>1</span>')
+            self.assertRegex(html, r'San Francisco\s*<span[^>]*>1</span>')
+
+            resp = client.get("/cafes?city=nyc")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_list_pagination(self):
+        app.config['CAFES_PER_PAGE'] = 1
+        db.session.add(Cafe(**dict(CAFE_DATA, name="Z Cafe")))
+        db.session.commit()
+
+        try:
+            with app.test_client() as client:
+                resp = client.get("/cafes?page=2")
+                self.assertIn(b"Z Cafe", resp.data)
+                self.assertNotIn(b"Test Cafe", resp.data)
+                self.assertIn(b"Page 2 of 2", resp.data)
+
+                resp = client.get("/cafes?page=3")
+                self.assertEqual(resp.status_code, 404)
+        finally:
+            app.config['CAFES_PER_PAGE'] = 24
+
     def test_detail(self):
         with app.test_client() as client:
             resp = client.get(f"/cafes/{self.cafe_id}")
@@ -232,22 +361,21 @@ class CafeViewsTestCase(TestCase):
             self.assertIn(b'testcafe.com', resp.data)
 
 
-class CafeAdminViewsTestCase(TestCase):
-    """Tests for add/edit views on cafes."""
+class PageCacheTestCase(TestCase):
+    """Tests for caching anonymous cafe pages."""
 
     def setUp(self):
-        """Before each test, add sample city, users, and cafes"""
+        """Before each test, add sample city, user and cafe."""
 
+        Cafe.query.delete()
         City.query.delete()
         User.query.delete()
-        Cafe.query.delete()
 
         sf = City(**CITY_DATA)
         db.session.add(sf)
 
         user = User.register(**TEST_USER_DATA)
-        admin = User.register(**ADMIN_USER_DATA)
-        db.session.add_all([user, admin])
+        db.session.add(user)
 
         cafe = Cafe(**CAFE_DATA)
         db.session.add(cafe)
@@ -255,249 +383,1876 @@ class CafeAdminViewsTestCase(TestCase):
         db.session.commit()
 
         self.user_id = user.id
-        self.admin_id = admin.id
         self.cafe_id = cafe.id
 
+        page_cache.purge()
+        app.config['PAGE_CACHE_TTL'] = 60
+
     def tearDown(self):
-        """After each test, delete the cities."""
+        """After each test, remove all cafes and turn caching off."""
+
+        app.config['PAGE_CACHE_TTL'] = 0
+        page_cache.purge()
 
         Cafe.query.delete()
         City.query.delete()
         User.query.delete()
         db.session.commit()
 
-    def test_anon_add(self):
+    def test_anon_cached(self):
         with app.test_client() as client:
-            resp = client.get(f"/cafes/add", follow_redirects=True)
-            self.assertIn(b'Only admins can add cafes', resp.data)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
+            self.assertIn('s-maxage=60', resp.headers['Cache-Control'])
+            self.assertIn('Cookie', resp.headers['Vary'])
 
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'Only admins can add cafes', resp.data)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertEqual(resp.headers['X-Page-Cache'], 'HIT')
+            self.assertIn(b"Test Cafe", resp.data)
 
-    def test_user_add(self):
+    def test_logged_in_not_cached(self):
         with app.test_client() as client:
             do_login(client, self.user_id)
+            client.get("/cafes")
+            resp = client.get("/cafes")
+            self.assertNotIn('X-Page-Cache', resp.headers)
+            self.assertIn(b'Log Out', resp.data)
 
-            resp = client.get(f"/cafes/add", follow_redirects=True)
-            self.assertIn(b'Only admins can add cafes', resp.data)
-
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'Only admins can add cafes', resp.data)
-
-    def test_admin_add(self):
+    def test_purged_on_edit(self):
         with app.test_client() as client:
-            do_login(client, self.admin_id)
-
-            resp = client.get(f"/cafes/add")
-            self.assertIn(b'Add Cafe', resp.data)
+            client.get("/cafes")
 
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'added', resp.data)
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.name = "Renamed Cafe"
+            db.session.commit()
 
-    def test_dynamic_cities_vocab(self):
-        id = self.cafe_id
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
+            self.assertIn(b"Renamed Cafe", resp.data)
 
-        # the following is a regular expression for the HTML for the drop-down
-        # menu pattern we want to check for
-        choices_pattern = re.compile(
-            r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
-            r'San Francisco</option></select>')
 
+    def test_streamed_page_cached_when_sent(self):
         with app.test_client() as client:
-            do_login(client, self.admin_id)
+            resp = client.get("/cafes", buffered=False)
+            self.assertNotIn('Content-Length', resp.headers)
+            self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
+            resp.close()
 
-            resp = client.get(f"/cafes/add")
-            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+            # never read, so never cached
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
 
-            resp = client.get(f"/cafes/{id}/edit")
-            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers['X-Page-Cache'], 'HIT')
+            self.assertIn(b"Test Cafe", resp.data)
 
-    def test_anon_edit(self):
-        id = self.cafe_id
 
-        with app.test_client() as client:
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Only admins can edit cafes', resp.data)
+class StreamingTestCase(TestCase):
+    """Tests for streamed pages."""
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'Only admins can edit cafes', resp.data)
+    def setUp(self):
+        """Before each test, add sample city, user and liked cafe."""
 
-    def test_user_edit(self):
-        id = self.cafe_id
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
 
-        with app.test_client() as client:
-            do_login(client, self.user_id)
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Only admins can edit cafes', resp.data)
+        db.session.add(City(**CITY_DATA))
+        user = User.register(**TEST_USER_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+        db.session.add(Like(user_id=user.id, cafe_id=cafe.id))
+        db.session.commit()
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'Only admins can edit cafes', resp.data)
+        self.user_id = user.id
 
-    def test_admin_edit(self):
-        id = self.cafe_id
+    def tearDown(self):
+        """After each test, delete everything."""
+
+        app.config['STREAM_TEMPLATES'] = True
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
 
+    def test_buffered(self):
+        pieces = ['<html><head>', '<title>', '</head>', '<body>', 'x' * 10,
+                  '<p>', '</p>', '</body></html>']
+        self.assertEqual(list(buffered(pieces, 30)), [
+            '<html><head><title></head>',
+            '<body>xxxxxxxxxx<p></p></body></html>',
+        ])
+        self.assertEqual(list(buffered(pieces, 8)), [
+            '<html><head>', '<title></head>', '<body>xxxxxxxxxx',
+            '<p></p></body></html>',
+        ])
+
+    def test_pages_stream(self):
         with app.test_client() as client:
-            do_login(client, self.admin_id)
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Edit Test Cafe', resp.data)
+            do_login(client, self.user_id)
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'edited', resp.data)
+            resp = client.get("/cafes", buffered=False)
+            # streamed: no length up front
+            self.assertNotIn('Content-Length', resp.headers)
+            self.assertEqual(resp.mimetype, 'text/html')
+            # the head arrives before anything else is rendered
+            head = next(resp.response).decode()
+            self.assertIn('</head>', head)
+            self.assertNotIn('Test Cafe', head)
+            self.assertIn(b"Test Cafe", b''.join(resp.response))
+            resp.close()
+
+            resp = client.get("/profile")
+            self.assertNotIn('Content-Length', resp.headers)
+            self.assertIn(b"Your Liked Cafes", resp.data)
+            self.assertIn(b"Test Cafe", resp.data)
 
+    def test_streaming_off(self):
+        app.config['STREAM_TEMPLATES'] = False
 
-#######################################
-# users
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertIn('Content-Length', resp.headers)
+            self.assertIn(b"Test Cafe", resp.data)
 
 
-class UserModelTestCase(TestCase):
-    """Tests for the user model."""
+class CityMapTestCase(TestCase):
+    """Tests for city overview maps and city pages."""
 
     def setUp(self):
-        """Before each test, add sample users."""
+        """Before each test, add sample city and cafe, and send map
+        requests to a fake MapQuest saving into a temporary directory."""
 
-        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
 
         db.session.commit()
 
-        self.user = user
+        self.server = serve_fake_mapquest(0, background=True)
+        self.orig = mapping.MAPQUEST_BASE_URL, mapping.CITY_MAPS_DIR
+        self.dir = tempfile.TemporaryDirectory()
+        mapping.MAPQUEST_BASE_URL = (
+            f"http://127.0.0.1:{self.server.server_address[1]}")
+        mapping.CITY_MAPS_DIR = self.dir.name
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove all cafes and stop the fake MapQuest."""
 
-        User.query.delete()
+        mapping.MAPQUEST_BASE_URL, mapping.CITY_MAPS_DIR = self.orig
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
 
-    def test_authenticate(self):
-        rez = User.authenticate("test", "secret")
-        self.assertEqual(rez, self.user)
+    def test_city_map_url(self):
+        url = mapping.get_city_map_url(
+            ["1 Main St,San Francisco,CA", "2 Oak St,San Francisco,CA"])
+        self.assertIn(
+            "locations=1%20Main%20St,San%20Francisco,CA"
+            "||2%20Oak%20St,San%20Francisco,CA", url)
+        self.assertNotIn("center=", url)
+
+    def test_save_city_maps_chunks(self):
+        addresses = [f"{n} Main St" for n in range(150)]
+        count = mapping.save_city_maps("sf", addresses, "San Francisco", "CA")
+
+        self.assertEqual(count, 2)
+        self.assertEqual(mapping.get_city_map_count("sf"), 2)
+        self.assertEqual(
+            sorted(os.listdir(self.dir.name)),
+            ["sf-1.jpg", "sf-2.jpg", "sf.json"])
+
+        # fewer cafes: the extra map goes
+        mapping.save_city_maps("sf", addresses[:10], "San Francisco", "CA")
+        self.assertEqual(sorted(os.listdir(self.dir.name)),
+                         ["sf-1.jpg", "sf.json"])
+
+    def test_save_city_maps_changed_chunk(self):
+        addresses = [f"{n} Main St" for n in range(150)]
+        mapping.save_city_maps("sf", addresses, "San Francisco", "CA")
+        paths = [os.path.join(self.dir.name, f"sf-{n}.jpg") for n in (1, 2)]
+        for path in paths:
+            os.utime(path, (0, 0))
+
+        # only the second map has the moved cafe
+        addresses[120] = "120 Oak St"
+        mapping.save_city_maps("sf", addresses, "San Francisco", "CA")
+        self.assertEqual(os.stat(paths[0]).st_mtime, 0)
+        self.assertNotEqual(os.stat(paths[1]).st_mtime, 0)
+
+    def test_update_city_maps(self):
+        with app.app_context():
+            futures = update_city_maps("sf", "sf")
+
+        self.assertEqual(len(futures), 1)
+        futures[0].result()
+        self.assertEqual(mapping.get_city_map_count("sf"), 1)
+
+    def test_save_city_maps_unchanged(self):
+        sf = City.query.get("sf")
+        self.assertEqual(sf.save_map(), 1)
+
+        # same addresses: nothing is fetched, even with MapQuest gone
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(sf.save_map(), 1)
+
+    def test_city_page(self):
+        City.query.get("sf").save_map()
 
-    def test_authenticate_fail(self):
-        rez = User.authenticate("no-such-user", "secret")
-        self.assertEqual(rez, False)
+        with app.test_client() as client:
+            resp = client.get("/cities/sf")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"San Francisco, CA", resp.data)
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertIn(b"/static/maps/cities/sf-1.jpg", resp.data)
 
-        rez = User.authenticate("test", "password")
-        self.assertEqual(rez, False)
+            resp = client.get("/cities/nope")
+            self.assertEqual(resp.status_code, 404)
 
-    def test_full_name(self):
-        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+    def test_city_page_purged_on_edit(self):
+        app.config['PAGE_CACHE_TTL'] = 60
+        page_cache.purge()
 
-    def test_register(self):
-        u = User.register(**TEST_USER_DATA)
-        # test that password gets bcrypt-hashed (all start w/$2b$)
-        self.assertEqual(u.hashed_password[:4], "$2b$")
-        db.session.rollback()
+        try:
+            with app.test_client() as client:
+                client.get("/cities/sf")
 
+                cafe = Cafe.query.one()
+                cafe.name = "Renamed Cafe"
+                db.session.commit()
 
-class AuthViewsTestCase(TestCase):
-    """Tests for views on logging in/logging out/registration."""
+                resp = client.get("/cities/sf")
+                self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
+                self.assertIn(b"Renamed Cafe", resp.data)
+        finally:
+            app.config['PAGE_CACHE_TTL'] = 0
+            page_cache.purge()
+
+
+class CafeAPITestCase(TestCase):
+    """Tests for the JSON/MessagePack cafe API."""
 
     def setUp(self):
-        """Before each test, add sample users."""
+        """Before each test, add sample city and cafes."""
 
-        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafes = [Cafe(**dict(CAFE_DATA, name=f"Cafe {i}")) for i in range(5)]
+        db.session.add_all(cafes)
 
         db.session.commit()
 
-        self.user_id = user.id
+        self.cafe_ids = [cafe.id for cafe in cafes]
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove all cafes."""
 
-        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
 
-    def test_signup(self):
+    def test_parse_fields(self):
+        self.assertEqual(parse_fields("name, id,state"),
+                         ['id', 'name', 'state'])
+        self.assertEqual(parse_fields("city"), ['id', 'city'])
+        self.assertEqual(parse_fields(""), list(FIELDS))
+
+        with self.assertRaises(FieldError):
+            parse_fields("name,hashed_password")
+
+    def test_sparse_fields(self):
         with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
+            url = f"/api/cafes/{self.cafe_ids[0]}"
+            resp = client.get(f"{url}?fields=name,city")
 
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA_NEW,
-                follow_redirects=True,
-            )
+            self.assertEqual(resp.content_type, "application/json")
+            self.assertEqual(resp.json, {"cafe": {
+                "id": self.cafe_ids[0],
+                "name": "Cafe 0",
+                "city": "San Francisco",
+            }})
 
-            self.assertIn(b"You are signed up and logged in.", resp.data)
-            self.assertTrue(session.get(CURR_USER_KEY))
+            resp = client.get(url)
+            self.assertEqual(set(resp.json["cafe"]), set(FIELDS))
 
-    def test_login(self):
+            resp = client.get("/api/cafes?fields=nope")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/api/cafes/0")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json, {"error": "Not found"})
+
+    def test_keyset_pagination(self):
         with app.test_client() as client:
-            resp = client.get("/login")
-            self.assertIn(b'Welcome Back!', resp.data)
+            seen = []
+            url = "/api/cafes?fields=name&limit=2"
+            after = None
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "WRONG"},
-                follow_redirects=True,
-            )
+            while True:
+                resp = client.get(url + (f"&after={after}" if after else ""))
+                seen += [cafe["id"] for cafe in resp.json["cafes"]]
+                after = resp.json["next"]
+                if after is None:
+                    break
 
-            self.assertIn(b"Invalid credentials", resp.data)
+            self.assertEqual(seen, self.cafe_ids)
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "secret"},
-                follow_redirects=True,
-            )
+            resp = client.get("/api/cafes?city=nyc")
+            self.assertEqual(resp.json, {"cafes": [], "next": None})
 
-            self.assertIn(b"Hello, test", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+    def test_msgpack(self):
+        import msgpack
 
-    def test_logout(self):
         with app.test_client() as client:
-            do_login(client, self.user_id)
-            resp = client.post("/logout", follow_redirects=True)
+            resp = client.get(
+                "/api/cafes?fields=name&limit=1",
+                headers={"Accept": "application/msgpack"})
 
-            self.assertIn(b"successfully logged out", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), None)
+            self.assertEqual(resp.content_type, "application/msgpack")
+            self.assertIn("Accept", resp.headers["Vary"])
+            self.assertEqual(msgpack.unpackb(resp.data, raw=False), {
+                "cafes": [{"id": self.cafe_ids[0], "name": "Cafe 0"}],
+                "next": self.cafe_ids[0],
+            })
 
 
-class NavBarTestCase(TestCase):
-    """Tests navigation bar."""
+class SnapshotTestCase(TestCase):
+    """Tests for the memory-mapped catalog snapshot."""
 
     def setUp(self):
-        """Before tests, add sample user."""
-
-        User.query.delete()
+        """Before each test, add two cities and some cafes."""
 
-        user = User.register(**TEST_USER_DATA)
+        Cafe.query.delete()
+        City.query.delete()
 
-        db.session.add_all([user])
+        db.session.add_all([
+            City(**CITY_DATA),
+            City(code="oak", name="Oakland", state="CA"),
+        ])
+        cafes = [Cafe(**dict(CAFE_DATA, name=name, city_code=city))
+                 for name, city in [("Cafe C", "sf"), ("Café A", "oak"),
+                                    ("Cafe B", "sf")]]
+        db.session.add_all(cafes)
         db.session.commit()
 
-        self.user_id = user.id
+        self.ids = [cafe.id for cafe in cafes]
+
+        # the catalog reads its settings from the current app
+        ctx = app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        self.path = catalog.path()
 
     def tearDown(self):
-        """After tests, remove all users."""
+        """After each test, remove all cafes."""
 
-        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
 
-    def test_anon_navbar(self):
-        with app.test_client() as client:
+    def test_snapshot(self):
+        write_snapshot(self.path)
+        snapshot = catalog.get()
+
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot.city_counts(), {"sf": 2, "oak": 1})
+        # same order as the database's (collation-dependent) list order
+        self.assertEqual([row.name for row in snapshot.page(None, 0, 10)],
+                         [c.name for c in Cafe.query.order_by(Cafe.name)])
+        self.assertEqual([row.name for row in snapshot.page("sf", 1, 10)],
+                         ["Cafe C"])
+        self.assertEqual(snapshot.page("nyc", 0, 10), [])
+
+        row = snapshot.get(self.ids[1])
+        self.assertEqual((row.name, row.city_code, row.url),
+                         ("Café A", "oak", CAFE_DATA["url"]))
+        self.assertEqual(row.get_city_state(), "Oakland, CA")
+        self.assertIsNone(snapshot.get(0))
+
+        self.assertEqual([row.id for row in snapshot.after(self.ids[0], 5)],
+                         self.ids[1:])
+
+    def test_rebuilt_when_stale(self):
+        catalog.get()
+
+        cafe = Cafe.query.get(self.ids[0])
+        cafe.name = "Renamed Cafe"
+        db.session.commit()
+
+        self.assertEqual(catalog.get().get(self.ids[0]).name, "Renamed Cafe")
+
+    def test_replaced_by_another_process(self):
+        old = catalog.get()
+
+        # a write we don't hear about, then another process's rebuild
+        Cafe.query.filter_by(id=self.ids[0]).update(
+            {Cafe.name: "Elsewhere"})
+        db.session.commit()
+        catalog.dirty = False
+        write_snapshot(self.path)
+
+        new = catalog.get()
+        self.assertIsNot(new, old)
+        self.assertEqual(new.get(self.ids[0]).name, "Elsewhere")
+
+    def test_rebuild_keeps_current_file(self):
+        catalog.get()
+        inode = os.stat(self.path).st_ino
+
+        # e.g. a process that waited while another rebuilt
+        catalog.rebuild()
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+    def test_list_without_queries(self):
+        catalog.get()
+        City.get_registry()
+
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        engine = db.get_engine(app)
+        event.listen(engine, "before_cursor_execute", count)
+        self.addCleanup(event.remove, engine, "before_cursor_execute", count)
+
+        with app.test_client() as client:
+            resp = client.get("/cafes?city=sf")
+            self.assertIn(b"Cafe B", resp.data)
+            self.assertNotIn("Café A", resp.data.decode())
+
+            resp = client.get(f"/api/cafes/{self.ids[1]}?fields=city")
+            self.assertEqual(resp.json["cafe"]["city"], "Oakland")
+
+        self.assertEqual(statements, [])
+
+
+class HoursTestCase(TestCase):
+    """Tests for opening hours and "open now" filtering."""
+
+    def setUp(self):
+        """Before each test, add cities in two time zones, and cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add_all([
+            City(**dict(CITY_DATA, timezone="America/Los_Angeles")),
+            City(code="nyc", name="New York", state="NY",
+                 timezone="America/New_York"),
+        ])
+
+        morning = Cafe(**dict(CAFE_DATA, name="Morning Cafe",
+                              hours="Mon-Fri 7:00-11:00"))
+        late = Cafe(**dict(CAFE_DATA, name="Late Cafe", city_code="nyc",
+                           hours="Mon-Fri 10:00-2:00"))
+        unknown = Cafe(**dict(CAFE_DATA, name="Mystery Cafe"))
+        db.session.add_all([morning, late, unknown])
+
+        db.session.commit()
+
+        self.morning_id = morning.id
+        self.late_id = late.id
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def open_ids(self, at):
+        return sorted(id for (id,) in db.session.query(Cafe.id)
+                      .filter(Cafe.open_at(at)))
+
+    def test_parse_hours(self):
+        bitmap = parse_hours("Mon-Fri 7:00-18:00; Sat 8-12:30\nSun closed")
+
+        self.assertEqual(len(bitmap), 84)
+        self.assertTrue(is_open(bitmap, slot_at(datetime(2026, 10, 19, 7))))
+        self.assertFalse(is_open(bitmap, slot_at(datetime(2026, 10, 19, 18))))
+        self.assertTrue(
+            is_open(bitmap, slot_at(datetime(2026, 10, 24, 12, 15))))
+        self.assertFalse(
+            is_open(bitmap, slot_at(datetime(2026, 10, 24, 12, 30))))
+        self.assertEqual(parse_hours("Sun closed"), bytes(84))
+
+        # past midnight on Sunday is Monday morning
+        bitmap = parse_hours("Sun 22:00-1:00")
+        self.assertTrue(is_open(bitmap, slot_at(datetime(2026, 10, 19, 0))))
+
+        for bad in ("Mon-Fri", "Funday 9-5", "Mon 9:00-25:00", "Mon 9"):
+            with self.assertRaises(HoursError):
+                parse_hours(bad)
+
+    def test_form_validates_hours(self):
+        with app.test_request_context():
+            form = CafeAddEditForm(formdata=MultiDict(
+                dict(CAFE_DATA, hours="Mon 9-5pm")), meta={"csrf": False})
+            form.city_code.choices = City.get_city_codes()
+
+            self.assertFalse(form.validate())
+            self.assertIn("hours", form.errors)
+
+    def test_open_at_local(self):
+        # Monday 10:30, wherever the cafe is
+        self.assertEqual(self.open_ids(datetime(2026, 10, 19, 10, 30)),
+                         [self.morning_id, self.late_id])
+        # Tuesday 1:00 is still Monday night for the late cafe
+        self.assertEqual(self.open_ids(datetime(2026, 10, 20, 1)),
+                         [self.late_id])
+
+    def test_open_at_instant(self):
+        # Monday 15:00 UTC is 8:00 in San Francisco, 11:00 in New York
+        at = datetime(2026, 10, 19, 15, tzinfo=timezone.utc)
+        self.assertEqual(self.open_ids(at), [self.morning_id, self.late_id])
+
+        # Monday 18:30 UTC is 11:30 in San Francisco
+        at = datetime(2026, 10, 19, 18, 30, tzinfo=timezone.utc)
+        self.assertEqual(self.open_ids(at), [self.late_id])
+
+    def test_open_now_list(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes?open_now=1")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(b"Mystery Cafe", resp.data)
+
+    def test_open_in_snapshot(self):
+        # Monday 18:30 UTC is 11:30 in San Francisco, 14:30 in New York
+        at = datetime(2026, 10, 19, 18, 30, tzinfo=timezone.utc)
+
+        with app.app_context():
+            snapshot = catalog.get()
+            slots = City.get_local_slots(at)
+            found = snapshot.rows(snapshot.open_records(slots))
+            self.assertEqual([row.id for row in found], self.open_ids(at))
+
+            found = snapshot.open_records({"sf": slots["sf"]})
+            self.assertEqual(len(found), 0)
+
+    def test_open_at_api(self):
+        with app.test_client() as client:
+            resp = client.get(
+                "/api/cafes?fields=name&open_at=2026-10-19T08:00-07:00")
+            self.assertEqual([c["name"] for c in resp.json["cafes"]],
+                             ["Morning Cafe", "Late Cafe"])
+
+            resp = client.get("/api/cafes?open_at=now")
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.get("/api/cafes?open_at=teatime")
+            self.assertEqual(resp.status_code, 400)
+
+
+class AutocompleteTestCase(TestCase):
+    """Tests for cafe/city autocomplete."""
+
+    def setUp(self):
+        """Before each test, add sample city and cafe."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**dict(CAFE_DATA, name="Café du Soleil"))
+        db.session.add(cafe)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_prefix_index(self):
+        index = PrefixIndex()
+        index.add(1, "Blue Bean Cafe")
+        index.add(2, "Bean There")
+
+        self.assertEqual(index.search("bean", 10), [1, 2])
+        self.assertEqual(index.search("blue b", 10), [1])
+        self.assertEqual(index.search("bean", 1), [1])
+
+        index.remove(2, "Bean There")
+        self.assertEqual(index.search("bean", 10), [1])
+        self.assertEqual(len(index), 3)
+
+    def test_autocomplete(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/autocomplete?q=SOL")
+            self.assertEqual(resp.json["results"], [{
+                "type": "cafe",
+                "id": self.cafe_id,
+                "name": "Café du Soleil",
+                "city": "San Francisco, CA",
+                "url": f"/cafes/{self.cafe_id}",
+            }])
+
+            resp = client.get("/api/cafes/autocomplete?q=fran")
+            self.assertEqual(resp.json["results"][0]["url"], "/cafes?city=sf")
+
+            resp = client.get("/api/cafes/autocomplete?q=")
+            self.assertEqual(resp.json["results"], [])
+
+            # a limit below 1 still returns the best match
+            resp = client.get("/api/cafes/autocomplete?q=sol&limit=-5")
+            self.assertEqual(len(resp.json["results"]), 1)
+
+    def test_cafe_named_like_city(self):
+        cafe = Cafe(**dict(CAFE_DATA, name="San Francisco"))
+        db.session.add(cafe)
+        db.session.commit()
+
+        cafe_search.index = None
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/autocomplete?q=san fran")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                sorted(result["type"] for result in resp.json["results"]),
+                ["cafe", "city"])
+
+    def test_autocomplete_updated(self):
+        cafe_search.search("x")
+
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.name = "Moonbeam"
+        db.session.commit()
+
+        self.assertEqual(cafe_search.search("sol"), [])
+        self.assertEqual(cafe_search.search("moon")[0]["id"], self.cafe_id)
+
+
+class ImageProxyTestCase(TestCase):
+    """Tests for resized image proxy."""
+
+    SRC = "http://testcafeimg.com/o.jpg"
+
+    def setUp(self):
+        """Before each test, use an empty image cache."""
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.old_dir = app.config['IMAGE_CACHE_DIR']
+        app.config['IMAGE_CACHE_DIR'] = self.dir.name
+        disk_cache.size = None
+
+    def tearDown(self):
+        """After each test, remove the image cache."""
+
+        app.config['IMAGE_CACHE_DIR'] = self.old_dir
+        disk_cache.size = None
+        self.dir.cleanup()
+
+    def test_image_attrs(self):
+        with app.test_request_context():
+            self.assertEqual(
+                image_attrs(Cafe._default_img),
+                f'src="{static_url("images/default-cafe.jpg")}"')
+
+            attrs = image_attrs(self.SRC, "50vw")
+            self.assertIn(f'src="{proxied_url(self.SRC, 320)}"'.replace(
+                "&", "&amp;"), attrs)
+            self.assertIn(" 640w", attrs)
+            self.assertIn('sizes="50vw"', attrs)
+
+    def test_resize(self):
+        path = os.path.join(os.path.dirname(__file__), Cafe._default_img[1:])
+        with open(path, "rb") as f:
+            resized = resize(f.read(), (10, 20), 10 ** 8)
+
+        self.assertEqual(sorted(resized), [10, 20])
+        self.assertEqual(resized[10][:2], b"\xff\xd8")
+
+    def test_bad_signature(self):
+        with app.test_client() as client:
+            resp = client.get(f"/images/320/bad.jpg?src={self.SRC}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_serve_cached(self):
+        with app.test_request_context():
+            url = proxied_url(self.SRC, 320)
+            key = hashlib.sha256(self.SRC.encode()).hexdigest()
+            disk_cache.put(f"{key}-320.jpg", b"\xff\xd8jpeg")
+
+        with app.test_client() as client:
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, b"\xff\xd8jpeg")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+
+    def test_internal_addresses_refused(self):
+        for url in ["http://127.0.0.1/a.jpg", "http://localhost:8080/a.jpg",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "http://10.0.0.1/a.jpg", "http://[::1]/a.jpg",
+                    "http://[::ffff:192.168.0.1]/a.jpg", "file:///etc/passwd"]:
+            with self.assertRaises(ImageError, msg=url):
+                check_url(url)
+
+        check_url("http://93.184.216.34/a.jpg")
+
+    def test_redirects_checked(self):
+        requested = []
+
+        class Redirect(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requested.append(self.path)
+                self.send_response(302)
+                self.send_header("Location", "http://169.254.169.254/")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Redirect)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        start = f"http://127.0.0.1:{server.server_port}/start.jpg"
+
+        try:
+            # the server itself is internal
+            with self.assertRaises(ImageError):
+                fetch(start, 1000)
+            self.assertEqual(requested, [])
+
+            # let the first hop through: the redirect is still refused
+            def check_all_but_start(url):
+                return "127.0.0.1" if url == start else check_url(url)
+
+            images.check_url = check_all_but_start
+            try:
+                with self.assertRaisesRegex(ImageError, "not a public"):
+                    fetch(start, 1000)
+            finally:
+                images.check_url = check_url
+            self.assertEqual(requested, ["/start.jpg"])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_fetch_from_checked_address(self):
+        hosts = []
+
+        class Image(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hosts.append(self.headers["Host"])
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", "4")
+                self.end_headers()
+                self.wfile.write(b"\xff\xd8ok")
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Image)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        # a host that doesn't resolve: only the checked address works
+        url = f"http://rebound.invalid:{server.server_port}/a.jpg"
+
+        images.check_url = lambda url: "127.0.0.1"
+        try:
+            self.assertEqual(fetch(url, 1000), b"\xff\xd8ok")
+        finally:
+            images.check_url = check_url
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(hosts, [f"rebound.invalid:{server.server_port}"])
+
+    def test_serve_evicted_while_open(self):
+        with app.test_request_context():
+            disk_cache.put("a", b"\xff\xd8jpeg")
+            file = disk_cache.get("a")
+            os.remove(disk_cache.path("a"))
+
+        with file:
+            self.assertEqual(file.read(), b"\xff\xd8jpeg")
+
+    def test_evicts_oldest(self):
+        app.config['IMAGE_CACHE_MAX_BYTES'] = 25
+        try:
+            with app.test_request_context():
+                disk_cache.put("a", b"x" * 10)
+                os.utime(disk_cache.path("a"), (1, 1))
+                disk_cache.put("b", b"x" * 10)
+                disk_cache.put("c", b"x" * 10)
+
+                self.assertIsNone(disk_cache.get("a"))
+                self.assertIsNotNone(disk_cache.get("c"))
+        finally:
+            app.config['IMAGE_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+
+
+class CafeAdminViewsTestCase(TestCase):
+    """Tests for add/edit views on cafes."""
+
+    def setUp(self):
+        """Before each test, add sample city, users, and cafes"""
+
+        City.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.add_all([user, admin])
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """After each test, delete the cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_anon_add(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/add", follow_redirects=True)
+            self.assertIn(b'Only admins can add cafes', resp.data)
+
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'Only admins can add cafes', resp.data)
+
+    def test_user_add(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            resp = client.get(f"/cafes/add", follow_redirects=True)
+            self.assertIn(b'Only admins can add cafes', resp.data)
+
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'Only admins can add cafes', resp.data)
+
+    def test_admin_add(self):
+        with app.test_client() as client:
+            do_login(client, self.admin_id)
+
+            resp = client.get(f"/cafes/add")
+            self.assertIn(b'Add Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'added', resp.data)
+
+    def test_dynamic_cities_vocab(self):
+        id = self.cafe_id
+
+        # the following is a regular expression for the HTML for the drop-down
+        # menu pattern we want to check for
+        choices_pattern = re.compile(
+            r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
+            r'San Francisco</option></select>')
+
+        with app.test_client() as client:
+            do_login(client, self.admin_id)
+
+            resp = client.get(f"/cafes/add")
+            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+            resp = client.get(f"/cafes/{id}/edit")
+            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+    def test_anon_edit(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Only admins can edit cafes', resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'Only admins can edit cafes', resp.data)
+
+    def test_user_edit(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Only admins can edit cafes', resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'Only admins can edit cafes', resp.data)
+
+    def test_admin_edit(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            do_login(client, self.admin_id)
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Edit Test Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'edited', resp.data)
+
+
+class FreezeTestCase(TestCase):
+    """Tests for `flask freeze`."""
+
+    def setUp(self):
+        """Before each test, add sample city and cafes, edited long ago."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        other = Cafe(**CAFE_DATA_EDIT)
+        db.session.add_all([cafe, other])
+        db.session.commit()
+
+        Cafe.query.update({Cafe.updated_at: datetime(2020, 1, 1)})
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.other_id = other.id
+        self.dir = tempfile.TemporaryDirectory()
+        self.out = self.dir.name
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+        self.dir.cleanup()
+
+    def freeze(self, *args):
+        result = app.test_cli_runner().invoke(
+            args=["freeze", self.out, "--workers", "1", *args])
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result.output
+
+    def read(self, *parts):
+        with open(os.path.join(self.out, *parts, "index.html")) as f:
+            return f.read()
+
+    def test_page_path(self):
+        self.assertEqual(page_path("/"), "index.html")
+        self.assertEqual(page_path("/cafes/3"), "cafes/3/index.html")
+        self.assertEqual(page_path("/cafes?page=2&city=sf"),
+                         "cafes/city=sf/page=2/index.html")
+
+    def test_static_url(self):
+        with app.test_request_context():
+            url = static_url("js/liking.js")
+            self.assertRegex(url, r"^/static/js/liking\.js\?v=[0-9a-f]{10}$")
+            self.assertEqual(static_url("nope.js"), "/static/nope.js")
+
+    def test_freeze(self):
+        output = self.freeze()
+        self.assertIn("Pages: 6 rendered, 0 removed", output)
+
+        self.assertIn("Flask Cafe", self.read())
+        self.assertIn("Test Cafe", self.read("cafes"))
+        self.assertIn("new-name", self.read("cafes", "city=sf"))
+        self.assertIn("new-name", self.read("cities", "sf"))
+        self.assertRegex(self.read("cafes", str(self.cafe_id)),
+                         r"/static/js/liking\.js\?v=")
+        self.assertTrue(os.path.exists(
+            os.path.join(self.out, "static", "js", "liking.js")))
+
+    def test_incremental(self):
+        self.freeze()
+
+        output = self.freeze()
+        self.assertIn("Pages: 0 rendered, 0 removed", output)
+
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.name = "Renamed Cafe"
+        db.session.delete(Cafe.query.get(self.other_id))
+        db.session.commit()
+
+        output = self.freeze()
+        self.assertIn("Pages: 5 rendered, 1 removed", output)
+        self.assertIn("Renamed Cafe", self.read("cafes", str(self.cafe_id)))
+        self.assertNotIn("new-name", self.read("cafes"))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.out, "cafes", str(self.other_id), "index.html")))
+
+
+class InvalidationBusTestCase(TestCase):
+    """Tests for relaying committed changes over NOTIFY."""
+
+    def setUp(self):
+        """Before each test, add sample city and cafe, and listen as if
+        we were another process."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        db.session.commit()
+        self.cafe_id = cafe.id
+
+        self.signals = []
+        self.arrived = threading.Event()
+        tables_changed.connect(self.on_changed)
+
+        self.listener = Listener(app, coalesce=0.3, origin="elsewhere")
+        self.listener.start()
+        self.assertTrue(self.listener.listening.wait(5))
+
+    def tearDown(self):
+        """After each test, stop listening and remove all cafes."""
+
+        self.listener.stop()
+        tables_changed.disconnect(self.on_changed)
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def on_changed(self, sender, changes, remote=False, **kwargs):
+        if remote:
+            self.signals.append(changes)
+            self.arrived.set()
+
+    def test_encode_decode(self):
+        changes = {
+            "cafes": {1, 2},
+            "likes": {(1, 2)},
+            "users": {None, 3},
+            "cities": set(f"c{n}" for n in range(bus.MAX_IDS + 1)),
+        }
+        self.assertEqual(
+            decode_changes(json.loads(encode_changes(changes))),
+            {"cafes": {1, 2}, "likes": {(1, 2)},
+             "users": {None}, "cities": {None}})
+
+    def test_commit_relayed(self):
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.name = "Renamed Cafe"
+        db.session.commit()
+
+        self.assertTrue(self.arrived.wait(5))
+        self.assertEqual(self.signals, [{"cafes": {self.cafe_id}}])
+
+        stats = self.listener.stats()
+        self.assertEqual(stats["received"], 1)
+        self.assertIsNotNone(stats["last_lag_ms"])
+
+    def test_rollback_not_relayed(self):
+        Cafe.query.get(self.cafe_id).name = "Never Saved"
+        db.session.flush()
+        db.session.rollback()
+
+        City.query.get("sf").name = "San Fran"
+        db.session.commit()
+
+        self.assertTrue(self.arrived.wait(5))
+        self.assertEqual(self.signals, [{"cities": {"sf"}}])
+
+    def test_unrelayed_tables_skipped(self):
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        City.query.get("sf").name = "San Fran"
+        db.session.commit()
+
+        self.assertTrue(self.arrived.wait(5))
+        self.assertEqual(self.signals, [{"cities": {"sf"}}])
+        self.assertEqual(self.listener.stats()["received"], 1)
+
+        db.session.delete(user)
+        db.session.commit()
+
+    def test_coalesced(self):
+        Cafe.query.get(self.cafe_id).name = "Renamed Cafe"
+        db.session.commit()
+        City.query.get("sf").name = "San Fran"
+        db.session.commit()
+
+        self.assertTrue(self.arrived.wait(5))
+        self.assertEqual(self.signals,
+                         [{"cafes": {self.cafe_id}, "cities": {"sf"}}])
+        self.assertEqual(self.listener.stats()["received"], 2)
+
+    def test_own_changes_skipped(self):
+        payload = json.dumps({"o": "elsewhere", "t": time.time(),
+                              "c": {"cafes": [self.cafe_id]}})
+        self.listener.dispatch([payload, "not json"])
+        self.assertEqual(self.signals, [])
+
+    def test_remote_change_purges_pages(self):
+        app.config['PAGE_CACHE_TTL'] = 60
+        page_cache.purge()
+
+        try:
+            with app.test_client() as client:
+                client.get(f"/cafes/{self.cafe_id}")
+
+                # another host renamed it
+                db.session.execute(
+                    "UPDATE cafes SET name = 'Renamed Cafe' WHERE id = :id",
+                    {"id": self.cafe_id})
+                db.session.commit()
+                payload = json.dumps({"o": "there", "t": time.time(),
+                                      "c": {"cafes": [self.cafe_id]}})
+                self.listener.dispatch([payload])
+
+                resp = client.get(f"/cafes/{self.cafe_id}")
+                self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
+                self.assertIn(b"Renamed Cafe", resp.data)
+        finally:
+            app.config['PAGE_CACHE_TTL'] = 0
+            page_cache.purge()
+
+
+class OfflineTestCase(TestCase):
+    """Tests for the service worker and its manifest."""
+
+    def tearDown(self):
+        app.config['SERVICE_WORKER'] = True
+        app.static_folder = os.path.join(app.root_path, 'static')
+        try:
+            os.remove(app.config['SERVICE_WORKER_MANIFEST'])
+        except FileNotFoundError:
+            pass
+
+    def test_service_worker(self):
+        with app.test_client() as client:
+            resp = client.get("/sw.js")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "application/javascript")
+            self.assertEqual(resp.headers['Cache-Control'], "no-cache")
+
+            js = resp.get_data(as_text=True)
+            with open(app.config['SERVICE_WORKER_MANIFEST']) as f:
+                manifest = json.load(f)
+            self.assertIn(json.dumps(manifest['version']), js)
+            with app.test_request_context():
+                self.assertIn(static_url('js/liking.js'), manifest['precache'])
+
+            resp = client.get("/")
+            self.assertIn(b'register("/sw.js")', resp.data)
+
+    def test_manifest_version(self):
+        static = tempfile.mkdtemp()
+        os.mkdir(os.path.join(static, 'js'))
+        os.mkdir(os.path.join(static, 'images'))
+        with open(os.path.join(static, 'js', 'a.js'), 'w') as f:
+            f.write("1")
+        app.static_folder = static
+
+        result = app.test_cli_runner().invoke(args=["offline", "manifest"])
+        self.assertEqual(result.exit_code, 0)
+        with open(app.config['SERVICE_WORKER_MANIFEST']) as f:
+            before = json.load(f)
+        self.assertIn("/static/js/a.js?v=", before['precache'][0])
+
+        with open(os.path.join(static, 'js', 'a.js'), 'w') as f:
+            f.write("2")
+        with app.app_context():
+            after = offline.build_manifest()
+        self.assertNotEqual(before['version'], after['version'])
+
+    def test_libraries_pinned(self):
+        with app.test_client() as client:
+            page = client.get("/").get_data(as_text=True)
+        loaded = re.findall(r'"(https://unpkg\.com/[^"]*)"', page)
+        self.assertEqual(loaded, list(LIBRARIES))
+        for url in loaded:
+            self.assertRegex(url, r"^https://unpkg\.com/[^/@]+@\d+\.\d+\.\d+/")
+
+    def test_disabled(self):
+        app.config['SERVICE_WORKER'] = False
+
+        with app.test_client() as client:
+            self.assertEqual(client.get("/sw.js").status_code, 404)
+            self.assertNotIn(b"/sw.js", client.get("/").data)
+
+
+class HealthTestCase(TestCase):
+    """Tests for health checks and warm-up."""
+
+    def setUp(self):
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+    def tearDown(self):
+        City.query.delete()
+        db.session.commit()
+
+    def test_healthz(self):
+        with app.test_client() as client:
+            resp = client.get("/healthz")
+            self.assertEqual(resp.json, {"ok": True})
+
+    def test_warm_up(self):
+        City.clear_registry()
+        app.jinja_env.cache.clear()
+
+        steps = warm_up(app)
+
+        self.assertEqual(list(steps),
+                         ["pool", "mappers", "templates", "caches", "bus"])
+        self.assertIsNotNone(City._registry)
+        self.assertTrue(bus.listener.listening.wait(5))
+        self.assertIn("cafe/list.html",
+                      [key[1] for key in app.jinja_env.cache.keys()])
+
+    def test_readyz(self):
+        warmup.timings.clear()
+
+        with app.test_client() as client:
+            resp = client.get("/readyz")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.json["ready"])
+            self.assertIn("templates", resp.json["warmup_ms"])
+
+    def test_readyz_db_down(self):
+        bad = create_app({
+            "SQLALCHEMY_DATABASE_URI": "postgresql://localhost:1/nope",
+            "SQLALCHEMY_ECHO": False,
+        })
+        # connect_db made it the default app; only its client should use it
+        db.app = app
+        warmup.timings.clear()
+
+        with bad.test_client() as client:
+            resp = client.get("/readyz")
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertFalse(resp.json["ready"])
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests for sending read-only views to a replica.
+
+    The "replica" is a second engine on the test database, so we can
+    see which engine each query went to.
+    """
+
+    def setUp(self):
+        """Before each test, add sample city, cafe and user, and a
+        replica."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+        self.orig = (app.config['SQLALCHEMY_BINDS'],
+                     app.config['SQLALCHEMY_REPLICA_BINDS'])
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica-0': app.config['SQLALCHEMY_DATABASE_URI']}
+        app.config['SQLALCHEMY_REPLICA_BINDS'] = ['replica-0']
+
+        self.engines = {
+            'primary': db.get_engine(app),
+            'replica': db.get_engine(app, bind='replica-0'),
+        }
+        self.queries = {}
+        self.listeners = {}
+        for name, engine in self.engines.items():
+            self.listeners[name] = self.counter(name)
+            event.listen(engine, 'before_cursor_execute',
+                         self.listeners[name])
+
+    def tearDown(self):
+        """After each test, drop the replica and remove all data."""
+
+        for name, engine in self.engines.items():
+            event.remove(engine, 'before_cursor_execute',
+                         self.listeners[name])
+        (app.config['SQLALCHEMY_BINDS'],
+         app.config['SQLALCHEMY_REPLICA_BINDS']) = self.orig
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def counter(self, name):
+        def count(conn, cursor, statement, *args):
+            self.queries[name] = self.queries.get(name, 0) + 1
+        return count
+
+    def test_read_only_view(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertGreater(self.queries.get('replica', 0), 0)
+        self.assertNotIn('primary', self.queries)
+
+    def test_other_views(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            resp = client.get("/profile/edit")
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertGreater(self.queries.get('primary', 0), 0)
+        self.assertNotIn('replica', self.queries)
+
+    def test_read_your_writes(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            client.post("/profile/edit", data=TEST_USER_DATA_EDIT)
+
+            with client.session_transaction() as sess:
+                self.assertGreater(sess[PRIMARY_UNTIL_KEY], time.time())
+
+            self.queries.clear()
+            resp = client.get("/profile")
+            self.assertIn(b"new-fn new-ln", resp.data)
+            self.assertNotIn('replica', self.queries)
+
+            with client.session_transaction() as sess:
+                sess[PRIMARY_UNTIL_KEY] = 0
+
+            self.queries.clear()
+            client.get("/profile")
+            self.assertIn('replica', self.queries)
+            self.assertNotIn('primary', self.queries)
+
+    def test_snapshot_reads_primary(self):
+        statements = {}
+
+        def record(name):
+            def listener(conn, cursor, statement, *args):
+                statements.setdefault(name, []).append(statement)
+            return listener
+
+        for name, engine in self.engines.items():
+            listener = record(name)
+            event.listen(engine, 'before_cursor_execute', listener)
+            self.addCleanup(event.remove, engine, 'before_cursor_execute',
+                            listener)
+
+        catalog.dirty = True
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertIn(CAFE_DATA["name"].encode(), resp.data)
+
+        def fingerprints(name):
+            return [s for s in statements.get(name, ())
+                    if "max(cafes.updated_at)" in s]
+
+        self.assertEqual(fingerprints('replica'), [])
+        self.assertGreater(len(fingerprints('primary')), 0)
+
+    def test_dispose_engines(self):
+        for engine in self.engines.values():
+            engine.connect().close()
+            self.assertGreater(engine.pool.checkedin(), 0)
+
+        dispose_engines(db, app)
+
+        for engine in self.engines.values():
+            self.assertEqual(engine.pool.checkedin(), 0)
+            self.assertEqual(engine.pool._pre_ping,
+                             app.config['SQLALCHEMY_ENGINE_OPTIONS'][
+                                 'pool_pre_ping'])
+
+    def test_pool_options(self):
+        pool = self.engines['primary'].pool
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        self.assertEqual(pool.size(), options['pool_size'])
+        self.assertEqual(pool._recycle, options['pool_recycle'])
+        self.assertEqual(pool._pre_ping, options['pool_pre_ping'])
+
+
+class SchemaTestCase(TestCase):
+    """Tests for migrations and the query plan check."""
+
+    def setUp(self):
+        """Before each test, add enough cafes, users and likes that the
+        planner prefers indexes where it has them."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.execute(City.__table__.insert(), [
+            dict(code=f"c{n}", name=f"City {n}", state="CA", timezone="UTC")
+            for n in range(10)])
+        hashed = bcrypt.generate_password_hash("secret").decode("utf8")
+        db.session.execute(User.__table__.insert(), [
+            dict(username=f"user{n}", email="u@test.com",
+                 first_name="F", last_name="L", description="",
+                 image_url="", hashed_password=hashed, admin=False)
+            for n in range(2000)])
+        db.session.execute(Cafe.__table__.insert(), [
+            dict(name=f"Cafe {n}", description="", url="",
+                 address=f"{n} Main St", city_code=f"c{n % 10}",
+                 image_url="", hours="")
+            for n in range(3000)])
+
+        user_ids = [id for (id,) in db.session.query(User.id)]
+        cafe_ids = [id for (id,) in db.session.query(Cafe.id)]
+        db.session.execute(Like.__table__.insert(), [
+            dict(user_id=user_ids[n % len(user_ids)], cafe_id=cafe_id)
+            for n, cafe_id in enumerate(cafe_ids)])
+        db.session.commit()
+        db.session.execute("ANALYZE")
+        db.session.commit()
+
+    def tearDown(self):
+        """After each test, remove all data."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_hot_queries_use_indexes(self):
+        with app.app_context():
+            self.assertEqual(schema.check_plans(rows=500), [])
+
+    def test_cli_imported_when_run(self):
+        # a fresh process: this one has imported everything already
+        code = ("import sys; from app import create_app; create_app(); "
+                "print(sorted(m for m in ('alembic', 'freezer', 'importer',"
+                " 'schema') if m in sys.modules))")
+        out = subprocess.run([sys.executable, "-c", code], check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE).stdout
+        self.assertEqual(out.decode().strip(), "[]")
+
+        result = app.test_cli_runner().invoke(args=["db", "--help"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("check-plans", result.output)
+
+    def test_default_config(self):
+        # create_app leaves WTF_CSRF_ENABLED unset; only tests set it
+        del app.config['WTF_CSRF_ENABLED']
+        try:
+            with app.app_context():
+                schema.check_plans(rows=500)
+            self.assertNotIn('WTF_CSRF_ENABLED', app.config)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_missing_index_fails(self):
+        index = next(i for i in Cafe.__table__.indexes
+                     if i.name == "ix_cafes_name_id")
+        index.drop(db.engine)
+
+        try:
+            with app.app_context():
+                failures = schema.check_plans(rows=500)
+        finally:
+            index.create(db.engine)
+
+        self.assertIn(("/cafes", "cafes"),
+                      [(page, table) for page, table, *rest in failures])
+
+    def test_migrations_match_models(self):
+        url = "postgresql:///flaskcafe-test-migrations"
+        admin = create_engine(app.config['SQLALCHEMY_DATABASE_URI'],
+                              isolation_level="AUTOCOMMIT")
+        admin.execute('DROP DATABASE IF EXISTS "flaskcafe-test-migrations"')
+        admin.execute('CREATE DATABASE "flaskcafe-test-migrations"')
+
+        try:
+            schema.upgrade(url=url)
+
+            engine = create_engine(url)
+            with engine.connect() as conn:
+                diff = compare_metadata(
+                    MigrationContext.configure(conn), db.metadata)
+            engine.dispose()
+            self.assertEqual(diff, [])
+
+            schema.downgrade("base", url=url)
+        finally:
+            admin.execute('DROP DATABASE "flaskcafe-test-migrations"')
+            admin.dispose()
+
+
+    def test_upgrade_from_baseline(self):
+        url = "postgresql:///flaskcafe-test-migrations"
+        admin = create_engine(app.config['SQLALCHEMY_DATABASE_URI'],
+                              isolation_level="AUTOCOMMIT")
+        admin.execute('DROP DATABASE IF EXISTS "flaskcafe-test-migrations"')
+        admin.execute('CREATE DATABASE "flaskcafe-test-migrations"')
+
+        try:
+            # a database as create_all() made it before this series
+            schema.upgrade("0001", url=url)
+            engine = create_engine(url)
+            engine.execute(
+                "INSERT INTO cities VALUES ('sf', 'San Francisco', 'CA');"
+                "INSERT INTO cafes (name, description, url, address,"
+                " city_code, image_url) VALUES ('C', '', '', '', 'sf', '');"
+                "INSERT INTO users (username, admin, email, first_name,"
+                " last_name, description, image_url, hashed_password)"
+                " VALUES ('u', false, '', '', '', '', '', '');"
+                "INSERT INTO likes SELECT users.id, cafes.id FROM users, cafes")
+
+            schema.upgrade(url=url)
+
+            row = engine.execute(
+                "SELECT cities.timezone, cafes.trending_score, cafes.hours,"
+                " likes.created_at IS NOT NULL FROM cities"
+                " JOIN cafes ON cafes.city_code = cities.code"
+                " JOIN likes ON likes.cafe_id = cafes.id").fetchone()
+            self.assertEqual(tuple(row), ("UTC", 0, "", True))
+            engine.dispose()
+        finally:
+            admin.execute('DROP DATABASE "flaskcafe-test-migrations"')
+            admin.dispose()
+
+
+class CafeImportTestCase(TestCase):
+    """Tests for `flask cafes import`."""
+
+    def setUp(self):
+        """Before each test, add sample city and an input file."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cafes.csv")
+        with open(self.path, "w") as f:
+            f.write(
+                "name,description,url,address,city_code,city,image_url\n"
+                "Cafe A,Nice,http://a.com/,1 Main St,sf,,\n"
+                "Cafe B,,,2 Main St,,San Francisco,\n"
+                ",No name,,3 Main St,sf,,\n"
+                "Cafe D,,,4 Main St,nyc,,\n")
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+        self.dir.cleanup()
+
+    def test_import(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(
+            args=["cafes", "import", self.path, "--no-maps", "--batch-size", "2"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("2 cafes imported, 2 rejected", result.output)
+
+        names = [c.name for c in Cafe.query.order_by('name')]
+        self.assertEqual(names, ["Cafe A", "Cafe B"])
+        self.assertEqual(
+            Cafe.query.filter_by(name="Cafe B").one().image_url,
+            Cafe._default_img)
+
+        with open(f"{self.path}.rejects.jsonl") as f:
+            rejects = [json.loads(line) for line in f]
+        self.assertEqual([r["line"] for r in rejects], [4, 5])
+        self.assertIn("name", rejects[0]["errors"])
+        self.assertIn("city_code", rejects[1]["errors"])
+
+    def test_bad_records(self):
+        path = os.path.join(self.dir.name, "cafes.jsonl")
+        with open(path, "w") as f:
+            f.write('{"name": "Cafe A", "address": "1 Main St", '
+                    '"city_code": "sf"}\n'
+                    '{"name": "Cafe B", \n'
+                    '["not", "an", "object"]\n'
+                    '{"name": "Cafe D", "address": "4 Main St", '
+                    '"city_code": "sf"}\n'
+                    '{"id": [5], "name": "Cafe E", "address": "5 Main St", '
+                    '"city_code": "sf"}\n')
+
+        result = app.test_cli_runner().invoke(
+            args=["cafes", "import", path, "--no-maps"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("2 cafes imported, 3 rejected", result.output)
+
+        with open(f"{path}.rejects.jsonl") as f:
+            rejects = [json.loads(line) for line in f]
+        self.assertEqual([r["line"] for r in rejects], [2, 3, 5])
+        self.assertEqual(rejects[0]["row"], '{"name": "Cafe B", ')
+        self.assertIn("Not valid JSON", rejects[0]["errors"]["record"][0])
+        self.assertEqual(rejects[1]["errors"],
+                         {"record": ["Not an object."]})
+        self.assertEqual(rejects[2]["errors"],
+                         {"id": ["Not a valid integer."]})
+
+
+class UserImportTestCase(TestCase):
+    """Tests for `flask users import`."""
+
+    def setUp(self):
+        """Before each test, add a user and an input file."""
+
+        User.query.delete()
+        User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "users.jsonl")
+        rows = [
+            dict(username="alice", email="alice@test.com", first_name="A",
+                 last_name="L", password="secret1"),
+            dict(username="bob", email="bob@test.com", first_name="B",
+                 last_name="O", password="secret2", description="Hi"),
+            # taken, case-insensitively
+            dict(username="TEST", email="t@test.com", first_name="T",
+                 last_name="T", password="secret3"),
+            dict(username="carol", email="not-an-email", first_name="C",
+                 last_name="A", password="secret4"),
+            dict(username="Alice", email="alice2@test.com", first_name="A",
+                 last_name="L", password="secret5"),
+            dict(username="dave", email="dave@test.com", first_name="D",
+                 last_name="A", password="secret6"),
+        ]
+        with open(self.path, "w") as f:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+        self.dir.cleanup()
+
+    def test_import(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=[
+            "users", "import", self.path, "--batch-size", "2",
+            "--workers", "2"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("3 users imported, 3 rejected", result.output)
+
+        names = [u.username for u in User.query.order_by('username')]
+        self.assertEqual(names, ["alice", "bob", "dave", "test"])
+        self.assertTrue(User.authenticate("bob", "secret2"))
+        self.assertFalse(User.authenticate("bob", "secret5"))
+        self.assertEqual(User.query.filter_by(username="dave").one()
+                         .image_url, User._default_img)
+
+        with open(f"{self.path}.rejects.jsonl") as f:
+            rejects = {r["line"]: r["errors"] for r in map(json.loads, f)}
+        self.assertEqual(sorted(rejects), [3, 4, 5])
+        self.assertIn("taken", rejects[3]["username"][0])
+        self.assertIn("email", rejects[4])
+        self.assertIn("username", rejects[5])
+
+    def test_insert_conflicts(self):
+        inserted = importer.insert_users([
+            dict(username=name, email="x@test.com", first_name="X",
+                 last_name="Y", description="", admin=False,
+                 hashed_password="x")
+            for name in ("Test", "zed", "ZED")])
+        db.session.commit()
+        self.assertEqual(inserted, {"zed"})
+
+
+#######################################
+# users
+
+
+class UserModelTestCase(TestCase):
+    """Tests for the user model."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user = user
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_authenticate(self):
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+
+    def test_authenticate_fail(self):
+        rez = User.authenticate("no-such-user", "secret")
+        self.assertEqual(rez, False)
+
+        rez = User.authenticate("test", "password")
+        self.assertEqual(rez, False)
+
+    def test_full_name(self):
+        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+
+    def test_register(self):
+        u = User.register(**TEST_USER_DATA)
+        # test that password gets bcrypt-hashed (all start w/$2b$)
+        self.assertEqual(u.hashed_password[:4], "$2b$")
+        db.session.rollback()
+
+
+class AuthViewsTestCase(TestCase):
+    """Tests for views on logging in/logging out/registration."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_signup(self):
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b'Sign Up', resp.data)
+
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA_NEW,
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"You are signed up and logged in.", resp.data)
+            self.assertTrue(session.get(CURR_USER_KEY))
+
+    def test_login(self):
+        with app.test_client() as client:
+            resp = client.get("/login")
+            self.assertIn(b'Welcome Back!', resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "WRONG"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Invalid credentials", resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Hello, test", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+
+    def test_logout(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            resp = client.post("/logout", follow_redirects=True)
+
+            self.assertIn(b"successfully logged out", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), None)
+
+
+class NavBarTestCase(TestCase):
+    """Tests navigation bar."""
+
+    def setUp(self):
+        """Before tests, add sample user."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+
+        db.session.add_all([user])
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After tests, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_anon_navbar(self):
+        with app.test_client() as client:
             resp = client.get("/cafes")
             self.assertIn(b'Log In', resp.data)
             self.assertIn(b'Sign Up', resp.data)
@@ -652,6 +2407,17 @@ class LikeViewsTestCase(TestCase):
 
             resp = client.post(f"/api/like", json=data)
             self.assertEqual(resp.json, {"liked": self.cafe_id})
+            score = Cafe.query.get(self.cafe_id).trending_score
+            self.assertGreater(score, 0)
+
+            # sent again, e.g. from the offline queue: counted once
+            resp = client.post(f"/api/like", json=data)
+            self.assertEqual(resp.json, {"liked": self.cafe_id})
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.user_id).count(), 1)
+            db.session.expire_all()
+            self.assertEqual(
+                Cafe.query.get(self.cafe_id).trending_score, score)
 
     def test_api_unlike(self):
         like = Like(user_id=self.user_id, cafe_id=self.cafe_id)
@@ -668,3 +2434,582 @@ class LikeViewsTestCase(TestCase):
 
             resp = client.post(f"/api/unlike", json=data)
             self.assertEqual(resp.json, {"unliked": self.cafe_id})
+
+
+class BakedQueriesTestCase(TestCase):
+    """Tests for the baked lookups in queries.py."""
+
+    def setUp(self):
+        """Before each test, add sample city, user, cafe and like"""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        user = User.register(**TEST_USER_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        other = Cafe(**CAFE_DATA_EDIT)
+        db.session.add_all([cafe, other])
+        db.session.commit()
+        db.session.add(Like(user_id=user.id, cafe_id=cafe.id))
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        """After each test, delete everything."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_lookups(self):
+        db.session.expunge_all()
+        # twice: building, then reusing the baked query
+        for _ in range(2):
+            self.assertEqual(queries.get_user(self.user_id).username, "test")
+            self.assertEqual(queries.get_cafe(self.cafe_id).name, "Test Cafe")
+            self.assertIsNone(queries.get_user(self.user_id + 100))
+            self.assertTrue(
+                queries.user_likes_cafe(self.user_id, self.cafe_id))
+            self.assertFalse(
+                queries.user_likes_cafe(self.user_id, self.other_id))
+            self.assertEqual(queries.find_login("TeSt").id, self.user_id)
+            self.assertIsNone(queries.find_login("nobody"))
+
+    def test_get_or_404(self):
+        with app.test_request_context():
+            with self.assertRaises(NotFound):
+                queries.get_cafe_or_404(self.other_id + 100)
+
+
+class TrendingTestCase(TestCase):
+    """Tests for trending cafe scores."""
+
+    def setUp(self):
+        """Before each test, add sample city, users, and cafes"""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        TrendingEpoch.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.add_all([user, admin])
+
+        cafe = Cafe(**CAFE_DATA)
+        other = Cafe(**CAFE_DATA_EDIT)
+        db.session.add_all([cafe, other])
+
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+        self.cafe_id = cafe.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        """After each test, delete everything."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        TrendingEpoch.query.delete()
+        db.session.commit()
+
+    def like(self, user_id, cafe_id, days_ago=0):
+        """Add a like made days_ago, and its score, as the API would."""
+
+        created_at = datetime.utcnow() - timedelta(days=days_ago)
+        db.session.add(
+            Like(user_id=user_id, cafe_id=cafe_id, created_at=created_at))
+        db.session.execute(
+            f"UPDATE cafes SET trending_score = trending_score + "
+            f"{trending.weight_sql(':at')} WHERE id = :id",
+            {"at": created_at, "id": cafe_id})
+        db.session.commit()
+
+    def scores(self):
+        return [(cafe.id, round(score, 3))
+                for cafe, score in trending.get_trending(10)]
+
+    def test_like_unlike_api(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            client.post("/api/like", json={"cafe_id": self.cafe_id})
+            self.assertEqual(self.scores(), [(self.cafe_id, 1.0)])
+
+            client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+            self.assertEqual(self.scores(), [])
+
+    def test_decay(self):
+        self.like(self.user_id, self.cafe_id, days_ago=7)
+        self.like(self.admin_id, self.cafe_id, days_ago=7)
+        self.like(self.user_id, self.other_id, days_ago=0)
+        self.like(self.admin_id, self.other_id, days_ago=14)
+
+        # two week-old likes (0.5 each) < one new like + a 2-week-old one
+        self.assertEqual(
+            self.scores(), [(self.other_id, 1.25), (self.cafe_id, 1.0)])
+
+    def test_renormalize(self):
+        self.like(self.user_id, self.cafe_id, days_ago=7)
+        self.like(self.user_id, self.other_id, days_ago=1)
+        before = self.scores()
+
+        result = app.test_cli_runner().invoke(args=["trending", "renormalize"])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertEqual(self.scores(), before)
+        self.assertIsNotNone(TrendingEpoch.query.get(1))
+        self.assertAlmostEqual(Cafe.query.get(self.cafe_id).trending_score,
+                               0.5, places=3)
+
+    def test_rebuild(self):
+        self.like(self.user_id, self.cafe_id, days_ago=7)
+        Cafe.query.update({Cafe.trending_score: 0})
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["trending", "rebuild"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(self.scores(), [(self.cafe_id, 0.5)])
+
+    def test_trending_page(self):
+        self.like(self.user_id, self.cafe_id)
+
+        with app.test_client() as client:
+            resp = client.get("/cafes/trending")
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertNotIn(b"new-name", resp.data)
+
+            resp = client.get("/api/cafes/trending")
+            self.assertEqual(resp.json["cafes"][0]["id"], self.cafe_id)
+
+            resp = client.get("/api/cafes/trending?limit=-1")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.json["cafes"]), 1)
+
+
+class CityStatsTestCase(TestCase):
+    """Tests for the city statistics dashboard."""
+
+    def setUp(self):
+        """Before each test, add a city, users, cafes and likes."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.add_all([user, admin])
+
+        cafe = Cafe(**CAFE_DATA)
+        other = Cafe(**CAFE_DATA_EDIT)
+        db.session.add_all([cafe, other])
+        db.session.commit()
+
+        db.session.add_all([
+            Like(user_id=user.id, cafe_id=cafe.id),
+            Like(user_id=admin.id, cafe_id=cafe.id,
+                 created_at=datetime.utcnow() - timedelta(days=60)),
+        ])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """After each test, delete everything."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_refresh(self):
+        result = app.test_cli_runner().invoke(args=["stats", "refresh"])
+        self.assertEqual(result.exit_code, 0)
+
+        [row] = stats.get_city_stats()
+        self.assertEqual(row.code, "sf")
+        self.assertEqual(row.cafe_count, 2)
+        self.assertEqual(row.like_count, 2)
+        self.assertEqual(row.top_cafe_id, self.cafe_id)
+        self.assertEqual(row.top_cafe_name, "Test Cafe")
+        self.assertEqual(row.top_cafe_likes, 2)
+        # the admin's like is too old to count
+        self.assertEqual(row.active_users, 1)
+        self.assertLess(datetime.utcnow() - row.refreshed_at,
+                        timedelta(minutes=1))
+
+        # numbers stay as of the refresh
+        Like.query.delete()
+        db.session.commit()
+        [row] = stats.get_city_stats()
+        self.assertEqual(row.like_count, 2)
+
+    def test_dashboard(self):
+        stats.refresh()
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/admin/stats", follow_redirects=True)
+            self.assertIn(b"Only admins can see statistics", resp.data)
+
+            do_login(client, self.user_id)
+            resp = client.get("/admin/stats", follow_redirects=True)
+            self.assertIn(b"Only admins can see statistics", resp.data)
+
+            do_login(client, self.admin_id)
+            resp = client.get("/admin/stats")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("San Francisco, CA", html)
+            self.assertIn(f'<a href="/cafes/{self.cafe_id}">Test Cafe</a>',
+                          html)
+            self.assertIn("0 minutes ago", html)
+            self.assertNotIn("flask stats refresh", html)
+
+            app.config['CITY_STATS_MAX_AGE'] = -1
+            try:
+                resp = client.get("/admin/stats")
+            finally:
+                app.config['CITY_STATS_MAX_AGE'] = 60 * 60
+            self.assertIn(b"flask stats refresh", resp.data)
+
+
+class AsyncLikeAPITestCase(TestCase):
+    """Tests for the ASGI like API."""
+
+    def setUp(self):
+        """Before each test, add sample city, user, and cafe"""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """After each test, delete the cities."""
+
+        Follow.query.delete()
+        FeedItem.query.delete()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def call(self, method, path, user_id=None, query=b'', body=None,
+             **options):
+        """Make a request to a fresh LikeAPI; return (status, json), and
+        keep the response headers in self.headers."""
+
+        headers = []
+        if user_id:
+            serializer = app.session_interface.get_signing_serializer(app)
+            cookie = serializer.dumps({CURR_USER_KEY: user_id})
+            headers.append((b'cookie', f'session={cookie}'.encode()))
+
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query, 'headers': headers}
+        messages = [{'type': 'http.request',
+                     'body': json.dumps(body).encode() if body else b''}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            api = LikeAPI(app.config['SQLALCHEMY_DATABASE_URI'], 1, 1,
+                          secret_key=app.secret_key, **options)
+            await api(scope, receive, send)
+            if api.pool:
+                await api.pool.close()
+
+        asyncio.run(run())
+        self.headers = dict(sent[0]['headers'])
+        return sent[0]['status'], json.loads(sent[1]['body'])
+
+    def test_not_logged_in(self):
+        resp = self.call('GET', '/api/likes', query=b'cafe_id=1')
+        self.assertEqual(resp, (200, {"error": "Not logged in"}))
+
+    def test_like_unlike(self):
+        data = {"cafe_id": self.cafe_id}
+        query = f"cafe_id={self.cafe_id}".encode()
+
+        resp = self.call('POST', '/api/like', self.user_id, body=data)
+        self.assertEqual(resp, (200, {"liked": self.cafe_id}))
+
+        resp = self.call('GET', '/api/likes', self.user_id, query=query)
+        self.assertEqual(resp, (200, {"likes": True}))
+
+        [(cafe, score)] = trending.get_trending(10)
+        self.assertAlmostEqual(score, 1.0, places=3)
+        db.session.commit()
+
+        resp = self.call('POST', '/api/unlike', self.user_id, body=data)
+        self.assertEqual(resp, (200, {"unliked": self.cafe_id}))
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(trending.get_trending(10), [])
+
+    def test_read_your_writes(self):
+        data = {"cafe_id": self.cafe_id}
+
+        self.call('POST', '/api/like', self.user_id, body=data)
+        self.assertNotIn(b'set-cookie', self.headers)
+
+        self.call('POST', '/api/like', self.user_id, body=data,
+                  replicas=True)
+        cookie = SimpleCookie(self.headers[b'set-cookie'].decode())
+        serializer = app.session_interface.get_signing_serializer(app)
+        session = serializer.loads(cookie['session'].value)
+        self.assertEqual(session[CURR_USER_KEY], self.user_id)
+        self.assertGreater(session[PRIMARY_UNTIL_KEY], time.time())
+
+    def test_missing_cafe(self):
+        resp = self.call('POST', '/api/like', self.user_id,
+                         body={"cafe_id": self.cafe_id + 1})
+        self.assertEqual(resp[0], 404)
+
+    def test_like_fans_out(self):
+        other = User.register(**ADMIN_USER_DATA)
+        db.session.commit()
+        feed.follow(other.id, self.user_id)
+        db.session.commit()
+
+        self.call('POST', '/api/like', self.user_id,
+                  body={"cafe_id": self.cafe_id})
+        [entry] = feed.get_feed(other.id)[0]
+        self.assertEqual((entry.user_id, entry.cafe_id),
+                         (self.user_id, self.cafe_id))
+        db.session.commit()
+
+        self.call('POST', '/api/unlike', self.user_id,
+                  body={"cafe_id": self.cafe_id})
+        self.assertEqual(feed.get_feed(other.id), ([], None))
+        self.assertEqual(FeedItem.query.count(), 0)
+
+
+class FeedTestCase(TestCase):
+    """Tests for follows and the activity feed."""
+
+    def setUp(self):
+        """Before each test, add sample city, users, and cafes"""
+
+        Follow.query.delete()
+        FeedItem.query.delete()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        new = User.register(**TEST_USER_DATA_NEW)
+
+        cafe = Cafe(**CAFE_DATA)
+        other = Cafe(**CAFE_DATA_EDIT)
+        db.session.add_all([cafe, other])
+
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+        self.new_id = new.id
+        self.cafe_id = cafe.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        """After each test, delete everything."""
+
+        Follow.query.delete()
+        FeedItem.query.delete()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def like(self, user_id, cafe_id, minutes_ago):
+        db.session.add(Like(
+            user_id=user_id, cafe_id=cafe_id,
+            created_at=datetime.utcnow() - timedelta(minutes=minutes_ago)))
+        db.session.commit()
+
+    def feed_items(self, client, **params):
+        resp = client.get("/api/feed", query_string=params)
+        return [(item["user_id"], item["cafe_id"])
+                for item in resp.json["items"]], resp.json["next"]
+
+    def test_follow_like_unlike(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            resp = client.post("/api/follow", json={"user_id": self.admin_id})
+            self.assertEqual(resp.json, {"following": self.admin_id})
+            self.assertEqual(User.query.get(self.admin_id).follower_count, 1)
+
+            do_login(client, self.admin_id)
+            client.post("/api/like", json={"cafe_id": self.cafe_id})
+            # followers' feeds only; not the liker's own
+            self.assertEqual(self.feed_items(client), ([], None))
+
+            do_login(client, self.user_id)
+            self.assertEqual(self.feed_items(client),
+                             ([(self.admin_id, self.cafe_id)], None))
+
+            resp = client.get("/profile")
+            self.assertIn(b"Friends' Likes", resp.data)
+            self.assertIn(b"<b>admin</b> liked", resp.data)
+
+            do_login(client, self.admin_id)
+            client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+            do_login(client, self.user_id)
+            self.assertEqual(self.feed_items(client), ([], None))
+
+    def test_follow_backfills_unfollow_clears(self):
+        self.like(self.admin_id, self.cafe_id, minutes_ago=5)
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            client.post("/api/follow", json={"user_id": self.admin_id})
+            # following twice changes nothing
+            client.post("/api/follow", json={"user_id": self.admin_id})
+            self.assertEqual(User.query.get(self.admin_id).follower_count, 1)
+            self.assertEqual(self.feed_items(client),
+                             ([(self.admin_id, self.cafe_id)], None))
+
+            resp = client.post("/api/unfollow",
+                               json={"user_id": self.admin_id})
+            self.assertEqual(resp.json, {"unfollowed": self.admin_id})
+            self.assertEqual(User.query.get(self.admin_id).follower_count, 0)
+            self.assertEqual(self.feed_items(client), ([], None))
+
+    def test_follow_self(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            resp = client.post("/api/follow", json={"user_id": self.user_id})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(Follow.query.count(), 0)
+
+    def test_big_accounts_fan_out_on_read(self):
+        feed.follow(self.user_id, self.admin_id)
+        feed.follow(self.user_id, self.new_id)
+        User.query.get(self.admin_id).follower_count = (
+            feed.FANOUT_MAX_FOLLOWERS + 1)
+        db.session.commit()
+
+        with app.test_client() as client:
+            do_login(client, self.admin_id)
+            client.post("/api/like", json={"cafe_id": self.cafe_id})
+            do_login(client, self.new_id)
+            client.post("/api/like", json={"cafe_id": self.other_id})
+
+            # only the small account's like was copied
+            self.assertEqual(
+                [(item.actor_id, item.cafe_id) for item in FeedItem.query],
+                [(self.new_id, self.other_id)])
+
+            do_login(client, self.user_id)
+            items, next_page = self.feed_items(client)
+            self.assertEqual(sorted(items), sorted([
+                (self.admin_id, self.cafe_id), (self.new_id, self.other_id)]))
+
+    def test_pages(self):
+        feed.follow(self.user_id, self.admin_id)
+        User.query.get(self.new_id).follower_count = (
+            feed.FANOUT_MAX_FOLLOWERS + 1)
+        feed.follow(self.user_id, self.new_id)
+        db.session.commit()
+
+        # interleave fanned-out and read-time likes
+        self.like(self.admin_id, self.cafe_id, minutes_ago=1)
+        feed.add_like(self.admin_id, self.cafe_id)
+        db.session.execute(
+            "UPDATE feed_items SET liked_at = :at",
+            {"at": datetime.utcnow() - timedelta(minutes=1)})
+        db.session.commit()
+        self.like(self.new_id, self.cafe_id, minutes_ago=2)
+        self.like(self.new_id, self.other_id, minutes_ago=3)
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            pages = []
+            cursor = None
+            while True:
+                params = {"limit": 2}
+                if cursor:
+                    params["before"] = cursor
+                items, cursor = self.feed_items(client, **params)
+                pages.append(items)
+                if cursor is None:
+                    break
+
+            self.assertEqual(pages, [
+                [(self.admin_id, self.cafe_id), (self.new_id, self.cafe_id)],
+                [(self.new_id, self.other_id)],
+            ])
+
+            resp = client.get("/api/feed?before=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/profile?before=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_feeds_are_capped(self):
+        base = datetime.utcnow() - timedelta(days=1)
+        db.session.execute(FeedItem.__table__.insert(), [
+            dict(user_id=self.user_id, actor_id=self.new_id,
+                 cafe_id=self.cafe_id, liked_at=base + timedelta(seconds=n))
+            for n in range(feed.FEED_MAX_ITEMS + 5)])
+        self.like(self.admin_id, self.cafe_id, minutes_ago=0)
+
+        feed.follow(self.user_id, self.admin_id)
+        db.session.commit()
+
+        self.assertEqual(FeedItem.query.count(), feed.FEED_MAX_ITEMS)
+        # the oldest went
+        self.assertEqual(
+            db.session.query(db.func.min(FeedItem.liked_at)).scalar(),
+            base + timedelta(seconds=6))
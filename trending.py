@@ -0,0 +1,114 @@
+"""Trending cafes, ranked by exponentially decaying like scores.
+
+A like at time t is worth 2 ** ((t - epoch) / HALF_LIFE) points, and
+Cafe.trending_score is the sum over its likes. Since every score shrinks
+at the same rate, decaying them is the same as not decaying them at all:
+newer likes are simply worth more. So a like/unlike only adds/subtracts
+its own weight, and ranking is a walk down the index on trending_score.
+
+Weights grow with time, so `flask trending renormalize` should run
+periodically (weekly, say) to move the epoch forward and rescale scores.
+"""
+
+from datetime import timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from models import db, Cafe
+
+trending_cli = AppGroup('trending', help="Maintain trending cafe scores.")
+
+HALF_LIFE = timedelta(days=7)
+
+# epoch used until the first renormalize
+DEFAULT_EPOCH = '2020-01-01'
+
+# scores worth less than this many likes made now are dropped to 0
+MIN_SCORE = 0.001
+
+NOW_SQL = "timezone('utc', now())"
+
+
+def weight_sql(at):
+    """SQL for the points added by a like made at `at` (SQL timestamp)."""
+
+    return (
+        f"power(2.0, extract(epoch FROM {at} - coalesce("
+        f"(SELECT epoch FROM trending_epoch WHERE id = 1), "
+        f"TIMESTAMP '{DEFAULT_EPOCH}')) / {HALF_LIFE.total_seconds()})")
+
+
+# Core (not ORM) updates: scores are derived data, and shouldn't make
+# every cafe cache think the cafes table changed.
+
+ADD_LIKE_SQL = text(
+    f"UPDATE cafes SET trending_score = trending_score + {weight_sql(NOW_SQL)}"
+    f" WHERE id = :cafe_id")
+
+REMOVE_LIKE_SQL = text(
+    f"UPDATE cafes SET trending_score = greatest(0, trending_score - "
+    f"{weight_sql(':created_at')}) WHERE id = :cafe_id")
+
+REBUILD_SQL = text(
+    f"UPDATE cafes SET trending_score = coalesce("
+    f"(SELECT sum({weight_sql('likes.created_at')}) FROM likes"
+    f" WHERE likes.cafe_id = cafes.id), 0)")
+
+
+def add_like(cafe_id):
+    """Add a like made now (in this transaction) to the cafe's score."""
+
+    db.session.execute(ADD_LIKE_SQL, {"cafe_id": cafe_id})
+
+
+def remove_like(cafe_id, created_at):
+    """Take a deleted like, made at created_at, off the cafe's score."""
+
+    db.session.execute(
+        REMOVE_LIKE_SQL, {"cafe_id": cafe_id, "created_at": created_at})
+
+
+def get_trending(limit):
+    """Return [(cafe, score)] for the top cafes, best first.
+
+    Scores are in "likes made right now": a like from one half-life ago
+    counts 0.5.
+    """
+
+    score = Cafe.trending_score / db.literal_column(weight_sql(NOW_SQL))
+    return (db.session.query(Cafe, score)
+            .filter(Cafe.trending_score > 0)
+            .order_by(Cafe.trending_score.desc())
+            .limit(limit)
+            .all())
+
+
+@trending_cli.command('renormalize')
+def renormalize():
+    """Move the epoch to now and rescale all scores to match."""
+
+    # likes read the epoch; make them wait, so none is weighed against the
+    # old epoch and then added to a rescaled score
+    db.session.execute(text(
+        "LOCK TABLE trending_epoch IN ACCESS EXCLUSIVE MODE"))
+    db.session.execute(text(
+        f"UPDATE cafes SET trending_score = CASE"
+        f" WHEN trending_score / {weight_sql(NOW_SQL)} < :min_score THEN 0"
+        f" ELSE trending_score / {weight_sql(NOW_SQL)} END"
+        f" WHERE trending_score > 0"), {"min_score": MIN_SCORE})
+    db.session.execute(text(
+        f"INSERT INTO trending_epoch (id, epoch) VALUES (1, {NOW_SQL})"
+        f" ON CONFLICT (id) DO UPDATE SET epoch = excluded.epoch"))
+    db.session.commit()
+    click.echo("Trending scores renormalized.")
+
+
+@trending_cli.command('rebuild')
+def rebuild():
+    """Recompute every score from the likes table (e.g. after imports)."""
+
+    db.session.execute(REBUILD_SQL)
+    db.session.commit()
+    click.echo("Trending scores rebuilt.")
@@ -0,0 +1,120 @@
+"""Worker warm-up, and the health checks that report on it.
+
+A fresh worker pays for connecting to the database, compiling templates,
+configuring the ORM mappers, filling its caches and starting its
+invalidation listener on its first requests. warm_up() does all that up
+front (gunicorn calls it after forking each worker); /readyz says
+whether it has, so load balancers only send traffic to warm workers.
+/healthz just says the process is up.
+"""
+
+import threading
+import time
+
+from flask import Blueprint, current_app, jsonify
+from sqlalchemy.orm import configure_mappers
+
+import bus
+from models import db, Cafe, City
+
+health = Blueprint('health', __name__)
+
+# {step: seconds} for this process's last successful warm-up
+timings = {}
+
+_warming = threading.Lock()
+
+
+def open_pool(app):
+    """Open WARMUP_CONNECTIONS pooled connections at once, then return
+    them to the pool."""
+
+    engine = db.get_engine(app)
+    conns = []
+    try:
+        for i in range(app.config['WARMUP_CONNECTIONS']):
+            conn = engine.connect()
+            conns.append(conn)
+            conn.execute("SELECT 1")
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def compile_templates(app):
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def prime_caches(app):
+    from autocomplete import cafe_search
+    from snapshot import catalog
+
+    City.get_registry()
+    Cafe.get_city_counts()
+    cafe_search.refresh()
+    catalog.get()
+
+
+STEPS = [
+    ('pool', open_pool),
+    ('mappers', lambda app: configure_mappers()),
+    ('templates', compile_templates),
+    ('caches', prime_caches),
+    ('bus', bus.start),
+]
+
+
+def warm_up(app):
+    """Run each warm-up step; return {step: seconds}.
+
+    Raises if a step fails (e.g. the database is down); the worker then
+    stays not ready until /readyz manages a warm-up.
+    """
+
+    with _warming:
+        done = {}
+        with app.app_context():
+            for name, step in STEPS:
+                started = time.perf_counter()
+                step(app)
+                done[name] = time.perf_counter() - started
+
+            # don't hold a connection between requests
+            db.session.remove()
+
+        timings.clear()
+        timings.update(done)
+        return done
+
+
+def ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+@health.route('/healthz')
+def healthz():
+    """Liveness: the process is serving requests."""
+
+    return jsonify({"ok": True})
+
+
+@health.route('/readyz')
+def readyz():
+    """Readiness: warmed up, and the database answers."""
+
+    try:
+        if not timings:
+            if _warming.locked():
+                return jsonify({"ready": False, "error": "warming up"}), 503
+            warm_up(current_app._get_current_object())
+        db.session.execute("SELECT 1")
+    except Exception as e:
+        current_app.logger.warning("Not ready: %s", e)
+        return jsonify({"ready": False, "error": str(e)}), 503
+
+    return jsonify({
+        "ready": True,
+        "warmup_ms": {name: ms(seconds) for name, seconds in timings.items()},
+        "bus": bus.listener.stats() if bus.listener else None,
+    })